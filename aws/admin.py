@@ -1,13 +1,13 @@
 from django.contrib import admin, messages
 from django.utils.safestring import mark_safe
 
-from .models import Task, Profile, Instance
+from .models import Task, TaskDuration, Profile, Cluster, Instance
 
 
 @admin.register(Task)
 class TaskAdmin(admin.ModelAdmin):
-    list_display = ['project', 'build_pk', 'name', 'phase', 'is_critical', 'image', 'status', 'result']
-    list_filter = ['status', 'result', 'is_critical']
+    list_display = ['project', 'build_pk', 'name', 'phase', 'is_critical', 'is_speculative', 'image', 'status', 'result', 'pull_duration', 'cost']
+    list_filter = ['status', 'result', 'is_critical', 'is_speculative']
     raw_id_fields = ['build',]
 
     def build_pk(self, task):
@@ -19,9 +19,24 @@ class TaskAdmin(admin.ModelAdmin):
     project.short_description = 'Project'
 
 
+@admin.register(TaskDuration)
+class TaskDurationAdmin(admin.ModelAdmin):
+    list_display = ['project', 'slug', 'mean', 'samples', 'updated']
+    raw_id_fields = ['project']
+
+
+class ClusterInline(admin.TabularInline):
+    model = Cluster
+    fields = ['name', 'region', 'weight', 'subnet', 'security_groups', 'ami', 'throttled_until']
+    readonly_fields = ['throttled_until']
+    extra = 0
+
+
 @admin.register(Profile)
 class ProfileAdmin(admin.ModelAdmin):
-    list_display = ['slug', 'name', 'instance_type']
+    list_display = ['slug', 'name', 'launch_type', 'instance_type', 'instance_types']
+    list_filter = ['launch_type']
+    inlines = [ClusterInline]
 
 
 
@@ -37,7 +52,7 @@ terminate.short_description = "Terminate instance"
 
 @admin.register(Instance)
 class InstanceAdmin(admin.ModelAdmin):
-    list_display = ['profile', 'ec2_id', 'container_arn', 'created', 'active', 'preferred']
+    list_display = ['profile', 'cluster', 'ec2_id', 'instance_type', 'price', 'container_arn', 'created', 'active', 'preferred']
     list_filter = ['active', 'preferred']
     raw_id_fields = ['tasks']
     actions = [terminate]
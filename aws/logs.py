@@ -0,0 +1,312 @@
+import bisect
+import gzip
+import hashlib
+import itertools
+import logging
+import time
+import uuid
+
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+
+from projects.storage import read_range
+
+from .models import aws_client
+
+
+log = logging.getLogger('aws')
+
+# The minimum time (in seconds) between CloudWatch requests for a
+# single log stream, regardless of how many people are watching it.
+POLL_INTERVAL = 1
+
+# How long (in seconds) a cached copy of a log stream is retained. When
+# a copy expires, the stream is reloaded from CloudWatch.
+CACHE_TIMEOUT = 60 * 60
+
+# How much longer (in seconds) the chunks of a cached copy of a log stream
+# are retained than the metadata that describes them.
+EXPIRY_MARGIN = 60
+
+# How long (in seconds) a fetcher can hold the lock on a stream.
+LOCK_TIMEOUT = 30
+
+# The maximum amount of log data (in bytes) returned by a single read.
+MAX_READ_SIZE = 256 * 1024
+
+# The maximum number of lines, and the approximate maximum uncompressed
+# size (in bytes), of a single block in an archived log.
+BLOCK_LINES = 1000
+BLOCK_SIZE = 64 * 1024
+
+
+class LogTail:
+    """A shared, cached tail of a CloudWatch log stream.
+
+    The log content is stored in the cache as a sequence of chunks, each
+    containing the UTF-8 encoded events returned by a single CloudWatch
+    request. Viewers read from the cache using a byte offset into the log;
+    only one viewer at a time will actually go to CloudWatch for new data.
+
+    Each cached copy of the stream has a version, and all of its chunks
+    expire with it; the stream is then reloaded as a new version. Offsets
+    into the log are the same in every version, so viewers can carry on
+    reading from where they were.
+    """
+    def __init__(self, stream_name, group_name='beekeeper', region_name=None):
+        self.stream_name = stream_name
+        self.group_name = group_name
+        self.region_name = region_name
+        self.key = 'aws:log:%s' % hashlib.sha1(
+            ('%s/%s' % (group_name, stream_name)).encode('utf-8')
+        ).hexdigest()
+
+    def chunk_key(self, meta, index):
+        return '%s:%s:%s' % (self.key, meta['version'], index)
+
+    @property
+    def meta(self):
+        meta = cache.get(self.key)
+        if meta is None:
+            meta = {
+                'version': uuid.uuid4().hex,
+                'expires': time.time() + CACHE_TIMEOUT,
+                'token': None,
+                'bounds': [],
+                'length': 0,
+                'fetched': None,
+                'exhausted': False,
+            }
+        return meta
+
+    def refresh(self):
+        """Retrieve any new events for the stream from CloudWatch.
+
+        If the stream has been polled recently (or another viewer is
+        currently polling), this is a no-op.
+        """
+        meta = self.meta
+        if meta['fetched'] and meta['fetched'] + POLL_INTERVAL > time.time():
+            return
+
+        lock_key = '%s:lock' % self.key
+        lock = uuid.uuid4().hex
+        if not cache.add(lock_key, lock, LOCK_TIMEOUT):
+            return
+
+        try:
+            # Re-read the metadata now that we hold the lock; another
+            # viewer may have fetched in the meantime.
+            meta = self.meta
+            if meta['fetched'] and meta['fetched'] + POLL_INTERVAL > time.time():
+                return
+
+            kwargs = {
+                'startFromHead': True,
+            }
+            if meta['token']:
+                kwargs['nextToken'] = meta['token']
+
+            response = aws_client('logs', self.region_name).get_log_events(
+                logGroupName=self.group_name,
+                logStreamName=self.stream_name,
+                **kwargs
+            )
+
+            # If the fetch took so long that the lock expired, another
+            # viewer may have fetched the same events; let theirs stand.
+            if cache.get(lock_key) != lock:
+                return
+
+            data = ''.join(
+                event['message'] + '\n'
+                for event in response['events']
+            ).encode('utf-8')
+
+            # Every part of a version expires at the same time; chunks
+            # are kept a little longer than the metadata that describes
+            # them, so that they can always be found using the metadata.
+            timeout = max(int(meta['expires'] - time.time()), 1)
+            if data:
+                cache.set(self.chunk_key(meta, len(meta['bounds'])), data, timeout + EXPIRY_MARGIN)
+                meta['bounds'].append(meta['length'])
+                meta['length'] += len(data)
+
+            meta['token'] = response['nextForwardToken']
+            meta['fetched'] = time.time()
+            meta['exhausted'] = not data
+            cache.set(self.key, meta, timeout)
+        finally:
+            if cache.get(lock_key) == lock:
+                cache.delete(lock_key)
+
+    def read(self, offset=0):
+        """Read cached log data, starting at the given byte offset.
+
+        Returns a tuple containing the log data, and the offset that
+        should be used for the next read. While the stream is being
+        reloaded, a viewer may be further ahead than the cached copy;
+        the viewer keeps its offset until the copy catches up.
+        """
+        meta = self.meta
+        if offset >= meta['length']:
+            return b'', offset
+
+        first = max(bisect.bisect_right(meta['bounds'], offset) - 1, 0)
+        last = first
+        while last < len(meta['bounds']) and meta['bounds'][last] - offset < MAX_READ_SIZE:
+            last += 1
+
+        keys = [self.chunk_key(meta, index) for index in range(first, last)]
+        chunks = cache.get_many(keys)
+        if len(chunks) != len(keys):
+            # Part of the log has been evicted from the cache. Throw away
+            # this version, so the next refresh reloads the stream.
+            log.info("Log data for %s has been evicted; reloading." % self.stream_name)
+            cache.delete(self.key)
+            return b'', offset
+
+        data = b''.join(chunks[key] for key in keys)
+        start = meta['bounds'][first]
+        return data[offset - start:], start + len(data)
+
+    def is_complete(self, offset, since):
+        """Has a reader at the given offset seen the entire stream?
+
+        offset: The offset of the next read by the viewer.
+        since: A datetime; the stream is only considered complete if a
+            fetch that returned no new events occurred after this time.
+        """
+        meta = self.meta
+        return bool(
+            meta['exhausted']
+            and meta['fetched']
+            and meta['fetched'] > since.timestamp()
+            and offset >= meta['length']
+        )
+
+
+def log_events(stream_name, group_name='beekeeper', region_name=None):
+    "Iterate over the messages in a log stream, starting from the head."
+    token = None
+    while True:
+        kwargs = {
+            'startFromHead': True,
+        }
+        if token:
+            kwargs['nextToken'] = token
+
+        response = aws_client('logs', region_name).get_log_events(
+            logGroupName=group_name,
+            logStreamName=stream_name,
+            **kwargs
+        )
+        for event in response['events']:
+            yield event['message']
+
+        # When there are no more events, CloudWatch returns the token
+        # that was provided.
+        if response['nextForwardToken'] == token:
+            break
+        token = response['nextForwardToken']
+
+
+def write_archive(lines, outfile):
+    """Write log lines to a file as a series of independent gzip blocks.
+
+    Each block is a complete gzip member, so the file as a whole is a
+    valid gzip file, but any block can be decompressed in isolation.
+
+    Returns an index describing the archive. The index contains the total
+    uncompressed length and line count of the log, plus a list of blocks;
+    each block is described by the offset and line number (in the
+    uncompressed log) of its first line, and the offset and size of the
+    compressed block in the archive file.
+    """
+    index = {
+        'length': 0,
+        'lines': 0,
+        'blocks': [],
+    }
+    block = []
+    block_size = 0
+    position = 0
+
+    for line in itertools.chain(lines, [None]):
+        if line is not None:
+            data = (line + '\n').encode('utf-8')
+            block.append(data)
+            block_size += len(data)
+
+        if block and (line is None or len(block) >= BLOCK_LINES or block_size >= BLOCK_SIZE):
+            compressed = gzip.compress(b''.join(block))
+            outfile.write(compressed)
+            index['blocks'].append([
+                index['length'], index['lines'], position, len(compressed)
+            ])
+            index['length'] += block_size
+            index['lines'] += len(block)
+            position += len(compressed)
+
+            block = []
+            block_size = 0
+
+    return index
+
+
+class ArchivedLog:
+    """A log that has been archived to file storage by write_archive().
+
+    Content is retrieved using ranged reads of the archive, so only the
+    blocks that are needed are retrieved and decompressed.
+    """
+    def __init__(self, name, index, storage=default_storage):
+        self.name = name
+        self.index = index
+        self.storage = storage
+        self.offsets = [block[0] for block in index['blocks']]
+
+    @property
+    def length(self):
+        return self.index['length']
+
+    def read_blocks(self, first, last):
+        "Return the uncompressed content of blocks first to last (exclusive)."
+        blocks = self.index['blocks'][first:last]
+        if not blocks:
+            return b''
+
+        start = blocks[0][2]
+        end = blocks[-1][2] + blocks[-1][3]
+        # gzip.decompress() handles the concatenation of multiple members.
+        return gzip.decompress(read_range(self.name, start, end - start, storage=self.storage))
+
+    def read(self, offset=0):
+        """Read archived log data, starting at the given byte offset.
+
+        Returns a tuple containing the log data, and the offset that
+        should be used for the next read.
+        """
+        if offset >= self.length:
+            return b'', self.length
+
+        first = max(bisect.bisect_right(self.offsets, offset) - 1, 0)
+        last = first + 1
+        while last < len(self.offsets) and self.offsets[last] - offset < MAX_READ_SIZE:
+            last += 1
+
+        data = self.read_blocks(first, last)
+        start = self.offsets[first]
+        return data[offset - start:], start + len(data)
+
+    def stream(self, blocks_per_read=16):
+        "Iterate over the full content of the log, a few blocks at a time."
+        for first in range(0, len(self.offsets), blocks_per_read):
+            yield self.read_blocks(first, first + blocks_per_read)
+
+    def lines(self):
+        "Iterate over the lines of the log."
+        for data in self.stream():
+            # Blocks always contain complete lines, each terminated
+            # by a newline.
+            yield from data.decode('utf-8').split('\n')[:-1]
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from aws.logs import ArchivedLog
+from aws.models import Task
+from aws.tasks import index_log
+
+
+class Command(BaseCommand):
+    help = 'Build the search index for archived task logs that have not been indexed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true', dest='all',
+            help='Rebuild the index for all archived logs, not just the unindexed logs.'
+        )
+
+    def handle(self, **options):
+        self.verbosity = options['verbosity']
+
+        tasks = Task.objects.exclude(log_archive='')
+        if not options['all']:
+            tasks = tasks.filter(log_chunks__isnull=True)
+
+        for task in tasks.distinct().iterator():
+            if self.verbosity >= 1:
+                self.stdout.write("Indexing log for %s:%s..." % (task.build, task))
+
+            archive = ArchivedLog(task.log_archive.name, task.log_index)
+            with transaction.atomic():
+                for line in index_log(task, archive.lines()):
+                    pass
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 10:03
+from __future__ import unicode_literals
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aws', '0017_task_log_archive'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.CreateModel(
+            name='LogChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line', models.IntegerField()),
+                ('content', models.TextField()),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='log_chunks', to='aws.Task')),
+            ],
+            options={
+                'ordering': ('task', 'line'),
+            },
+        ),
+        # A trigram index for substring searches of log content. This
+        # index can't serve content__icontains; it is replaced by an
+        # index on UPPER(content) in 0031_logchunk_upper_trgm.
+        migrations.RunSQL(
+            'CREATE INDEX aws_logchunk_content_trgm ON aws_logchunk USING gin (content gin_trgm_ops);',
+            'DROP INDEX aws_logchunk_content_trgm;',
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 11:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aws', '0018_logchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='cache_key',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 12:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aws', '0019_task_cache_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='pull_duration',
+            field=models.DurationField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 12:50
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aws', '0020_task_pull_duration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='hot_image_count',
+            field=models.IntegerField(default=5),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='hot_images',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=list),
+        ),
+    ]
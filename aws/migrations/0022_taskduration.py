@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 13:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0011_cacheentry'),
+        ('aws', '0021_profile_hot_images'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskDuration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.CharField(max_length=100)),
+                ('samples', models.IntegerField(default=0)),
+                ('mean', models.DurationField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='task_durations', to='projects.Project')),
+            ],
+            options={
+                'ordering': ('project', 'slug'),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='taskduration',
+            unique_together=set([('project', 'slug')]),
+        ),
+    ]
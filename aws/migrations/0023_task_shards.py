@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 14:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aws', '0022_taskduration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='shard_index',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='shard_total',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 14:47
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aws', '0023_task_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='max_retries',
+            field=models.IntegerField(default=2),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='retries',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=list),
+        ),
+    ]
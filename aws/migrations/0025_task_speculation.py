@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 15:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aws', '0024_task_retries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='is_speculative',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='speculate_after',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
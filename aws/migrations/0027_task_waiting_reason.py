@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 16:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aws', '0026_task_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='waiting_reason',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 17:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aws', '0027_task_waiting_reason'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Cluster',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('region', models.CharField(blank=True, max_length=50)),
+                ('weight', models.PositiveIntegerField(default=1)),
+                ('subnet', models.CharField(blank=True, max_length=100)),
+                ('security_groups', models.CharField(blank=True, max_length=200)),
+                ('ami', models.CharField(blank=True, max_length=100, verbose_name='AMI')),
+                ('throttled_until', models.DateTimeField(blank=True, null=True)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='clusters', to='aws.Profile')),
+            ],
+            options={
+                'ordering': ('profile', '-weight', 'name'),
+            },
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='cluster',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='instances', to='aws.Cluster'),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='cluster',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='tasks', to='aws.Cluster'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cluster',
+            unique_together=set([('profile', 'region', 'name')]),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-20 09:10
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aws', '0030_instance_costs'),
+    ]
+
+    operations = [
+        # Case-insensitive substring searches (content__icontains) are
+        # compiled to UPPER("content"::text) LIKE UPPER(...), so the
+        # trigram index must be on the same expression to be used.
+        migrations.RunSQL(
+            'DROP INDEX aws_logchunk_content_trgm;',
+            'CREATE INDEX aws_logchunk_content_trgm ON aws_logchunk USING gin (content gin_trgm_ops);',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX aws_logchunk_content_upper_trgm ON aws_logchunk USING gin ((UPPER("content"::text)) gin_trgm_ops);',
+            'DROP INDEX aws_logchunk_content_upper_trgm;',
+        ),
+    ]
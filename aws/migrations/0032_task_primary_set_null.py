@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-20 09:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aws', '0031_logchunk_upper_trgm'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='task',
+            name='primary',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='aws.Task'),
+        ),
+    ]
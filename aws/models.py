@@ -1,174 +1,195 @@
 import base64
+import hashlib
+import json
 import logging
+import math
+import random
 import uuid
 from datetime import timedelta
 
 import boto3
 from botocore.exceptions import ClientError
 
-from github3.exceptions import GitHubError
-
 from django.conf import settings
 from django.contrib.postgres import fields as postgres
+from django.core.exceptions import ValidationError
 from django.db import models
-from django.urls import reverse
 from django.utils import timezone
-from django.utils.timesince import timesince
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from django.utils.timesince import timesince, timeuntil
 
-from projects.models import Build, ProjectSetting
+from projects.models import Build, BaseTask, BaseTaskQuerySet, CacheEntry, Project
 
 
 log = logging.getLogger('aws')
 
+# How long (in seconds) to wait after a task finishes before archiving
+# its log, to allow CloudWatch to receive the last log events.
+LOG_ARCHIVE_DELAY = 60
 
-class TaskQuerySet(models.QuerySet):
-    def started(self):
-        return self.filter(status__in=(
-                    Task.STATUS_WAITING,
-                    Task.STATUS_RUNNING,
-                ))
-
-    def not_finished(self):
-        return self.filter(status__in=(
-                    Task.STATUS_WAITING,
-                    Task.STATUS_RUNNING,
-                    Task.STATUS_STOPPING,
-                ))
-
-    def created(self):
-        return self.filter(status=Task.STATUS_CREATED)
-
-    def waiting(self):
-        return self.filter(status=Task.STATUS_WAITING)
-
-    def running(self):
-        return self.filter(status=Task.STATUS_RUNNING)
-
-    def stopping(self):
-        return self.filter(status=Task.STATUS_STOPPING)
-
-    def finished(self):
-        return self.filter(status__in=[
-                                Task.STATUS_DONE,
-                                Task.STATUS_ERROR,
-                                Task.STATUS_STOPPED,
-                            ])
-
-    def recently_finished(self):
-        return self.filter(
-            status__in=[
-                Task.STATUS_DONE,
-                Task.STATUS_ERROR,
-                Task.STATUS_STOPPED,
-            ],
-            updated__gt=timezone.now() - timedelta(hours=1)
+# The maximum number of instances to consider when looking for an
+# instance that already has a task's image.
+MAX_AFFINITY_INSTANCES = 10
+
+# How far back to look for the images used by recent tasks on a profile.
+HOT_IMAGE_PERIOD = timedelta(days=7)
+
+# The weight given to the most recent run when updating the expected
+# duration of a task.
+DURATION_WEIGHT = 0.2
+
+# The shard duration to aim for when a task is automatically sharded,
+# and the most shards a task will be split into.
+DEFAULT_SHARD_TARGET = timedelta(minutes=5)
+MAX_SHARDS = 20
+
+# AWS error codes that mean requests to a region are being throttled, and
+# how long to prefer other clusters after a cluster has been throttled.
+THROTTLING_ERRORS = {'Throttling', 'ThrottlingException', 'RequestLimitExceeded'}
+THROTTLE_PERIOD = timedelta(minutes=1)
+
+# The start of the failure reasons ECS gives when there isn't capacity
+# to run a task right now (as opposed to the task being unrunnable).
+CAPACITY_FAILURES = ('RESOURCE:', 'Capacity is unavailable')
+
+# Memory (in MB) on each instance that is used by the ECS agent and
+# Docker, and so can't be reserved by tasks.
+ECS_RESERVED_MEMORY = 256
+
+# How long an instance can take to register with ECS. An instance that
+# hasn't registered in that time isn't expected to take work.
+INSTANCE_BOOT_PERIOD = timedelta(minutes=10)
+
+
+_clients = {}
+
+
+def aws_client(service, region_name=None):
+    """Return a client for an AWS service that can be shared by the entire
+    process.
+
+    region_name: The region to connect to; by default, AWS_REGION.
+    """
+    region_name = region_name or settings.AWS_REGION
+    try:
+        return _clients[(service, region_name)]
+    except KeyError:
+        aws_session = boto3.session.Session(
+            region_name=region_name,
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
         )
+        client = aws_session.client(service)
+        _clients[(service, region_name)] = client
+        return client
 
-    def done(self):
-        return self.filter(status=Task.STATUS_DONE)
-
-    def error(self):
-        return self.filter(status=Task.STATUS_ERROR)
-
-    def failed(self):
-        return self.filter(result=Build.RESULT_FAIL)
-
-
-class Task(models.Model):
-    STATUS_CREATED = Build.STATUS_CREATED
-    STATUS_WAITING = Build.STATUS_WAITING
-    STATUS_RUNNING = Build.STATUS_RUNNING
-    STATUS_DONE = Build.STATUS_DONE
-    STATUS_ERROR = Build.STATUS_ERROR
-    STATUS_STOPPING = Build.STATUS_STOPPING
-    STATUS_STOPPED = Build.STATUS_STOPPED
-
-    STATUS_CHOICES = [
-        (STATUS_CREATED, 'Created'),
-        (STATUS_WAITING, 'Waiting'),
-        (STATUS_RUNNING, 'Running'),
-        (STATUS_DONE, 'Done'),
-        (STATUS_ERROR, 'Error'),
-        (STATUS_STOPPING, 'Stopping'),
-        (STATUS_STOPPED, 'Stopped'),
-    ]
-    objects = TaskQuerySet.as_manager()
 
-    build = models.ForeignKey(Build, related_name='tasks')
-    status = models.IntegerField(choices=STATUS_CHOICES, default=STATUS_CREATED)
-    result = models.IntegerField(choices=Build.RESULT_CHOICES, default=Build.RESULT_PENDING)
+_ec2_catalog = None
 
-    name = models.CharField(max_length=100, db_index=True)
-    slug = models.CharField(max_length=100, db_index=True)
 
-    phase = models.IntegerField()
-    is_critical = models.BooleanField()
-    queued = models.DateTimeField(null=True, blank=True)
-    started = models.DateTimeField(null=True, blank=True)
-    updated = models.DateTimeField(auto_now=True)
-    completed = models.DateTimeField(null=True, blank=True)
+def ec2_catalog():
+    """The EC2 instance types, and Fargate rates, that can be used to run
+    tasks, as loaded from the AWS_EC2_TYPES_FILE data file.
+
+    Prices are hourly, in US dollars. Instance types are keyed by name.
+    """
+    global _ec2_catalog
+    if _ec2_catalog is None:
+        with open(settings.AWS_EC2_TYPES_FILE) as data:
+            catalog = json.load(data)
+        catalog['instance_types'] = {
+            ec2_type['name']: ec2_type
+            for ec2_type in catalog['instance_types']
+        }
+        _ec2_catalog = catalog
+    return _ec2_catalog
+
+
+class TaskQuerySet(BaseTaskQuerySet):
+    def using_capacity(self):
+        "Tasks that have a container of their own."
+        return self.started().filter(arn__isnull=False, primary__isnull=True)
+
+    def by_expected_duration(self):
+        """Order tasks so the longest running tasks are started first.
+
+        Tasks that have never run (so have no expected duration) are
+        treated as the longest of all.
+        """
+        return self.annotate(
+            expected_duration=models.Subquery(
+                TaskDuration.objects.filter(
+                    project=models.OuterRef('build__change__project'),
+                    slug=models.OuterRef('slug'),
+                ).values('mean')[:1]
+            )
+        ).order_by(
+            models.F('expected_duration').desc(nulls_first=True), 'phase', 'name'
+        )
 
-    environment = postgres.JSONField(blank=True)
-    profile_slug = models.CharField(max_length=100, default='default')
-    arn = models.CharField(max_length=100, null=True, blank=True)
 
-    error = models.TextField(blank=True)
+class Task(BaseTask):
+    objects = TaskQuerySet.as_manager()
 
+    # ECS tasks have always allowed the image to be empty.
     image = models.CharField(max_length=100, null=True, blank=True)
 
-    class Meta:
-        ordering = ('phase', 'name',)
-        unique_together = [('build', 'slug')]
+    arn = models.CharField(max_length=100, null=True, blank=True)
+    waiting_reason = models.CharField(max_length=200, blank=True)
+
+    log_archive = models.FileField(max_length=255, blank=True)
+    log_index = postgres.JSONField(null=True, blank=True)
+
+    cache_key = models.CharField(max_length=64, blank=True)
+    pull_duration = models.DurationField(null=True, blank=True)
+
+    shard_index = models.IntegerField(null=True, blank=True)
+    shard_total = models.IntegerField(null=True, blank=True)
+
+    retries = postgres.JSONField(default=list, blank=True)
+
+    # If set, the task can be started before the previous phase has
+    # finished, once this fraction of the previous phase has passed.
+    speculate_after = models.FloatField(null=True, blank=True)
+    is_speculative = models.BooleanField(default=False)
+
+    # A digest of everything that determines what the task will do. If
+    # an identical task is already running, this task shares its run.
+    fingerprint = models.CharField(max_length=64, blank=True, db_index=True)
+    primary = models.ForeignKey(
+        'self', null=True, blank=True, related_name='duplicates', on_delete=models.SET_NULL
+    )
+
+    # The cluster that ran the task; null for the default cluster.
+    cluster = models.ForeignKey(
+        'Cluster', null=True, blank=True, related_name='tasks', on_delete=models.SET_NULL
+    )
+
+    # The estimated cost (in US dollars) of running the task.
+    cost = models.FloatField(null=True, blank=True)
 
     def save(self, *args, **kwargs):
+        if self.is_finished and self.cost is None:
+            self.cost = self.compute_cost()
         super().save(*args, **kwargs)
         # If this task finishes, is stopped, or errors out,
         # start the timer on the sweeper to shut down the instance
         # used to run it.
         if self.is_finished:
-            from .tasks import sweeper
-            sweeper.apply_async((str(self.pk),), countdown=self.profile.cooldown)
-
-    def get_absolute_url(self):
-        return reverse('projects:task', kwargs={
-                    'owner': self.build.change.project.repository.owner.login,
-                    'repo_name': self.build.change.project.repository.name,
-                    'change_pk': str(self.build.change.pk),
-                    'build_pk': str(self.build.pk),
-                    'task_slug': self.slug
-                })
-
-    def get_status_url(self):
-        return reverse('projects:task-status', kwargs={
-                    'owner': self.build.change.project.repository.owner.login,
-                    'repo_name': self.build.change.project.repository.name,
-                    'change_pk': str(self.build.change.pk),
-                    'build_pk': str(self.build.pk),
-                    'task_slug': self.slug
-                })
+            from .tasks import sweeper, archive_log
+            if self.profile.uses_instances:
+                sweeper.apply_async((str(self.pk),), countdown=self.profile.cooldown)
 
-    def __str__(self):
-        return self.name
+            # Once the log has been completely delivered to CloudWatch,
+            # archive it to file storage. A task that shared the run of
+            # another task uses the log of that task.
+            if self.arn and not self.log_archive and not self.primary_id:
+                archive_log.apply_async((str(self.pk),), countdown=LOG_ARCHIVE_DELAY)
 
     @property
-    def has_started(self):
-        return self.status in [
-            Task.STATUS_RUNNING,
-            Task.STATUS_DONE,
-            Task.STATUS_ERROR,
-        ]
-
-    @property
-    def is_finished(self):
-        return self.status in (
-            Task.STATUS_DONE,
-            Task.STATUS_ERROR,
-            Task.STATUS_STOPPED
-        )
-
-    @property
-    def has_error(self):
-        return self.status == Task.STATUS_ERROR
+    def log_archive_name(self):
+        return 'logs/%s/%s.log.gz' % (self.build.pk, self.slug)
 
     @property
     def log_stream_name(self):
@@ -180,52 +201,200 @@ class Task(models.Model):
     def profile(self):
         return Profile.objects.get(slug=self.profile_slug)
 
+    @property
+    def ecs_cluster(self):
+        "The cluster that ran (or will run) this task."
+        return self.cluster or Cluster.default()
+
+    @property
+    def region_name(self):
+        return self.ecs_cluster.region_name
+
+    @property
+    def log_source(self):
+        "The task whose run (and log) this task is using."
+        return self.primary or self
+
+    def read_new_log(self, offset=0):
+        """Read the log of the task, starting at the given byte offset.
+
+        Returns the log data, the offset that should be used for the next
+        read, and whether the whole log has been read. Once the log has
+        been archived, it is read from file storage; until then, it is
+        read from CloudWatch.
+        """
+        from .logs import ArchivedLog, LogTail
+
+        source = self.log_source
+        if source.log_archive:
+            archive = ArchivedLog(source.log_archive.name, source.log_index)
+            log_data, offset = archive.read(offset)
+            return log_data.decode('utf-8'), offset, offset >= archive.length
+
+        if not source.arn:
+            # The task hasn't been run, so there is no log.
+            return '', offset, True
+
+        tail = LogTail(source.log_stream_name, region_name=source.region_name)
+        try:
+            tail.refresh()
+        except ClientError:
+            # CloudWatch doesn't have the log (yet). If the task failed
+            # to start, it never will.
+            return '', offset, self.has_error
+        log_data, offset = tail.read(offset)
+        return log_data.decode('utf-8'), offset, tail.is_complete(offset, since=self.updated)
+
+    @property
+    def base_slug(self):
+        "The slug of the task, without any shard suffix."
+        if self.shard_total:
+            return self.slug.rsplit('.', 1)[0]
+        return self.slug
+
+    @property
+    def shards(self):
+        "All the shards of the task this task is a shard of."
+        return self.build.tasks.filter(slug__in=[
+            '%s.%s' % (self.base_slug, index)
+            for index in range(self.shard_total)
+        ])
+
     @property
     def aws_task_name(self):
-        if '/' in self.image:
-            return self.image.split('/')[1]
-        return self.image
+        return self.descriptor
+
+    @property
+    def retry_history(self):
+        "The times this task has been retried, and why."
+        return [
+            dict(retry, time=parse_datetime(retry['time']))
+            for retry in self.retries
+        ]
+
+    @cached_property
+    def expected_duration(self):
+        """The time this task is expected to take, based on previous runs.
+
+        Returns None if the task has never completed. Querysets ordered
+        by_expected_duration() provide this as an annotation; otherwise,
+        the durations of every task in the project are retrieved at once,
+        and cached on the build, so the other tasks of the build don't
+        need a query of their own.
+        """
+        build = self.build
+        try:
+            durations = build._expected_durations
+        except AttributeError:
+            durations = dict(
+                TaskDuration.objects.filter(
+                    project_id=build.change.project_id
+                ).order_by().values_list('slug', 'mean')
+            )
+            build._expected_durations = durations
+        return durations.get(self.slug)
+
+    @property
+    def eta(self):
+        "The time at which a running task is expected to finish."
+        if self.started and self.expected_duration:
+            return self.started + self.expected_duration
+        return None
 
     def full_status_display(self):
         if self.status == Task.STATUS_ERROR:
             return "Error: %s" % self.error
         elif self.status == Task.STATUS_WAITING:
-            return "Waiting (for %s)" % timesince(self.queued)
+            if self.expected_duration:
+                status = "Waiting (for %s; usually takes %s)" % (
+                    timesince(self.queued),
+                    timeuntil(timezone.now() + self.expected_duration),
+                )
+            else:
+                status = "Waiting (for %s)" % timesince(self.queued)
+            if self.waiting_reason:
+                status = '%s: %s' % (status, self.waiting_reason)
+            return status
         elif self.status == Task.STATUS_RUNNING:
+            if self.eta and self.eta > timezone.now():
+                return "Running (for %s; about %s remaining)" % (
+                    timesince(self.started), timeuntil(self.eta)
+                )
             return "Running (for %s)" % timesince(self.started)
         elif self.status == Task.STATUS_DONE:
             return "Done (Task took %s)" % timesince(self.started, now=self.completed)
         else:
             return self.get_status_display()
 
-    def start(self, ecs_client, ec2_client):
-        if self.build.change.is_pull_request:
-            pr_number = self.build.change.pull_request.number
-        else:
-            pr_number = ''
-
-        environment = {
-            'GITHUB_OWNER': self.build.commit.repository.owner.login,
-            'GITHUB_PROJECT_NAME': self.build.commit.repository.name,
-            'GITHUB_PR_NUMBER': pr_number,
-            'CODE_URL': settings.BEEKEEPER_URL + self.build.get_code_url(),
-            'SHA': self.build.commit.sha,
-            'TASK': self.slug.split(':')[-1],
-        }
-
-        # Add environment variables from the project configuration.
-        # Include, in order:
-        #  * Global variables for all tasks
-        #  * Global variables for a specific task
-        #  * Project variables for all tasks
-        #  * Project variables for a specific task
-        for project in [None, self.build.change.project]:
-            for descriptor in ['*', self.aws_task_name]:
-                for var in ProjectSetting.objects.filter(project=project, descriptor=descriptor):
-                    environment[var.key] = var.value
+    def build_environment(self):
+        "The environment variables that describe the build the task is part of."
+        environment = super().build_environment()
+
+        # Let a sharded task know which part of the work it should do.
+        if self.shard_total:
+            environment['SHARD_INDEX'] = self.shard_index
+            environment['SHARD_TOTAL'] = self.shard_total
+
+        # If the task declares a dependency cache, provide the URL
+        # where the cache can be retrieved and stored. Pull requests can
+        # only retrieve the cache, so they can't poison it for the
+        # builds of the project's own branches.
+        if self.cache_key:
+            environment['CACHE_URL'] = settings.BEEKEEPER_URL + CacheEntry.get_url(
+                self.build.change.project, self.slug, self.cache_key,
+                writable=not self.build.change.is_pull_request,
+            )
+            environment['CACHE_KEY'] = self.cache_key
+
+        return environment
+
+    def start(self, ecs_client, ec2_client, spawn=True):
+        """Start the task on ECS.
+
+        If there isn't capacity to run the task, a new instance will be
+        spawned, and the task will wait for capacity. If spawn is False,
+        the task is left untouched instead.
+        """
+        environment = self.run_environment()
+
+        # If an identical task (e.g., the same task on the same commit,
+        # in another build) is already running, share its run, rather
+        # than starting a new container.
+        self.fingerprint = self.compute_fingerprint(environment)
+        primary = Task.objects.started().filter(
+                fingerprint=self.fingerprint,
+                primary__isnull=True,
+                arn__isnull=False,
+            ).exclude(build=self.build_id).first()
+        if primary:
+            log.info("%s:%s is identical to %s:%s; sharing its run." % (
+                self.build, self, primary.build, primary
+            ))
+            self.primary = primary
+            self.arn = primary.arn
+            self.cluster = primary.cluster
+            self.status = primary.status
+            self.queued = primary.queued
+            self.started = primary.started
+            self.save()
 
-        # Add environment variables from the task configuration
-        environment.update(self.environment)
+            # Record that this task is using the instance, so the
+            # instance isn't swept while this task needs it.
+            for instance in primary.instances.all():
+                instance.tasks.add(self)
+            return
+
+        # Don't let a project use more than its share of resources.
+        reason = self.quota_reason()
+        if reason:
+            if spawn and self.waiting_reason != reason:
+                log.info("%s:%s is waiting: %s" % (self.build, self, reason))
+                self.status = Task.STATUS_WAITING
+                self.waiting_reason = reason
+                if self.queued is None:
+                    self.queued = timezone.now()
+                self.save()
+            return
 
         container_definition = {
             'name': self.aws_task_name,
@@ -243,19 +412,151 @@ class Task(models.Model):
         except Profile.DoesNotExist:
             raise RuntimeError("Unable to find a '%s' profile - is it defined?" % profile_name)
 
-        container_definition.update({
-            'cpu': profile.cpu,
-            'memory': profile.memory,
-        })
+        overrides = {
+            'containerOverrides': [container_definition]
+        }
+        if profile.uses_instances:
+            container_definition.update({
+                'cpu': profile.cpu,
+                'memory': profile.memory,
+            })
+        else:
+            # Fargate allocates resources to the task as a whole.
+            overrides.update({
+                'cpu': str(profile.cpu),
+                'memory': str(profile.memory),
+            })
+
+        # Try each of the profile's clusters in turn, until one of them
+        # has the capacity to run the task.
+        saturated = []
+        for cluster in profile.placements():
+            cluster_ecs_client = cluster.client('ecs', default=ecs_client)
+            try:
+                response = self.run_on(cluster, cluster_ecs_client, profile, overrides)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLING_ERRORS:
+                    raise
+                log.info("Requests to %s are being throttled; trying another cluster." % cluster)
+                cluster.throttle()
+                continue
+
+            if response['tasks']:
+                self.record_start(cluster, cluster_ecs_client, profile, response)
+                return
+
+            reason = response['failures'][0]['reason']
+            if not reason.startswith(CAPACITY_FAILURES):
+                log.error("FAILURE RESPONSE: %s" % response)
+                raise RuntimeError('Unable to start worker: %s' % reason)
+
+            log.info("%s doesn't have capacity for %s:%s (%s)." % (cluster, self.build, self, reason))
+            saturated.append(cluster)
+
+        capacity_reason = "Waiting for a %s instance" % profile
+        if not spawn:
+            log.info("No spare %s capacity for %s." % (profile, self))
+        elif not saturated:
+            # Every cluster is being throttled; try again on the next check.
+            self.status = Task.STATUS_WAITING
+            self.waiting_reason = "Waiting for AWS to stop throttling requests"
+            if self.queued is None:
+                self.queued = timezone.now()
+            self.save()
+        elif not profile.uses_instances:
+            # There are no instances to spawn; Fargate will have
+            # capacity again soon, so try again on the next check.
+            self.status = Task.STATUS_WAITING
+            self.waiting_reason = "Waiting for Fargate capacity"
+            if self.queued is None:
+                self.queued = timezone.now()
+            self.save()
+        elif self.waiting_reason != capacity_reason:
+            # This task hasn't asked for an instance yet. If the instances
+            # that are already starting can't run all the waiting tasks,
+            # spawn one in the most preferred cluster, sized for the tasks
+            # that will still be waiting.
+            waiting = Task.objects.waiting().filter(
+                    profile_slug=profile.slug,
+                    waiting_reason=capacity_reason,
+                ).exclude(pk=self.pk).count() + 1
+            waiting -= profile.booting_capacity()
+            if waiting <= 0:
+                log.info("Instances already starting for %s can run %s:%s." % (profile, self.build, self))
+            else:
+                cluster = saturated[0]
+                log.info("Spawning new %s instance in %s..." % (profile, cluster))
+                instance = profile.start_instance(
+                    key_name=settings.AWS_EC2_KEY_PAIR_NAME,
+                    security_groups=cluster.security_group_ids,
+                    subnet=cluster.subnet_id,
+                    cluster_name=cluster.name,
+                    ec2_client=cluster.client('ec2', default=ec2_client),
+                    ecs_client=cluster.client('ecs', default=ecs_client),
+                    cluster=cluster,
+                    waiting=waiting,
+                )
+                if instance:
+                    log.info("Created instance %s" % instance)
+                else:
+                    log.info("Maximum number of %s instances reached. Waiting for spare capacity..." % profile)
+            self.status = Task.STATUS_WAITING
+            self.waiting_reason = capacity_reason
+            if self.queued is None:
+                self.queued = timezone.now()
+            self.save()
 
-        response = ecs_client.run_task(
-            cluster=settings.AWS_ECS_CLUSTER_NAME,
+    def run_on(self, cluster, ecs_client, profile, overrides):
+        """Ask a cluster to run this task.
+
+        Returns the response from ECS.
+        """
+        if not profile.uses_instances:
+            return ecs_client.run_task(
+                cluster=cluster.name,
+                taskDefinition=self.aws_task_name,
+                overrides=overrides,
+                launchType=Profile.LAUNCH_TYPE_FARGATE,
+                networkConfiguration={
+                    'awsvpcConfiguration': {
+                        'subnets': [cluster.subnet_id],
+                        'securityGroups': cluster.security_group_ids,
+                        # Tasks need to reach the image registry and
+                        # GitHub; in a private subnet, this is ignored
+                        # in favor of the subnet's NAT gateway.
+                        'assignPublicIp': 'ENABLED',
+                    }
+                },
+            )
+
+        # If there's an instance that has already run this image (and so
+        # has the image cached), start the task on that instance.
+        # Otherwise, let ECS place the task.
+        container_arn = self.cached_image_instance(ecs_client, profile, cluster)
+        if container_arn:
+            log.info("Image %s is cached on container %s." % (self.image, container_arn))
+            response = ecs_client.start_task(
+                cluster=cluster.name,
+                taskDefinition=self.aws_task_name,
+                overrides=overrides,
+                containerInstances=[container_arn]
+            )
+            if response['tasks']:
+                return response
+
+            log.info("Unable to start task on container %s: %s" % (
+                container_arn, response['failures'][0]['reason']
+            ))
+
+        return ecs_client.run_task(
+            cluster=cluster.name,
             taskDefinition=self.aws_task_name,
-            overrides={
-                'containerOverrides': [container_definition]
-            }
+            overrides=overrides
         )
-        if response['tasks']:
+
+    def record_start(self, cluster, ecs_client, profile, response):
+        "Record that this task has been started by ECS."
+        if profile.uses_instances:
             container_arn = response['tasks'][0]['containerInstanceArn']
 
             try:
@@ -265,7 +566,7 @@ class Task(models.Model):
                 log.info("Task deployed on container %s..." % container_arn)
                 try:
                     ec2_id = ecs_client.describe_container_instances(
-                            cluster=settings.AWS_ECS_CLUSTER_NAME,
+                            cluster=cluster.name,
                             containerInstances=[container_arn]
                         )['containerInstances'][0]['ec2InstanceId']
                     log.info("Container %s is on EC2 instance %s." % (container_arn, ec2_id))
@@ -273,151 +574,393 @@ class Task(models.Model):
                     instance.container_arn = container_arn
                 except Instance.DoesNotExist:
                     log.info("EC2 instance %s is new." % ec2_id)
-                    instance = Instance(profile=profile, ec2_id=ec2_id)
+                    instance = Instance(profile=profile, ec2_id=ec2_id, cluster=cluster.saved)
 
             instance.save()
             instance.tasks.add(self)
+        else:
+            log.info("Task deployed on Fargate.")
+
+        # Add the timeout reaper task
+        from .tasks import reaper
+        reaper.apply_async((str(self.pk),), countdown=profile.timeout)
+
+        self.arn = response['tasks'][0]['taskArn']
+        self.cluster = cluster.saved
+        self.status = Task.STATUS_WAITING
+        self.waiting_reason = ''
+        if self.queued is None:
+            self.queued = timezone.now()
+        self.started = timezone.now()
+        self.save()
 
-            # Add the timeout reaper task
-            from .tasks import reaper
-            reaper.apply_async((str(self.pk),), countdown=profile.timeout)
+    def compute_cost(self):
+        """Estimate what it cost to run this task.
 
-            self.arn = response['tasks'][0]['taskArn']
-            self.status = Task.STATUS_WAITING
-            if self.queued is None:
-                self.queued = timezone.now()
-            self.started = timezone.now()
-            self.save()
-        elif response['failures'][0]['reason'] in ['RESOURCE:CPU']:
-            if self.status == Task.STATUS_CREATED:
-                log.info("Spawning new %s instance..." % profile)
-                instance = profile.start_instance(
-                    key_name=settings.AWS_EC2_KEY_PAIR_NAME,
-                    security_groups=settings.AWS_ECS_SECURITY_GROUP_IDS.split(':'),
-                    subnet=settings.AWS_ECS_SUBNET_ID,
-                    cluster_name=settings.AWS_ECS_CLUSTER_NAME,
-                    ec2_client=ec2_client,
-                )
-                if instance:
-                    log.info("Created instance %s" % instance)
-                else:
-                    log.info("Maximum number of %s instances reached. Waiting for spare capacity..." % profile)
-                self.status = Task.STATUS_WAITING
-                self.queued = timezone.now()
-                self.save()
-        else:
-            log.error("FAILURE RESPONSE: %s" % response)
-            raise RuntimeError('Unable to start worker: %s' % response['failures'][0]['reason'])
+        A task on an instance is charged its share of the price of the
+        instance for as long as it ran; a Fargate task is charged for the
+        resources it reserved. A task that shared the run of another task
+        is free. Returns None if the cost can't be determined.
+        """
+        if self.primary_id:
+            return 0.0
+        if self.started is None:
+            return None
 
-    def stop(self, aws_session=None, ecs_client=None):
-        if ecs_client is None:
-            if aws_session is None:
-                aws_session = boto3.session.Session(
-                    region_name=settings.AWS_REGION,
-                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                )
+        hours = ((self.completed or timezone.now()) - self.started).total_seconds() / 3600
+        try:
+            profile = self.profile
+        except Profile.DoesNotExist:
+            return None
+
+        if not profile.uses_instances:
+            rates = ec2_catalog()['fargate']
+            return hours * (
+                profile.cpu / 1024 * rates['vcpu_hour']
+                + profile.memory / 1024 * rates['gb_hour']
+            )
+
+        if self.pk is None:
+            return None
+        instance = self.instances.filter(price__isnull=False).first()
+        if instance is None:
+            return None
+        ec2_type = ec2_catalog()['instance_types'].get(instance.instance_type)
+        slots = profile.tasks_per_instance(ec2_type) if ec2_type else 1
+        return hours * instance.price / max(slots, 1)
+
+    def quota_reason(self):
+        """Check if starting this task would put its project over quota.
+
+        Returns a description of the quota that would be exceeded, or an
+        empty string if the task can be started.
+        """
+        project = self.build.change.project
+        running = Task.objects.using_capacity().filter(build__change__project=project)
+
+        if project.max_concurrent_builds is not None and not running.filter(build=self.build_id).exists():
+            builds = running.values('build').distinct().count()
+            if builds >= project.max_concurrent_builds:
+                return "%s already has %s builds running" % (project, builds)
+
+        if project.max_concurrent_tasks is not None:
+            tasks = running.count()
+            if tasks >= project.max_concurrent_tasks:
+                return "%s already has %s tasks running" % (project, tasks)
+
+        return ''
+
+    def compute_fingerprint(self, environment):
+        """Compute a digest of everything that determines what this task
+        will do when it runs with the given environment.
+
+        Environment variables that differ between builds without
+        changing the outcome of a task (e.g., the URL of the code) are
+        ignored.
+        """
+        return hashlib.sha256(json.dumps([
+            self.build.commit.sha,
+            self.image,
+            self.profile_slug,
+            sorted(
+                (str(key), str(value))
+                for key, value in environment.items()
+                if key not in settings.BEEKEEPER_FINGERPRINT_IGNORE
+            ),
+        ]).encode('utf-8')).hexdigest()
+
+    def cached_image_instance(self, ecs_client, profile, cluster=None):
+        """Find an instance that has already run this task's image, and
+        has the capacity to run this task.
+
+        cluster: The cluster to look in; by default, the default cluster.
+
+        Returns the container instance ARN, or None if no such instance
+        could be found.
+        """
+        if cluster is None:
+            cluster = Cluster.default()
+
+        container_arns = list(Instance.objects.active().filter(
+                profile=profile,
+                cluster=cluster.saved,
+                container_arn__isnull=False,
+                pk__in=Instance.objects.filter(tasks__image=self.image).values('pk'),
+            ).order_by('-checked').values_list('container_arn', flat=True)[:MAX_AFFINITY_INSTANCES])
+        if not container_arns:
+            return None
+
+        response = ecs_client.describe_container_instances(
+            cluster=cluster.name,
+            containerInstances=container_arns
+        )
+        for container in response['containerInstances']:
+            if container['status'] != 'ACTIVE' or not container['agentConnected']:
+                continue
+
+            remaining = {
+                resource['name']: resource.get('integerValue', 0)
+                for resource in container['remainingResources']
+            }
+            if remaining.get('CPU', 0) >= profile.cpu and remaining.get('MEMORY', 0) >= profile.memory:
+                return container['containerInstanceArn']
+
+        return None
+
+    def requeue(self, reason):
+        """Queue this task to be started again, after it was lost because
+        of a problem with the infrastructure it was running on.
+
+        Nothing about the lost run (where it ran, and when it started) is
+        kept, so the status and cost of the task only describe the new
+        run. The caller is responsible for saving the task.
+        """
+        self.retries.append({
+            'arn': self.arn,
+            'reason': reason,
+            'time': timezone.now().isoformat(),
+        })
+        self.arn = None
+        self.cluster = None
+        self.instances.clear()
+        self.status = Task.STATUS_WAITING
+        self.queued = timezone.now()
+        self.started = None
+        self.error = ''
+        self.pull_duration = None
+
+    def delete(self, *args, **kwargs):
+        self.release_duplicates()
+        super().delete(*args, **kwargs)
+
+    def release_duplicates(self):
+        """Hand the run of this task over to the tasks that share it, so
+        this task can be reset or deleted without losing their log.
+
+        The first of the duplicates becomes the primary for the others,
+        and takes over the log of the run.
+        """
+        duplicates = list(self.duplicates.order_by('pk'))
+        if not duplicates:
+            return
+
+        successor = duplicates[0]
+        log.info("Handing the run of %s:%s over to %s:%s." % (
+            self.build, self, successor.build, successor
+        ))
+        self.log_chunks.update(task=successor)
+        Task.objects.filter(pk=successor.pk).update(
+            primary=None,
+            log_archive=self.log_archive.name,
+            log_index=self.log_index,
+        )
+        Task.objects.filter(pk__in=[task.pk for task in duplicates[1:]]).update(primary=successor)
+
+        # If the run finished before its log was archived, archive it
+        # for the successor.
+        if successor.is_finished and self.arn and not self.log_archive:
+            from .tasks import archive_log
+            archive_log.apply_async((str(successor.pk),), countdown=LOG_ARCHIVE_DELAY)
+
+        # The archive now belongs to the successor.
+        self.log_archive = ''
+        self.log_index = None
+
+    def reset(self):
+        "Return this task to its initial state, so that it can be run again."
+        self.release_duplicates()
+        self.log_chunks.all().delete()
+        if self.log_archive:
+            self.log_archive.delete(save=False)
+
+        self.status = Task.STATUS_CREATED
+        self.result = Build.RESULT_PENDING
+        self.arn = None
+        self.queued = None
+        self.started = None
+        self.completed = None
+        self.error = ''
+        self.waiting_reason = ''
+        self.pull_duration = None
+        self.log_index = None
+        self.retries = []
+        self.is_speculative = False
+        self.fingerprint = ''
+        self.primary = None
+        self.cluster = None
+        self.cost = None
+        self.save()
 
+    def stop(self, aws_session=None, ecs_client=None):
+        if ecs_client is None and aws_session is not None:
             ecs_client = aws_session.client('ecs')
+        # Stop the task on the cluster that is running it.
+        cluster = self.ecs_cluster
+        ecs_client = cluster.client('ecs', default=ecs_client)
+
+        # If the run is shared with another task that hasn't finished,
+        # leave the container running for that task.
+        if self.arn and Task.objects.not_finished().filter(arn=self.arn).exclude(pk=self.pk).exists():
+            log.info("%s:%s shares its run with another task; not stopping %s." % (
+                self.build, self, self.arn
+            ))
+            self.status = Task.STATUS_STOPPED
+            self.save()
+            return
 
         response = ecs_client.stop_task(
-            cluster=settings.AWS_ECS_CLUSTER_NAME,
+            cluster=cluster.name,
             task=self.arn
         )
         self.status = Task.STATUS_STOPPING
         self.save()
 
-    def report(self, gh_repo):
-        """Report the status of this task to GitHub
+    def reported_status(self):
+        """The name, result, and URL of the status reported to GitHub.
 
-        gh_repo: An active GitHub API session.
+        All the shards of a sharded task are reported as a single status,
+        which only passes once every shard has passed.
         """
-        gh_commit = gh_repo.commit(self.build.commit.sha)
-        url = gh_commit._api.replace('commits', 'statuses')
-        payload = {
-            'context': '%s:%s/%s' % (settings.BEEKEEPER_NAMESPACE, self.phase, self.slug),
-            'state': {
-                Build.RESULT_PENDING: 'pending',
-                Build.RESULT_FAIL: 'failure',
-                Build.RESULT_NON_CRITICAL_FAIL: 'success',
-                Build.RESULT_PASS: 'success',
-            }[self.result],
-            'target_url': settings.BEEKEEPER_URL + self.get_absolute_url(),
-            'description': {
-                Build.RESULT_PENDING: '%s pending...' % self.name,
-                Build.RESULT_FAIL: '%s failed! Click for details.' % self.name,
-                Build.RESULT_NON_CRITICAL_FAIL: '%s: non-critical problem found. Click for details.' % self.name,
-                Build.RESULT_PASS: '%s passed.' % self.name,
-            }[self.result],
-        }
-        response = gh_commit._post(url, payload)
-        if not response.ok:
-            raise GitHubError(response.reason)
+        if not self.shard_total:
+            return super().reported_status()
 
+        results = [
+            self.result if shard.pk == self.pk else shard.result
+            for shard in self.shards
+        ]
+        if Build.RESULT_FAIL in results:
+            result = Build.RESULT_FAIL
+        elif Build.RESULT_PENDING in results:
+            result = Build.RESULT_PENDING
+        else:
+            result = min(results)
+        return (
+            self.name.rsplit(' (', 1)[0],
+            result,
+            settings.BEEKEEPER_URL + self.build.get_absolute_url(),
+        )
 
-class Profile(models.Model):
-    EC2_TYPES = [
-        # Price is us-west-2 price, as of 20 July 2017
-        {'name': 't2.nano',     'vcpu': 1,  'ecu': None,  'mem': 0.5,   'price': 0.0059},
-        {'name': 't2.micro',    'vcpu': 1,  'ecu': None,  'mem': 1,     'price': 0.012},
-        {'name': 't2.small',    'vcpu': 1,  'ecu': None,  'mem': 2,     'price': 0.023},
-        {'name': 't2.medium',   'vcpu': 2,  'ecu': None,  'mem': 4,     'price': 0.047},
-        {'name': 't2.large',    'vcpu': 2,  'ecu': None,  'mem': 8,     'price': 0.094},
-        {'name': 't2.xlarge',   'vcpu': 4,  'ecu': None,  'mem': 16,    'price': 0.188},
-        {'name': 't2.2xlarge',  'vcpu': 8,  'ecu': None,  'mem': 32,    'price': 0.376},
-
-        {'name': 'm4.large',    'vcpu': 2,  'ecu': 6.5,   'mem': 8,     'price': 0.1},
-        {'name': 'm4.xlarge',   'vcpu': 4,  'ecu': 13,    'mem': 16,    'price': 0.2},
-        {'name': 'm4.2xlarge',  'vcpu': 8,  'ecu': 26,    'mem': 32,    'price': 0.4},
-        {'name': 'm4.4xlarge',  'vcpu': 16, 'ecu': 53.5,  'mem': 64,    'price': 0.8},
-        {'name': 'm4.10xlarge', 'vcpu': 40, 'ecu': 124.5, 'mem': 160,   'price': 2.0},
-        {'name': 'm4.16xlarge', 'vcpu': 64, 'ecu': 188,   'mem': 256,   'price': 3.2},
-
-        {'name': 'c5.large',    'vcpu': 2,  'ecu': 8,     'mem': 3.75,  'price': 0.085},
-        {'name': 'c5.xlarge',   'vcpu': 4,  'ecu': 16,    'mem': 7.5,   'price': 0.17},
-        {'name': 'c5.2xlarge',  'vcpu': 8,  'ecu': 31,    'mem': 15,    'price': 0.34},
-        {'name': 'c5.4xlarge',  'vcpu': 16, 'ecu': 62,    'mem': 30,    'price': 0.68},
-        {'name': 'c5.9xlarge',  'vcpu': 36, 'ecu': 139,   'mem': 60,    'price': 1.53},
-        {'name': 'c5.18xlarge', 'vcpu': 72, 'ecu': 278,   'mem': 60,    'price': 3.06},
-
-        {'name': 'c4.large',    'vcpu': 2,  'ecu': 8,     'mem': 3.75,  'price': 0.1},
-        {'name': 'c4.xlarge',   'vcpu': 4,  'ecu': 16,    'mem': 7.5,   'price': 0.199},
-        {'name': 'c4.2xlarge',  'vcpu': 8,  'ecu': 31,    'mem': 15,    'price': 0.398},
-        {'name': 'c4.4xlarge',  'vcpu': 16, 'ecu': 62,    'mem': 30,    'price': 0.796},
-        {'name': 'c4.8xlarge',  'vcpu': 36, 'ecu': 132,   'mem': 60,    'price': 1.591},
-
-        {'name': 'p2.xlarge',   'vcpu': 4,  'ecu': 12,    'mem': 61,    'price': 0.9},
-        {'name': 'p2.8xlarge',  'vcpu': 32, 'ecu': 94,    'mem': 488,   'price': 7.2},
-        {'name': 'p2.16xlarge', 'vcpu': 64, 'ecu': 188,   'mem': 732,   'price': 14.4},
-
-        {'name': 'g3.4xlarge',  'vcpu': 16, 'ecu': 47,    'mem': 122,   'price': 1.14},
-        {'name': 'g3.8xlarge',  'vcpu': 32, 'ecu': 94,    'mem': 244,   'price': 2.28},
-        {'name': 'g3.16xlarge', 'vcpu': 64, 'ecu': 188,   'mem': 488,   'price': 4.56},
-
-        {'name': 'r4.large',    'vcpu': 2,  'ecu': 7,     'mem': 15.25, 'price': 0.133},
-        {'name': 'r4.xlarge',   'vcpu': 4,  'ecu': 13.5,  'mem': 30.5,  'price': 0.266},
-        {'name': 'r4.2xlarge',  'vcpu': 8,  'ecu': 27,    'mem': 61,    'price': 0.532},
-        {'name': 'r4.4xlarge',  'vcpu': 16, 'ecu': 53,    'mem': 122,   'price': 1.064},
-        {'name': 'r4.8xlarge',  'vcpu': 32, 'ecu': 99,    'mem': 244,   'price': 2.128},
-        {'name': 'r4.16xlarge', 'vcpu': 64, 'ecu': 195,   'mem': 488,   'price': 4.256},
-    ]
 
-    INSTANCE_TYPE_CHOICES = [
-        (ec2['name'], ec2['name'])
-        for ec2 in EC2_TYPES
+class LogChunk(models.Model):
+    """A group of consecutive lines from the log of a task.
+
+    Log chunks are indexed (with a trigram index) to allow the logs
+    of all tasks to be searched.
+    """
+    task = models.ForeignKey(Task, related_name='log_chunks')
+    line = models.IntegerField()
+    content = models.TextField()
+
+    class Meta:
+        ordering = ('task', 'line')
+
+    def __str__(self):
+        return '%s, line %s' % (self.task, self.line + 1)
+
+    def matching_lines(self, query):
+        """Return the lines in this chunk that contain the query.
+
+        Returns a list of (line number, line) pairs; the search is
+        case insensitive.
+        """
+        query = query.lower()
+        return [
+            (self.line + i + 1, line)
+            for i, line in enumerate(self.content.split('\n'))
+            if query in line.lower()
+        ]
+
+
+class TaskDuration(models.Model):
+    """The time a task usually takes to run on a project.
+
+    The mean is an exponentially weighted moving average, so it follows
+    changes in the duration of a task over time.
+    """
+    project = models.ForeignKey(Project, related_name='task_durations')
+    slug = models.CharField(max_length=100)
+    samples = models.IntegerField(default=0)
+    mean = models.DurationField()
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('project', 'slug')
+        unique_together = [('project', 'slug')]
+
+    def __str__(self):
+        return '%s: %s' % (self.project, self.slug)
+
+    @staticmethod
+    def add_sample(project, slug, duration):
+        "Update the expected duration of a task with a new sample."
+        entry, created = TaskDuration.objects.select_for_update().get_or_create(
+            project=project,
+            slug=slug,
+            defaults={'mean': duration, 'samples': 1},
+        )
+        if not created:
+            entry.mean += (duration - entry.mean) * DURATION_WEIGHT
+            entry.samples += 1
+            entry.save()
+        return entry
+
+    @staticmethod
+    def record(task):
+        """Update the expected duration of a task with a completed run.
+
+        A shard also contributes to the expected duration of the task
+        as a whole; the whole task is assumed to take as long as all
+        its shards run one after the other.
+        """
+        duration = task.completed - task.started
+        if task.shard_total:
+            TaskDuration.add_sample(
+                task.build.change.project, task.base_slug, duration * task.shard_total
+            )
+        return TaskDuration.add_sample(task.build.change.project, task.slug, duration)
+
+    @staticmethod
+    def shard_count(project, slug, target=None):
+        """How many shards should a task be split into?
+
+        Enough shards are used that each is expected to take no longer
+        than the target duration. A task that has never run isn't split.
+        """
+        if target is None:
+            target = DEFAULT_SHARD_TARGET
+        try:
+            mean = TaskDuration.objects.get(project=project, slug=slug).mean
+        except TaskDuration.DoesNotExist:
+            return 1
+        return max(1, min(MAX_SHARDS, math.ceil(mean / target)))
+
+
+class Profile(models.Model):
+    LAUNCH_TYPE_EC2 = 'EC2'
+    LAUNCH_TYPE_FARGATE = 'FARGATE'
+    LAUNCH_TYPE_CHOICES = [
+        (LAUNCH_TYPE_EC2, 'EC2 instances'),
+        (LAUNCH_TYPE_FARGATE, 'Fargate'),
     ]
-    INSTANCE_TYPE_PRICES = {
-        ec2['name']: str(ec2['price'])
-        for ec2 in EC2_TYPES
-    }
 
     name = models.CharField(max_length=100)
     slug = models.CharField(max_length=100, db_index=True)
 
-    instance_type = models.CharField(max_length=20, choices=INSTANCE_TYPE_CHOICES)
+    launch_type = models.CharField(max_length=20, choices=LAUNCH_TYPE_CHOICES, default=LAUNCH_TYPE_EC2)
+    # The instance types that can be started for the profile: either a
+    # single type, or a colon separated list of types to choose between.
+    # If neither is given, any type in the EC2 catalog can be used.
+    instance_type = models.CharField(max_length=20, blank=True)
+    instance_types = models.CharField(max_length=200, blank=True)
     spot = models.BooleanField(default=False)
+
+    # The resources reserved by each task (in compute units, where 1024
+    # is one vCPU, and MB), and the smallest instance (in vCPUs and GiB)
+    # that tasks should run on.
     cpu = models.IntegerField(default=0)
     memory = models.IntegerField(default=0)
+    min_vcpu = models.IntegerField(default=0)
+    min_memory = models.FloatField(default=0)
     ami = models.CharField('AMI', max_length=100, default='ami-57d9cd2e')
 
     timeout = models.IntegerField(default=60 * 60)
@@ -426,34 +969,219 @@ class Profile(models.Model):
     max_instances = models.IntegerField(null=True, blank=True)
     min_instances = models.IntegerField(default=0)
 
+    hot_image_count = models.IntegerField(default=5)
+    hot_images = postgres.JSONField(default=list, blank=True)
+
+    max_retries = models.IntegerField(default=2)
+
     class Meta:
         ordering = ('slug',)
 
     def __str__(self):
         return self.name
 
-    def start_instance(self, key_name, security_groups, subnet, cluster_name, aws_session=None, ec2_client=None):
-        if ec2_client is None:
+    def clean(self):
+        if self.uses_instances:
+            catalog = ec2_catalog()['instance_types']
+            unknown = [name for name in self.allowed_type_names if name not in catalog]
+            if unknown:
+                raise ValidationError("Unknown instance types: %s" % ', '.join(unknown))
+            if not self.candidate_types():
+                raise ValidationError("None of the allowed instance types can run a task for this profile.")
+        elif not (self.cpu and self.memory):
+            raise ValidationError("Fargate profiles must set the CPU and memory of their tasks.")
+
+    @property
+    def uses_instances(self):
+        "Does this profile run tasks on EC2 instances that it manages?"
+        return self.launch_type != Profile.LAUNCH_TYPE_FARGATE
+
+    @property
+    def allowed_type_names(self):
+        "The names of the instance types this profile is limited to, if any."
+        if self.instance_types:
+            return self.instance_types.split(':')
+        elif self.instance_type:
+            return [self.instance_type]
+        return []
+
+    def tasks_per_instance(self, ec2_type):
+        """The number of this profile's tasks that fit on an instance of
+        the given type.
+
+        A profile that doesn't reserve any resources is assumed to run
+        one task per vCPU.
+        """
+        fits = []
+        if self.cpu:
+            fits.append(ec2_type['vcpu'] * 1024 // self.cpu)
+        if self.memory:
+            fits.append(int((ec2_type['mem'] * 1024 - ECS_RESERVED_MEMORY) // self.memory))
+        if not fits:
+            fits.append(ec2_type['vcpu'])
+        return max(0, min(fits))
+
+    def candidate_types(self):
+        "The instance types from the EC2 catalog that can run this profile's tasks."
+        catalog = ec2_catalog()['instance_types']
+        names = self.allowed_type_names or list(catalog)
+        return [
+            catalog[name]
+            for name in names
+            if name in catalog
+            and catalog[name]['vcpu'] >= self.min_vcpu
+            and catalog[name]['mem'] >= self.min_memory
+            and self.tasks_per_instance(catalog[name]) > 0
+        ]
+
+    def choose_instance_type(self, waiting=1):
+        """Choose the type of instance to start for this profile.
+
+        The chosen type runs the waiting tasks (or as many of them as fit
+        on a single instance) at the lowest price per task-hour; ties go to
+        the cheaper instance. Returns None if none of the allowed types
+        can run a task.
+        """
+        best = None
+        for ec2_type in self.candidate_types():
+            packed = min(self.tasks_per_instance(ec2_type), max(waiting, 1))
+            cost = (ec2_type['price'] / packed, ec2_type['price'])
+            if best is None or cost < best[0]:
+                best = (cost, ec2_type)
+        return best[1] if best else None
+
+    def booting_capacity(self):
+        """The number of this profile's tasks that can be run by instances
+        that have recently been started, but haven't run a task yet.
+        """
+        catalog = ec2_catalog()['instance_types']
+        return sum(
+            self.tasks_per_instance(catalog[instance_type])
+            for instance_type in self.instances.active().filter(
+                container_arn__isnull=True,
+                created__gt=timezone.now() - INSTANCE_BOOT_PERIOD,
+            ).values_list('instance_type', flat=True)
+            if instance_type in catalog
+        )
+
+    def update_hot_images(self, ecs_client):
+        """Update the list of images that new instances should pull.
+
+        Hot images are the images used most by recent tasks on this
+        profile. The list records the name of each image, and the image
+        URI from its ECS task definition.
+        """
+        names = Task.objects.filter(
+                profile_slug=self.slug,
+                image__isnull=False,
+                build__created__gt=timezone.now() - HOT_IMAGE_PERIOD,
+            ).values('image').annotate(
+                uses=models.Count('pk')
+            ).order_by('-uses').values_list('image', flat=True)[:self.hot_image_count]
+
+        known = {
+            image['name']: image['uri']
+            for image in self.hot_images
+        }
+        hot_images = []
+        for name in names:
+            uri = known.get(name)
+            if uri is None:
+                try:
+                    response = ecs_client.describe_task_definition(
+                        taskDefinition=Task(image=name).aws_task_name
+                    )
+                    uri = response['taskDefinition']['containerDefinitions'][0]['image']
+                except ClientError as e:
+                    log.warning("Unable to find the image for %s: %s" % (name, e))
+                    continue
+            hot_images.append({'name': name, 'uri': uri})
+
+        self.hot_images = hot_images
+        self.save()
+
+    def placements(self):
+        """The clusters that can run tasks for this profile, in the order
+        they should be tried.
+
+        Clusters are shuffled in proportion to their weight, so tasks are
+        spread across them; clusters that have recently been throttled
+        are tried last. A profile with no clusters uses the default.
+        """
+        clusters = list(self.clusters.filter(weight__gt=0))
+        if not clusters:
+            return [Cluster.default()]
+
+        now = timezone.now()
+        return sorted(clusters, key=lambda cluster: (
+            cluster.throttled_until is not None and cluster.throttled_until > now,
+            -random.random() ** (1.0 / cluster.weight),
+        ))
+
+    def user_data(self, cluster_name):
+        """The script that is run when a new instance boots.
+
+        As well as registering the instance with the cluster, the script
+        pulls the hot images for the profile. On the ECS-optimized AMI,
+        the ECS agent doesn't start until this script has finished, so the
+        images are cached before the instance takes any work; the agent is
+        told to use the cached images, rather than pulling them again.
+        """
+        lines = [
+            "#!/bin/bash",
+            "echo ECS_CLUSTER=%s >> /etc/ecs/ecs.config" % cluster_name,
+        ]
+        if self.hot_images:
+            lines.append("echo ECS_IMAGE_PULL_BEHAVIOR=prefer-cached >> /etc/ecs/ecs.config")
+            lines.extend(
+                "docker pull %s" % image['uri']
+                for image in self.hot_images
+            )
+        return '\n'.join(lines) + '\n'
+
+    def start_instance(self, key_name, security_groups, subnet, cluster_name, aws_session=None, ec2_client=None, ecs_client=None, cluster=None, waiting=1):
+        """Start a new instance for this profile.
+
+        waiting: The number of tasks waiting for the instance; used to
+            choose the cheapest type of instance to run them.
+        """
+        if ec2_client is None or ecs_client is None:
             if aws_session is None:
                 aws_session = boto3.session.Session(
-                    region_name=settings.AWS_REGION,
+                    region_name=cluster.region_name if cluster else settings.AWS_REGION,
                     aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
                     aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
                 )
 
-            ec2_client = aws_session.client('ec2')
+            if ec2_client is None:
+                ec2_client = aws_session.client('ec2')
+            if ecs_client is None:
+                ecs_client = aws_session.client('ecs')
 
-        if self.max_instances is None or self.instances.active().count() < self.max_instances:
+        ec2_type = self.choose_instance_type(waiting) if self.uses_instances else None
+        if not self.uses_instances:
+            log.info("%s tasks run on Fargate; not starting an instance." % self)
+            instance = None
+        elif ec2_type is None:
+            log.error("None of the instance types allowed for %s can run its tasks." % self)
+            instance = None
+        elif self.max_instances is None or self.instances.active().count() < self.max_instances:
+            if self.hot_image_count:
+                self.update_hot_images(ecs_client)
+
+            log.info("Using %s instance for %s waiting %s tasks ($%s/hour)." % (
+                ec2_type['name'], waiting, self, ec2_type['price']
+            ))
             instance_data = {
-                'ImageId': self.ami,
-                'InstanceType': self.instance_type,
+                'ImageId': cluster.ami if cluster and cluster.ami else self.ami,
+                'InstanceType': ec2_type['name'],
                 'KeyName': key_name,
                 'SecurityGroupIds': security_groups,
                 'SubnetId': subnet,
                 'IamInstanceProfile': {
                     "Name": "ecsInstanceRole"
                 },
-                'UserData': "#!/bin/bash \n echo ECS_CLUSTER=%s >> /etc/ecs/ecs.config" % cluster_name
+                'UserData': self.user_data(cluster_name),
             }
 
             if self.spot:
@@ -465,14 +1193,17 @@ class Profile(models.Model):
                 ).decode('utf-8')
                 response = ec2_client.request_spot_instances(
                     InstanceCount=1,
-                    SpotPrice=Profile.INSTANCE_TYPE_PRICES[instance_data["InstanceType"]],
+                    SpotPrice=str(ec2_type['price']),
                     LaunchSpecification=instance_data
                 )
                 try:
                     log.info('Spot instance %s created.' % response['SpotInstanceRequests'][0]['InstanceId'])
                     instance = Instance.objects.create(
                         profile=self,
-                        ec2_id=response['SpotInstanceRequests'][0]['InstanceId']
+                        ec2_id=response['SpotInstanceRequests'][0]['InstanceId'],
+                        cluster=cluster.saved if cluster else None,
+                        instance_type=ec2_type['name'],
+                        price=ec2_type['price'],
                     )
                 except KeyError:
                     # No instance ID yet - but there has been an instance request.
@@ -490,7 +1221,10 @@ class Profile(models.Model):
                 # Create a database record of the instance.
                 instance = Instance.objects.create(
                     profile=self,
-                    ec2_id=response['Instances'][0]['InstanceId']
+                    ec2_id=response['Instances'][0]['InstanceId'],
+                    cluster=cluster.saved if cluster else None,
+                    instance_type=ec2_type['name'],
+                    price=ec2_type['price'],
                 )
         else:
             instance = None
@@ -498,6 +1232,69 @@ class Profile(models.Model):
         return instance
 
 
+class Cluster(models.Model):
+    """An ECS cluster, possibly in another region, that can run the tasks
+    of a profile.
+
+    Settings that are left blank use the values for the default cluster.
+    """
+    profile = models.ForeignKey(Profile, related_name='clusters')
+    name = models.CharField(max_length=100)
+    region = models.CharField(max_length=50, blank=True)
+    weight = models.PositiveIntegerField(default=1)
+
+    subnet = models.CharField(max_length=100, blank=True)
+    security_groups = models.CharField(max_length=200, blank=True)
+    ami = models.CharField('AMI', max_length=100, blank=True)
+
+    throttled_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('profile', '-weight', 'name')
+        unique_together = [('profile', 'region', 'name')]
+
+    def __str__(self):
+        return 'cluster %s (%s)' % (self.name, self.region_name)
+
+    @staticmethod
+    def default():
+        "The cluster defined by the AWS settings."
+        return Cluster(name=settings.AWS_ECS_CLUSTER_NAME)
+
+    @property
+    def saved(self):
+        "The cluster to record on a task or instance; None for the default."
+        return self if self.pk else None
+
+    @property
+    def region_name(self):
+        return self.region or settings.AWS_REGION
+
+    @property
+    def subnet_id(self):
+        return self.subnet or settings.AWS_ECS_SUBNET_ID
+
+    @property
+    def security_group_ids(self):
+        return (self.security_groups or settings.AWS_ECS_SECURITY_GROUP_IDS).split(':')
+
+    def client(self, service, default=None):
+        """Return a client for an AWS service in the region of this cluster.
+
+        default: A client for the default region, to be used if this
+            cluster is in the default region.
+        """
+        if default is not None and self.region_name == settings.AWS_REGION:
+            return default
+        return aws_client(service, self.region_name)
+
+    def throttle(self):
+        "Record that requests to this cluster are being throttled."
+        if self.pk:
+            self.throttled_until = timezone.now() + THROTTLE_PERIOD
+            Cluster.objects.filter(pk=self.pk).update(throttled_until=self.throttled_until)
+
+
 class InstanceQuerySet(models.QuerySet):
     def active(self):
         return self.filter(active=True)
@@ -507,9 +1304,16 @@ class Instance(models.Model):
     objects = InstanceQuerySet.as_manager()
 
     profile = models.ForeignKey(Profile, related_name='instances')
+    cluster = models.ForeignKey(
+        Cluster, null=True, blank=True, related_name='instances', on_delete=models.SET_NULL
+    )
     container_arn = models.CharField(max_length=100, null=True, blank=True, db_index=True)
     ec2_id = models.CharField(max_length=100, db_index=True)
 
+    # The type of the instance, and its hourly price (in US dollars).
+    instance_type = models.CharField(max_length=20, blank=True)
+    price = models.FloatField(null=True, blank=True)
+
     tasks = models.ManyToManyField(Task, related_name='instances', blank=True)
 
     created = models.DateTimeField(default=timezone.now)
@@ -522,16 +1326,15 @@ class Instance(models.Model):
     def __str__(self):
         return 'Container %s (EC2 ID %s)' % (self.container_arn, self.ec2_id)
 
-    def terminate(self, aws_session=None, ec2_client=None):
-        if ec2_client is None:
-            if aws_session is None:
-                aws_session = boto3.session.Session(
-                    region_name=settings.AWS_REGION,
-                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                )
+    @property
+    def ecs_cluster(self):
+        return self.cluster or Cluster.default()
 
+    def terminate(self, aws_session=None, ec2_client=None):
+        if ec2_client is None and aws_session is not None:
             ec2_client = aws_session.client('ec2')
+        # The instance must be terminated in its own region.
+        ec2_client = self.ecs_cluster.client('ec2', default=ec2_client)
 
         # Save the new state of the instance.
         self.active = False
@@ -1,10 +1,12 @@
 from django.conf.urls import url
-from django.contrib import admin
 
+from projects import views as projects
 from aws import views as aws
 
 
 urlpatterns = [
-    url(r'^(?P<task_slug>[-\w\._:]+)$', aws.task, name='task'),
-    url(r'^(?P<task_slug>[-\w\._:]+)/status$', aws.task_status, name='task-status'),
+    url(r'^(?P<task_slug>[-\w\._:]+)$', projects.task, name='task'),
+    url(r'^(?P<task_slug>[-\w\._:]+)/status$', projects.task_status, name='task-status'),
+    url(r'^(?P<task_slug>[-\w\._:]+)/log$', aws.task_log, name='task-log'),
+    url(r'^(?P<task_slug>[-\w\._:]+)/events$', projects.task_events, name='task-events'),
 ]
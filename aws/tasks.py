@@ -1,22 +1,26 @@
+import hashlib
 import logging
+import tempfile
 from datetime import timedelta
 
 import boto3
-
-from github3 import GitHub
-
-import yaml
+from botocore.exceptions import ClientError
 
 from config.celery import app
 
 from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q, Sum
 from django.utils import timezone
 
 from django.utils.timesince import timesince
 
-from projects.models import Change, Build
-from aws.models import Task
-from beekeeper.config import load_task_configs
+from projects.models import Build
+from projects.phases import BuildChecker, github_repository, on_check_build_failure
+from aws.logs import log_events, write_archive
+from aws.models import Task, TaskDuration, Instance, LogChunk
 
 
 log = logging.getLogger('aws')
@@ -29,90 +33,252 @@ ghlog.setLevel(logging.WARNING)
 urllib3log = logging.getLogger('requests.packages.urllib3')
 urllib3log.setLevel(logging.WARNING)
 
+# The number of log lines in each searchable log chunk
+SEARCH_CHUNK_LINES = 50
 
-def create_tasks(gh_repo, build):
-    # Download the config file from Github.
-    content = gh_repo.contents('beekeeper.yml', ref=build.commit.sha)
-    if content is None:
-        raise ValueError("Repository doesn't contain BeeKeeper config file.")
-
-    # Parse the raw configuration content and extract the appropriate phase.
-    config = yaml.load(content.decoded.decode('utf-8'))
-    if build.change.change_type == Change.CHANGE_TYPE_PULL_REQUEST:
-        phases = config.get('pull_request', [])
-    elif build.change.change_type == Change.CHANGE_TYPE_PUSH:
-        phases = config.get('push', [])
-
-    # Parse the phase configuration and create tasks
-    for task_config in load_task_configs(phases):
-        log.debug("Created phase %(phase)s task %(name)s" % task_config)
-        task = Task.objects.create(
-            build=build,
-            **task_config
-        )
-        task.report(gh_repo)
-
-
-def on_check_build_failure(self, exc, task_id, args, kwargs, einfo):
-    build = Build.objects.get(pk=args[0])
-    log.error("Error checking build %s: %s" % (build, str(exc)))
-    build.status = Build.STATUS_ERROR
-    build.error = str(exc)
-    build.save()
+# ECS stop codes that mean the instance running a task was taken away.
+HOST_LOSS_STOP_CODES = {'SpotInterruption', 'TerminationNotice'}
 
+# Container errors that mean a task couldn't be run, through no fault
+# of the code being tested.
+INFRASTRUCTURE_ERRORS = (
+    'CannotPullContainerError',
+    'CannotCreateContainerError',
+    'CannotStartContainerError',
+    'CannotInspectContainerError',
+    'DockerTimeoutError',
+)
 
-@app.task(
-    bind=True,
-    on_failure=on_check_build_failure
+# A failure to pull an image is only worth retrying if the registry was
+# slow or busy; an image that doesn't exist won't exist on the next try.
+TRANSIENT_PULL_ERRORS = (
+    'timeout',
+    'timed out',
+    'deadline exceeded',
+    'toomanyrequests',
+    'too many requests',
+    'rate exceeded',
+    'throttl',
+    'connection reset',
+    'service unavailable',
 )
-def check_build(self, build_pk):
-    build = Build.objects.get(pk=build_pk)
 
-    aws_session = boto3.session.Session(
-        region_name=settings.AWS_REGION,
-        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+
+def host_lost(task_response):
+    "Was a task stopped because the instance running it went away?"
+    return (
+        task_response.get('stopCode') in HOST_LOSS_STOP_CODES
+        or task_response.get('stoppedReason', '').startswith('Host EC2')
     )
-    ecs_client = aws_session.client('ecs')
-    ec2_client = aws_session.client('ec2')
 
-    gh_session = GitHub(
-            settings.GITHUB_USERNAME,
-            password=settings.GITHUB_ACCESS_TOKEN
-        )
-    gh_repo = gh_session.repository(
-            build.change.project.repository.owner.login,
-            build.change.project.repository.name
+
+def infrastructure_failure(task_response):
+    """Determine if a task stopped because of an infrastructure problem.
+
+    Returns a description of the problem, or None if the task didn't
+    stop, or stopped because of the code it was running.
+    """
+    if task_response['lastStatus'] == 'FAILED':
+        return "AWS task failure."
+    elif task_response['lastStatus'] != 'STOPPED':
+        return None
+
+    if host_lost(task_response) or task_response.get('stopCode') == 'TaskFailedToStart':
+        return task_response.get('stoppedReason') or task_response['stopCode']
+
+    for container in task_response['containers']:
+        reason = container.get('reason', '')
+        if reason.startswith('CannotPullContainerError'):
+            if any(error in reason.lower() for error in TRANSIENT_PULL_ERRORS):
+                return reason
+        elif reason.startswith(INFRASTRUCTURE_ERRORS):
+            return reason
+
+    return None
+
+
+def cache_key(gh_repo, build, image, files, blobs):
+    """Compute the dependency cache key for a task.
+
+    The key is a digest of the task image, plus the content of the files
+    that the task declares as defining its dependencies. Github provides
+    the blob SHA of each file, so file content doesn't need to be
+    retrieved.
+
+    blobs: a cache of the blob SHAs of files that have already been
+        retrieved for this build.
+    """
+    digest = hashlib.sha256(image.encode('utf-8'))
+    for path in sorted(files):
+        if path not in blobs:
+            content = gh_repo.contents(path, ref=build.commit.sha)
+            blobs[path] = content.sha if content else ''
+        digest.update(('\n%s:%s' % (path, blobs[path])).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def describe_tasks(tasks, ecs_client):
+    """Retrieve the ECS description of a list of tasks.
+
+    The tasks may have been run on different clusters, in different
+    regions; ecs_client is used for tasks in the default region.
+    """
+    clusters = {}
+    for task in tasks:
+        clusters.setdefault(task.cluster_id, []).append(task)
+
+    task_responses = []
+    for cluster_tasks in clusters.values():
+        cluster = cluster_tasks[0].ecs_cluster
+        response = cluster.client('ecs', default=ecs_client).describe_tasks(
+            cluster=cluster.name,
+            tasks=[task.arn for task in cluster_tasks]
         )
+        task_responses.extend(response['tasks'])
+    return task_responses
+
+
+def speculative_tasks(build):
+    """Find the tasks in the next phase that can be started early.
+
+    A speculative task can be started while the current phase is still
+    running, as long as nothing in the current phase has failed, and
+    either all the critical tasks in the phase have passed, or enough
+    of the phase has passed.
+    """
+    running_phase = min(build.tasks.not_finished().values_list('phase', flat=True))
+    candidates = build.tasks.created().filter(
+        phase=running_phase + 1,
+        speculate_after__isnull=False
+    ).by_expected_duration()
+    if not candidates:
+        return []
+
+    current_tasks = build.tasks.filter(phase=running_phase)
+    if current_tasks.failed().exists() or current_tasks.error().exists():
+        return []
+
+    total = current_tasks.count()
+    passed = current_tasks.filter(result__in=[Build.RESULT_PASS, Build.RESULT_NON_CRITICAL_FAIL]).count()
+    critical_passed = not current_tasks.filter(is_critical=True).exclude(result=Build.RESULT_PASS).exists()
+
+    return [
+        task
+        for task in candidates
+        if critical_passed or passed >= task.speculate_after * total
+    ]
+
+
+def unblocked_tasks(build):
+    """Find the tasks that haven't started, but whose phase is now running.
+
+    When some tasks of a phase were started speculatively, the phase can
+    be running before the phase before it has finished. Once every earlier
+    phase has finished without failures, the rest of the phase is started,
+    without waiting for the speculative tasks to finish.
+    """
+    running_phase = min(build.tasks.not_finished().values_list('phase', flat=True))
+    earlier_tasks = build.tasks.filter(phase__lt=running_phase)
+    if earlier_tasks.created().exists() or earlier_tasks.failed().exists() or earlier_tasks.error().exists():
+        return []
+
+    return list(build.tasks.created().filter(phase=running_phase).by_expected_duration())
+
+
+def cancel_speculative_tasks(build, ecs_client):
+    "Stop any speculative tasks that follow a phase that has failed."
+    failed_phase = min(
+        build.tasks.filter(
+            Q(result=Build.RESULT_FAIL) | Q(status=Task.STATUS_ERROR)
+        ).values_list('phase', flat=True),
+        default=None
+    )
+    if failed_phase is None:
+        return
 
-    if build.status == Build.STATUS_CREATED:
-        log.info("Build %s: Starting..." % build)
-        # Record that the build has started.
-        build.status = Build.STATUS_RUNNING
-        build.save()
-
-        # Retrieve task definition
-        log.debug("Build %s: Creating task definitions..." % build)
-        create_tasks(gh_repo, build)
-
-        # Start the tasks with no prerequisites
-        log.debug("Build %s: Starting initial tasks..." % build)
-        initial_tasks = build.tasks.filter(status=Build.STATUS_CREATED, phase=0)
-        if initial_tasks:
-            for task in initial_tasks:
-                log.info("Build %s: Starting task %s..." % (build, task.name))
-                task.start(ecs_client, ec2_client)
+    for task in build.tasks.not_finished().filter(is_speculative=True, phase__gt=failed_phase):
+        log.info("Build %s: Phase %s failed; cancelling speculative task %s..." % (
+            build, failed_phase, task
+        ))
+        if task.arn:
+            task.stop(ecs_client=ecs_client)
+        # Don't wait for ECS to confirm the task has stopped; the result
+        # of the task isn't needed.
+        task.status = Task.STATUS_STOPPED
+        task.save()
+
+
+class AWSBuildChecker(BuildChecker):
+    """Check the progress of builds whose tasks are run on ECS.
+
+    Tasks are started in order of how long they are expected to take,
+    and the tasks of the next phase can be started speculatively.
+    """
+    log = log
+
+    def __init__(self, build, gh_repo, ecs_client, ec2_client):
+        super().__init__(build, gh_repo)
+        self.ecs_client = ecs_client
+        self.ec2_client = ec2_client
+
+        # The blob SHAs of the files that define dependency caches.
+        self.blobs = {}
+
+    def create_task(self, task_config):
+        build = self.build
+        files = task_config.pop('cache')
+        if files:
+            task_config['cache_key'] = cache_key(self.gh_repo, build, task_config['image'], files, self.blobs)
+
+        shards = task_config.pop('shards')
+        target = task_config.pop('shard_target')
+        if shards == 'auto':
+            shards = TaskDuration.shard_count(
+                build.change.project,
+                task_config['slug'],
+                timedelta(seconds=target) if target else None
+            )
+
+        if shards > 1:
+            # Split the task into shards; the shards are reported to
+            # Github as a single task.
+            log.debug("Splitting phase %s task %s into %s shards" % (
+                task_config['phase'], task_config['name'], shards
+            ))
+            for index in range(shards):
+                task = Task.objects.create(
+                    build=build,
+                    **dict(
+                        task_config,
+                        name='%s (%s/%s)' % (task_config['name'], index + 1, shards),
+                        slug='%s.%s' % (task_config['slug'], index),
+                        shard_index=index,
+                        shard_total=shards,
+                    )
+                )
+            task.report(self.gh_repo)
         else:
-            raise ValueError("No phase 0 tasks defined for build type '%s'" % build.change.change_type)
+            log.debug("Created phase %(phase)s task %(name)s" % task_config)
+            task = Task.objects.create(
+                build=build,
+                **task_config
+            )
+            task.report(self.gh_repo)
+
+    def order(self, tasks):
+        return tasks.by_expected_duration()
+
+    def start_task(self, task):
+        task.start(self.ecs_client, self.ec2_client)
 
-    elif build.status == Build.STATUS_RUNNING:
-        log.info("Build %s: Checking status of build..." % build)
+    def update_tasks(self):
+        build = self.build
         # Update the status of all currently running tasks
-        started_tasks = build.tasks.started()
+        started_tasks = build.tasks.started().by_expected_duration()
         if started_tasks:
             log.debug("Build %s: There are %s active tasks." % (build, started_tasks.count()))
             # Only check the *running* tasks - the ones where we have an ARN
-            running_arns = [task.arn for task in started_tasks if task.arn]
+            running_tasks = [task for task in started_tasks if task.arn]
             waiting_tasks = [task for task in started_tasks if task.arn is None]
 
             if waiting_tasks:
@@ -120,15 +286,10 @@ def check_build(self, build_pk):
                     log.debug('Build %s, Task %s: waiting for %s. Trying to start again...' % (
                         build, task, timesince(task.queued)
                     ))
-                    task.start(ecs_client, ec2_client)
-
-            if running_arns:
-                response = ecs_client.describe_tasks(
-                     cluster=settings.AWS_ECS_CLUSTER_NAME,
-                     tasks=running_arns
-                )
+                    task.start(self.ecs_client, self.ec2_client)
 
-                for task_response in response['tasks']:
+            if running_tasks:
+                for task_response in describe_tasks(running_tasks, self.ecs_client):
                     log.debug('Build %s, Task %s: %s' % (
                         build,
                         task_response['taskArn'],
@@ -137,8 +298,23 @@ def check_build(self, build_pk):
                     log.debug('Build %s: Full response %s' % (build, task_response))
 
                     task = build.tasks.get(arn=task_response['taskArn'])
+
+                    # Record how long it took to pull the task image.
+                    if task.pull_duration is None and 'pullStoppedAt' in task_response:
+                        task.pull_duration = task_response['pullStoppedAt'] - task_response['pullStartedAt']
+
+                    lost = infrastructure_failure(task_response)
                     if task_response['lastStatus'] == 'RUNNING':
                         task.status = Task.STATUS_RUNNING
+                    elif lost and len(task.retries) < task.profile.max_retries:
+                        # The task was lost through no fault of its own;
+                        # queue it to be started again.
+                        log.info("Build %s: Task %s was lost (%s); retrying..." % (build, task, lost))
+                        if host_lost(task_response) and task_response.get('containerInstanceArn'):
+                            Instance.objects.filter(
+                                container_arn=task_response.get('containerInstanceArn')
+                            ).update(active=False)
+                        task.requeue(lost)
                     elif task_response['lastStatus'] == 'STOPPED':
                         if all('exitCode' in container for container in task_response['containers']):
                             task.status = Task.STATUS_DONE
@@ -158,7 +334,7 @@ def check_build(self, build_pk):
                                 task.result = Build.RESULT_PASS
 
                             # Report the status to Github.
-                            task.report(gh_repo)
+                            task.report(self.gh_repo)
 
                             # Record the completion time.
                             task.completed = timezone.now()
@@ -178,73 +354,38 @@ def check_build(self, build_pk):
                         raise ValueError('Unknown task status %s' % task_response['lastStatus'])
                     task.save()
 
-        # If there are still tasks running, wait for them to finish.
-        unfinished_tasks = build.tasks.not_finished()
-        if unfinished_tasks.exists():
-            running_phase = max(unfinished_tasks.values_list('phase', flat=True))
-            log.info("Build %s: Still waiting for %s tasks in phase %s to complete." % (
-                build, len(unfinished_tasks), running_phase)
-            )
-        else:
-            # There are no unfinished tasks.
-            # If there have been any failures or task errors, stop right now.
-            # Otherwise, queue up tasks for the next phase.
-            finished_tasks = build.tasks.finished()
-            finished_phase = max(finished_tasks.values_list('phase', flat=True))
-
-            if finished_tasks.error().exists():
-                log.info("Build %s: Errors encountered during phase %s" % (build, finished_phase))
-                new_tasks = None
-                build.status = Build.STATUS_ERROR
-                build.result = Build.RESULT_FAIL
-                build.error = "%s tasks generated errors" % build.tasks.error().count()
-            elif finished_tasks.failed().exists():
-                log.info("Build %s: Failures encountered during phase %s" % (build, finished_phase))
-                new_tasks = None
-                build.status = Build.STATUS_DONE
-                build.result = Build.RESULT_FAIL
-            else:
-                new_tasks = build.tasks.filter(
-                                status=Task.STATUS_CREATED,
-                                phase=finished_phase + 1
-                            )
-
-            if new_tasks:
-                log.debug("Build %s: Starting new tasks..." % build)
-                for task in new_tasks:
-                    log.info("Build %s: Starting task %s..." % (build, task.name))
-                    task.start(ecs_client, ec2_client)
-            elif new_tasks is None:
-                log.info("Build %s: Aborted." % build)
-                build.save()
-            else:
-                log.info("Build %s: No new tasks required." % build)
-                build.status = Build.STATUS_DONE
-                build.result = min(
-                    t.result
-                    for t in build.tasks.all()
-                    if t.result != Build.RESULT_PENDING
-                )
-
-                build.save()
-                log.info("Build %s: Status %s" % (build, build.get_status_display()))
-                log.info("Build %s: Result %s" % (build, build.get_result_display()))
-
-    elif build.status == Build.STATUS_STOPPING:
-        log.info("Build %s: Stopping..." % build)
+                    # Keep track of how long the task usually takes. A task
+                    # that shared another task's run isn't counted twice.
+                    if task.status == Task.STATUS_DONE and not task.primary_id:
+                        with transaction.atomic():
+                            TaskDuration.record(task)
+
+    def phase_running(self):
+        build = self.build
+        # If a phase has failed, the speculative tasks that followed it
+        # aren't needed. Otherwise, start the rest of a phase that was
+        # started speculatively, once the phase before it has finished,
+        # and use any spare capacity to start the tasks in the next
+        # phase that can be started early.
+        cancel_speculative_tasks(build, self.ecs_client)
+        for task in unblocked_tasks(build):
+            log.info("Build %s: Starting task %s..." % (build, task.name))
+            self.start_task(task)
+        for task in speculative_tasks(build):
+            log.info("Build %s: Speculatively starting task %s..." % (build, task.name))
+            task.is_speculative = True
+            task.start(self.ecs_client, self.ec2_client, spawn=False)
+
+    def stop_tasks(self):
+        build = self.build
         running_tasks = build.tasks.running()
         stopping_tasks = build.tasks.stopping()
         if running_tasks:
             log.info("Build %s: There are %s active tasks." % (build, running_tasks.count()))
             for task in running_tasks:
-                task.stop(ecs_client=ecs_client)
+                task.stop(ecs_client=self.ecs_client)
         elif stopping_tasks:
-            response = ecs_client.describe_tasks(
-                 cluster=settings.AWS_ECS_CLUSTER_NAME,
-                 tasks=[task.arn for task in stopping_tasks]
-            )
-
-            for task_response in response['tasks']:
+            for task_response in describe_tasks(stopping_tasks, self.ecs_client):
                 log.debug('Task %s: %s' % (
                     task_response['taskArn'],
                     task_response['lastStatus'])
@@ -262,11 +403,35 @@ def check_build(self, build_pk):
                     ))
                 task.save()
         else:
-            log.info("Build %s: There are no tasks running; Build has been stopped." % build)
-            build.status = Build.STATUS_STOPPED
-            build.save()
+            return True
+        return False
 
-    if build.status not in (Build.STATUS_DONE, Build.STATUS_ERROR, Build.STATUS_STOPPED):
+    def build_finished(self):
+        build = self.build
+        # Record what it cost to run the tasks of the build.
+        if build.cost is None:
+            build.cost = build.tasks.aggregate(cost=Sum('cost'))['cost']
+            Build.objects.filter(pk=build.pk).update(cost=build.cost)
+            log.info("Build %s: Cost $%s" % (build, build.cost))
+
+
+@app.task(
+    bind=True,
+    on_failure=on_check_build_failure
+)
+def check_build(self, build_pk):
+    build = Build.objects.get(pk=build_pk)
+
+    aws_session = boto3.session.Session(
+        region_name=settings.AWS_REGION,
+        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+    )
+    ecs_client = aws_session.client('ecs')
+    ec2_client = aws_session.client('ec2')
+
+    checker = AWSBuildChecker(build, github_repository(build), ecs_client, ec2_client)
+    if checker.check():
         log.debug("Build %s: Schedule another check..." % build)
         check_build.apply_async((build_pk,), countdown=5)
 
@@ -292,6 +457,10 @@ def sweeper(self, task_pk):
         log.info("Task %s appears to have been purged; nothing to sweep." % task_pk)
         return
 
+    if not task.profile.uses_instances:
+        log.info("%s:%s didn't run on an instance; nothing to sweep." % (task.build, task))
+        return
+
     log.info("Sweeping %s:%s..." % (task.build, task))
 
     aws_session = boto3.session.Session(
@@ -383,3 +552,63 @@ def reaper(self, task_pk):
                 task.build, task
             ))
 
+
+def index_log(task, lines):
+    """Yield the lines of a task log, indexing them for search on the way.
+
+    Any existing search index for the task is replaced.
+    """
+    task.log_chunks.all().delete()
+
+    chunks = []
+    chunk = []
+    for number, line in enumerate(lines):
+        chunk.append(line)
+        yield line
+
+        if len(chunk) == SEARCH_CHUNK_LINES:
+            chunks.append(LogChunk(task=task, line=number + 1 - len(chunk), content='\n'.join(chunk)))
+            chunk = []
+
+            if len(chunks) == 100:
+                LogChunk.objects.bulk_create(chunks)
+                chunks = []
+
+    if chunk:
+        chunks.append(LogChunk(task=task, line=number + 1 - len(chunk), content='\n'.join(chunk)))
+    LogChunk.objects.bulk_create(chunks)
+
+
+@app.task(bind=True)
+def archive_log(self, task_pk):
+    try:
+        task = Task.objects.get(pk=task_pk)
+    except Task.DoesNotExist:
+        log.info("Task %s appears to have been purged; nothing to archive." % task_pk)
+        return
+
+    if task.log_archive:
+        log.info("Log for %s:%s has already been archived." % (task.build, task))
+        return
+
+    log.info("Archiving log for %s:%s..." % (task.build, task))
+    try:
+        with transaction.atomic(), tempfile.TemporaryFile() as archive:
+            index = write_archive(
+                index_log(task, log_events(task.log_stream_name, region_name=task.region_name)),
+                archive
+            )
+            archive.seek(0)
+            name = default_storage.save(task.log_archive_name, File(archive))
+    except ClientError as e:
+        log.info("Unable to retrieve log for %s:%s: [%s] %s" % (
+            task.build, task, e.response['Error']['Code'], e.response['Error']['Message'],
+        ))
+        return
+
+    # Use an update, rather than a save, so that the update timestamp
+    # on the task (which is used by the sweeper) isn't modified.
+    Task.objects.filter(pk=task.pk).update(log_archive=name, log_index=index)
+    log.info("Log for %s:%s archived as %s (%s lines)." % (
+        task.build, task, name, index['lines']
+    ))
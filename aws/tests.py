@@ -1,3 +1,1214 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+import boto3
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+
+from django.apps import apps
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from projects import views as project_views
+from projects.models import Build
+from projects.tests.utils import create_build
+
+# The models of a build app can only be loaded when it is the app in use;
+# CI runs the tests once for each build app (see .travis.yml).
+if not apps.is_installed('aws'):
+    raise unittest.SkipTest("BEEKEEPER_BUILD_APP isn't aws.")
+
+from . import logs
+from .logs import ArchivedLog, LogTail, write_archive
+from . import models
+from .models import Task, TaskDuration, Profile, Cluster, Instance, LogChunk
+from .tasks import (
+    SEARCH_CHUNK_LINES, describe_tasks, index_log, infrastructure_failure, speculative_tasks, unblocked_tasks,
+)
+
+
+class ArchivedLogTests(SimpleTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(location=self.media_root)
+
+        self.lines = [
+            'Line %s of the log: %s' % (i, '✓' * (i % 7))
+            for i in range(5432)
+        ]
+        self.content = ''.join(line + '\n' for line in self.lines).encode('utf-8')
+
+        with tempfile.TemporaryFile() as archive:
+            self.index = write_archive(iter(self.lines), archive)
+            archive.seek(0)
+            self.name = self.storage.save('logs/test.log.gz', archive)
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def test_index(self):
+        self.assertEqual(self.index['length'], len(self.content))
+        self.assertEqual(self.index['lines'], len(self.lines))
+        # 5432 lines in blocks of (at most) 1000 lines
+        self.assertEqual(len(self.index['blocks']), 6)
+        self.assertEqual(self.index['blocks'][0], [0, 0, 0, self.index['blocks'][0][3]])
+        self.assertEqual(self.index['blocks'][1][1], 1000)
+
+    def test_read_all(self):
+        archive = ArchivedLog(self.name, self.index, storage=self.storage)
+
+        data = io.BytesIO()
+        offset = 0
+        while offset < archive.length:
+            chunk, offset = archive.read(offset)
+            data.write(chunk)
+
+        self.assertEqual(data.getvalue(), self.content)
+
+    def test_read_from_offset(self):
+        archive = ArchivedLog(self.name, self.index, storage=self.storage)
+
+        # Start part way through the second block.
+        offset = self.index['blocks'][1][0] + 17
+        chunk, next_offset = archive.read(offset)
+
+        self.assertEqual(chunk, self.content[offset:next_offset])
+
+    def test_read_past_end(self):
+        archive = ArchivedLog(self.name, self.index, storage=self.storage)
+
+        self.assertEqual(archive.read(archive.length), (b'', archive.length))
+
+    def test_stream(self):
+        archive = ArchivedLog(self.name, self.index, storage=self.storage)
+
+        self.assertEqual(b''.join(archive.stream(blocks_per_read=4)), self.content)
+
+    def test_empty_log(self):
+        with tempfile.TemporaryFile() as archive:
+            index = write_archive(iter([]), archive)
+
+        self.assertEqual(index, {'length': 0, 'lines': 0, 'blocks': []})
+        self.assertEqual(b''.join(ArchivedLog('empty', index).stream()), b'')
+
+
+
+class FakeLogsClient:
+    "A CloudWatch Logs client for a single stream, which tests can add messages to."
+    def __init__(self, page_size=3):
+        self.messages = []
+        self.page_size = page_size
+        self.requests = 0
+        self.on_request = None
+
+    def get_log_events(self, logGroupName, logStreamName, startFromHead, nextToken=None):
+        self.requests += 1
+        if self.on_request:
+            self.on_request()
+
+        position = int(nextToken) if nextToken else 0
+        messages = self.messages[position:position + self.page_size]
+        return {
+            'events': [{'message': message} for message in messages],
+            'nextForwardToken': str(position + len(messages)),
+        }
+
+
+class Clock:
+    "A replacement for time.time(), for the log tail and the cache."
+    def __init__(self):
+        self.now = 1500000000.0
+
+    def __call__(self):
+        return self.now
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'log-tail-tests',
+    }
+})
+class LogTailTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.clock = Clock()
+        patcher = mock.patch('time.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.client = FakeLogsClient()
+        patcher = mock.patch.object(logs, 'aws_client', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.client.messages = ['Line %s' % i for i in range(8)]
+        self.content = ''.join('Line %s\n' % i for i in range(8)).encode('utf-8')
+        self.tail = LogTail('task/1')
+
+    def poll(self, offset=0):
+        "Poll the tail as a viewer would, a second after the last poll."
+        self.clock.now += logs.POLL_INTERVAL
+        self.tail.refresh()
+        return self.tail.read(offset)
+
+    def watch(self, offset=0, polls=10):
+        "Poll the tail a number of times, returning everything that was read."
+        content = b''
+        for i in range(polls):
+            data, offset = self.poll(offset)
+            content += data
+        return content, offset
+
+    def test_read(self):
+        # 8 lines are fetched 3 at a time.
+        content, offset = self.watch(polls=3)
+        self.assertEqual(content, self.content)
+        self.assertEqual(offset, len(self.content))
+        self.assertEqual(self.client.requests, 3)
+
+        self.assertEqual(self.tail.read(21), (self.content[21:], len(self.content)))
+        self.assertEqual(self.tail.read(len(self.content)), (b'', len(self.content)))
+
+    def test_max_read_size(self):
+        self.watch(polls=3)
+        with mock.patch.object(logs, 'MAX_READ_SIZE', 10):
+            # Reads return whole chunks.
+            self.assertEqual(self.tail.read(0), (self.content[:21], 21))
+            self.assertEqual(self.tail.read(25), (self.content[25:42], 42))
+
+    def test_poll_interval(self):
+        self.poll()
+        self.tail.refresh()
+        self.assertEqual(self.client.requests, 1)
+
+    def test_is_complete(self):
+        since = datetime.fromtimestamp(self.clock.now, timezone.utc)
+        content, offset = self.watch(polls=3)
+        # Every line has been read, but CloudWatch hasn't yet reported
+        # that there is nothing more.
+        self.assertFalse(self.tail.is_complete(offset, since=since))
+
+        self.poll(offset)
+        self.assertTrue(self.tail.is_complete(offset, since=since))
+        self.assertFalse(self.tail.is_complete(0, since=since))
+        self.assertFalse(self.tail.is_complete(
+            offset,
+            since=datetime.fromtimestamp(self.clock.now + 1, timezone.utc)
+        ))
+
+    def test_expiry(self):
+        self.client.messages = self.client.messages[:5]
+        first, offset = self.watch(polls=1)
+
+        # The stream keeps growing, and is watched for an hour; the start
+        # of the log expires with the rest of the cached copy, rather than
+        # while the metadata describing it is still in use.
+        self.clock.now += 3000
+        self.client.messages = ['Line %s' % i for i in range(8)]
+        second, offset = self.watch(offset, polls=1)
+        self.clock.now += 600
+        self.assertIsNone(cache.get(self.tail.key))
+
+        # The stream is reloaded; the viewer carries on from its offset.
+        self.assertEqual(self.poll(offset), (b'', offset))
+        third, offset = self.watch(offset)
+        self.assertEqual(first + second + third, self.content)
+
+    def test_evicted(self):
+        self.watch(polls=3)
+        cache.delete(self.tail.chunk_key(self.tail.meta, 1))
+
+        self.assertEqual(self.tail.read(25), (b'', 25))
+        self.assertIsNone(cache.get(self.tail.key))
+
+        content, offset = self.watch(25)
+        self.assertEqual(content, self.content[25:])
+
+    def test_concurrent_refresh(self):
+        # While one viewer is fetching, other viewers don't fetch.
+        self.client.on_request = LogTail('task/1').refresh
+        self.poll()
+        self.assertEqual(self.client.requests, 1)
+
+    def test_lock_expired(self):
+        def take_over():
+            # The first fetch is so slow that its lock expires, and
+            # another viewer fetches the same events, and more.
+            self.client.on_request = None
+            cache.delete('%s:lock' % self.tail.key)
+            other = LogTail('task/1')
+            other.refresh()
+            self.clock.now += logs.POLL_INTERVAL
+            other.refresh()
+
+        self.client.on_request = take_over
+        self.poll()
+        self.assertEqual(self.client.requests, 3)
+
+        # The slow fetch doesn't undo the other viewer's progress.
+        self.assertEqual(self.tail.meta['length'], 42)
+        content, offset = self.watch()
+        self.assertEqual(content, self.content)
+
+
+class TaskTestCase(TestCase):
+    def setUp(self):
+        for i in range(3):
+            build = create_build(i)
+            for status in (Task.STATUS_CREATED, Task.STATUS_RUNNING, Task.STATUS_DONE):
+                build.tasks.create(
+                    name='Task %s' % status,
+                    slug='task-%s' % status,
+                    phase=0,
+                    is_critical=True,
+                    environment={},
+                    image='beekeeper/python',
+                    started=timezone.now(),
+                )
+                # Update the status directly, rather than saving, so that
+                # finishing a task doesn't queue any cleanup.
+                build.tasks.filter(slug='task-%s' % status).update(status=status)
+
+
+# Rendering pages shouldn't depend on having run collectstatic.
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class CurrentTasksTests(TaskTestCase):
+    def test_query_budget(self):
+        # 1 query each for pending, started and recently finished tasks.
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('tasks:current-tasks'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['pending']), 3)
+        self.assertEqual(len(response.context['started']), 3)
+        self.assertEqual(len(response.context['recents']), 3)
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'task-status-tests',
+    }
+})
+class TaskStatusTests(TaskTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.task = Task.objects.get(build__change__project__repository__name='repo-0', slug='task-20')
+
+        self.logs_client = FakeLogsClient()
+        patcher = mock.patch.object(logs, 'aws_client', return_value=self.logs_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def status(self, offset=0):
+        response = self.client.get(self.task.get_status_url(), {'offset': offset})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_not_started(self):
+        status = self.status()
+        self.assertIsNone(status['log'])
+        self.assertEqual(status['message'], 'Waiting for logs to become available...')
+        self.assertFalse(status['finished'])
+
+    def test_running(self):
+        Task.objects.filter(pk=self.task.pk).update(arn='arn:aws:ecs:us-west-2:1:task/abc')
+        self.logs_client.messages = ['hello', 'world']
+
+        status = self.status()
+        self.assertEqual(status['log'], 'hello\nworld\n')
+        self.assertEqual(status['offset'], 12)
+        self.assertFalse(status['finished'])
+
+    def test_did_not_start(self):
+        Task.objects.filter(pk=self.task.pk).update(
+            arn='arn:aws:ecs:us-west-2:1:task/abc',
+            status=Task.STATUS_ERROR,
+        )
+        self.logs_client.get_log_events = mock.Mock(side_effect=ClientError(
+            {'Error': {'Code': 'ResourceNotFoundException', 'Message': 'No stream'}},
+            'GetLogEvents'
+        ))
+
+        status = self.status()
+        self.assertIsNone(status['log'])
+        self.assertEqual(status['message'], 'No logs; task did not start.')
+        self.assertTrue(status['finished'])
+
+    def test_archived(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with self.settings(
+                    DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+                    MEDIA_ROOT=media_root):
+            with tempfile.TemporaryFile() as archive:
+                index = write_archive(iter(['Line %s' % i for i in range(3)]), archive)
+                archive.seek(0)
+                name = default_storage.save('logs/test.log.gz', archive)
+            self.task.log_archive = name
+            self.task.log_index = index
+
+            self.assertEqual(self.task.read_new_log(7), ('Line 1\nLine 2\n', 21, True))
+
+class ImageAffinityTests(TaskTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profile = Profile.objects.create(
+            name='Default',
+            slug='default',
+            instance_type='t2.micro',
+            cpu=512,
+            memory=1024,
+        )
+        self.ecs_client = boto3.session.Session(
+            region_name='us-west-2',
+            aws_access_key_id='test',
+            aws_secret_access_key='test',
+        ).client('ecs')
+
+        # An instance that has run the python image, and one that hasn't.
+        self.instance = Instance.objects.create(
+            profile=self.profile,
+            ec2_id='i-1',
+            container_arn='arn:container/1',
+        )
+        self.instance.tasks.add(Task.objects.get(build__change__project__repository__name='repo-0', slug='task-100'))
+        Instance.objects.create(
+            profile=self.profile,
+            ec2_id='i-2',
+            container_arn='arn:container/2',
+        )
+
+        self.task = Task.objects.get(build__change__project__repository__name='repo-1', slug='task-10')
+
+    def describe_response(self, cpu, memory):
+        return {
+            'containerInstances': [
+                {
+                    'containerInstanceArn': 'arn:container/1',
+                    'status': 'ACTIVE',
+                    'agentConnected': True,
+                    'remainingResources': [
+                        {'name': 'CPU', 'type': 'INTEGER', 'integerValue': cpu},
+                        {'name': 'MEMORY', 'type': 'INTEGER', 'integerValue': memory},
+                    ],
+                }
+            ],
+            'failures': [],
+        }
+
+    def test_cached_image(self):
+        with Stubber(self.ecs_client) as stubber:
+            stubber.add_response(
+                'describe_container_instances',
+                self.describe_response(cpu=1024, memory=2048),
+                {'cluster': 'workers', 'containerInstances': ['arn:container/1']},
+            )
+            container_arn = self.task.cached_image_instance(self.ecs_client, self.profile)
+
+        self.assertEqual(container_arn, 'arn:container/1')
+
+    def test_no_capacity(self):
+        with Stubber(self.ecs_client) as stubber:
+            stubber.add_response(
+                'describe_container_instances',
+                self.describe_response(cpu=1024, memory=512),
+                {'cluster': 'workers', 'containerInstances': ['arn:container/1']},
+            )
+            container_arn = self.task.cached_image_instance(self.ecs_client, self.profile)
+
+        self.assertIsNone(container_arn)
+
+    def test_image_not_cached(self):
+        self.task.image = 'beekeeper/other'
+
+        # There's no need to ask ECS about any instances.
+        with Stubber(self.ecs_client):
+            container_arn = self.task.cached_image_instance(self.ecs_client, self.profile)
+
+        self.assertIsNone(container_arn)
+
+
+class HotImageTests(TaskTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profile = Profile.objects.create(
+            name='Default',
+            slug='default',
+            instance_type='t2.micro',
+            hot_image_count=1,
+        )
+        self.ecs_client = boto3.session.Session(
+            region_name='us-west-2',
+            aws_access_key_id='test',
+            aws_secret_access_key='test',
+        ).client('ecs')
+
+        # The python image is used by every task; the docs image only once.
+        Task.objects.filter(
+            build__change__project__repository__name='repo-0', slug='task-10'
+        ).update(image='beekeeper/docs')
+
+    def test_update(self):
+        with Stubber(self.ecs_client) as stubber:
+            stubber.add_response(
+                'describe_task_definition',
+                {
+                    'taskDefinition': {
+                        'containerDefinitions': [
+                            {'name': 'python', 'image': 'registry.example.com/beekeeper/python:latest'},
+                        ]
+                    }
+                },
+                {'taskDefinition': 'python'},
+            )
+            self.profile.update_hot_images(self.ecs_client)
+
+            # Known images don't need to be looked up again.
+            self.profile.update_hot_images(self.ecs_client)
+
+        self.assertEqual(self.profile.hot_images, [
+            {'name': 'beekeeper/python', 'uri': 'registry.example.com/beekeeper/python:latest'},
+        ])
+        self.assertEqual(
+            self.profile.user_data('workers'),
+            '#!/bin/bash\n'
+            'echo ECS_CLUSTER=workers >> /etc/ecs/ecs.config\n'
+            'echo ECS_IMAGE_PULL_BEHAVIOR=prefer-cached >> /etc/ecs/ecs.config\n'
+            'docker pull registry.example.com/beekeeper/python:latest\n'
+        )
+
+
+class TaskDurationTests(TaskTestCase):
+    def setUp(self):
+        super().setUp()
+        self.build = Build.objects.get(change__project__repository__name='repo-0')
+        self.project = self.build.change.project
+
+    def test_record(self):
+        task = self.build.tasks.get(slug='task-100')
+        task.completed = task.started + timedelta(minutes=10)
+        entry = TaskDuration.record(task)
+        self.assertEqual((entry.samples, entry.mean), (1, timedelta(minutes=10)))
+
+        # Later runs move the mean towards the new duration.
+        task.completed = task.started + timedelta(minutes=20)
+        entry = TaskDuration.record(task)
+        self.assertEqual((entry.samples, entry.mean), (2, timedelta(minutes=12)))
+
+    def test_longest_first(self):
+        TaskDuration.objects.create(project=self.project, slug='task-10', mean=timedelta(minutes=1))
+        TaskDuration.objects.create(project=self.project, slug='task-20', mean=timedelta(minutes=10))
+
+        # Tasks that have never run come first.
+        self.assertEqual(
+            [task.slug for task in self.build.tasks.by_expected_duration()],
+            ['task-100', 'task-20', 'task-10']
+        )
+
+    def test_eta(self):
+        TaskDuration.objects.create(project=self.project, slug='task-20', mean=timedelta(minutes=10))
+        task = self.build.tasks.get(slug='task-20')
+        task.started = timezone.now() - timedelta(minutes=2, seconds=30)
+
+        self.assertEqual(task.full_status_display(), 'Running (for 2\xa0minutes; about 7\xa0minutes remaining)')
+
+        # A task that has run longer than usual has no ETA.
+        task.started = timezone.now() - timedelta(minutes=12)
+        self.assertEqual(task.full_status_display(), 'Running (for 12\xa0minutes)')
+
+    def test_expected_duration_queries(self):
+        TaskDuration.objects.create(project=self.project, slug='task-20', mean=timedelta(minutes=10))
+        tasks = list(self.build.tasks.all())
+
+        # The durations for the whole build are looked up at once.
+        with self.assertNumQueries(1):
+            durations = {task.slug: task.expected_duration for task in tasks}
+        self.assertEqual(durations, {
+            'task-10': None,
+            'task-20': timedelta(minutes=10),
+            'task-100': None,
+        })
+
+
+class ShardTests(TaskTestCase):
+    def setUp(self):
+        super().setUp()
+        self.build = Build.objects.get(change__project__repository__name='repo-0')
+        self.project = self.build.change.project
+
+    def test_shard_count(self):
+        # A task that has never run isn't split.
+        self.assertEqual(TaskDuration.shard_count(self.project, 'tests'), 1)
+
+        TaskDuration.objects.create(project=self.project, slug='tests', mean=timedelta(minutes=40))
+        self.assertEqual(TaskDuration.shard_count(self.project, 'tests'), 8)
+        self.assertEqual(TaskDuration.shard_count(self.project, 'tests', timedelta(minutes=15)), 3)
+        self.assertEqual(TaskDuration.shard_count(self.project, 'tests', timedelta(seconds=1)), 20)
+
+    def test_record_shard(self):
+        task = self.build.tasks.create(
+            name='Tests (2/4)',
+            slug='tests.1',
+            phase=1,
+            is_critical=True,
+            environment={},
+            image='beekeeper/python',
+            shard_index=1,
+            shard_total=4,
+            started=timezone.now(),
+        )
+        task.completed = task.started + timedelta(minutes=5)
+        TaskDuration.record(task)
+
+        # The shard, and the task as a whole, both have a duration.
+        self.assertEqual(task.base_slug, 'tests')
+        self.assertEqual(TaskDuration.objects.get(slug='tests.1').mean, timedelta(minutes=5))
+        self.assertEqual(TaskDuration.objects.get(slug='tests').mean, timedelta(minutes=20))
+
+
+class InfrastructureFailureTests(SimpleTestCase):
+    def response(self, last_status='STOPPED', containers=None, **kwargs):
+        return dict(
+            taskArn='arn:task/1',
+            lastStatus=last_status,
+            containers=containers or [{'name': 'python', 'exitCode': 1}],
+            **kwargs
+        )
+
+    def test_test_failure(self):
+        self.assertIsNone(infrastructure_failure(self.response(stopCode='EssentialContainerExited')))
+
+    def test_still_running(self):
+        self.assertIsNone(infrastructure_failure(self.response(last_status='RUNNING')))
+
+    def test_spot_interruption(self):
+        self.assertEqual(
+            infrastructure_failure(self.response(
+                stopCode='SpotInterruption',
+                stoppedReason='Your Spot Task was interrupted.',
+            )),
+            'Your Spot Task was interrupted.'
+        )
+
+    def test_host_terminated(self):
+        self.assertEqual(
+            infrastructure_failure(self.response(
+                containers=[{'name': 'python'}],
+                stoppedReason='Host EC2 (instance i-1) terminated.',
+            )),
+            'Host EC2 (instance i-1) terminated.'
+        )
+
+    def test_container_error(self):
+        self.assertEqual(
+            infrastructure_failure(self.response(
+                containers=[{'name': 'python', 'reason': 'CannotPullContainerError: timeout'}],
+            )),
+            'CannotPullContainerError: timeout'
+        )
+
+    def test_pull_rate_limited(self):
+        reason = (
+            'CannotPullContainerError: Error response from daemon: toomanyrequests: '
+            'You have reached your pull rate limit.'
+        )
+        self.assertEqual(
+            infrastructure_failure(self.response(containers=[{'name': 'python', 'reason': reason}])),
+            reason
+        )
+
+    def test_pull_not_found(self):
+        # Pulling an image that doesn't exist won't work on a retry.
+        self.assertIsNone(infrastructure_failure(self.response(
+            containers=[{
+                'name': 'python',
+                'reason': 'CannotPullContainerError: Error response from daemon: '
+                    'repository beekeeper/missing not found: does not exist or no pull access',
+            }],
+        )))
+
+    def test_out_of_memory(self):
+        # Running out of memory is the fault of the code being tested.
+        self.assertIsNone(infrastructure_failure(self.response(
+            containers=[{'name': 'python', 'reason': 'OutOfMemoryError: Container killed due to memory usage'}],
+        )))
+
+    def test_failed(self):
+        self.assertEqual(infrastructure_failure(self.response(last_status='FAILED')), 'AWS task failure.')
+
+
+class RequeueTests(TaskTestCase):
+    def test_requeue(self):
+        profile = Profile.objects.create(name='Default', slug='default', instance_type='t2.micro')
+        cluster = Cluster.objects.create(profile=profile, name='other')
+        task = create_build(3).tasks.create(
+            name='Task',
+            slug='task',
+            phase=0,
+            is_critical=True,
+            environment={},
+            status=Task.STATUS_RUNNING,
+            arn='arn:task/1',
+            cluster=cluster,
+            started=timezone.now(),
+        )
+        instance = Instance.objects.create(profile=profile, cluster=cluster, ec2_id='i-1', price=0.5)
+        instance.tasks.add(task)
+
+        task.requeue('Host EC2 (instance i-1) terminated.')
+        task.save()
+
+        self.assertEqual(task.retry_history[0]['arn'], 'arn:task/1')
+        self.assertEqual(task.retry_history[0]['reason'], 'Host EC2 (instance i-1) terminated.')
+
+        # Nothing about the lost run is kept.
+        task = Task.objects.get(pk=task.pk)
+        self.assertEqual(task.status, Task.STATUS_WAITING)
+        self.assertIsNone(task.arn)
+        self.assertIsNone(task.cluster)
+        self.assertIsNone(task.started)
+        self.assertFalse(task.instances.exists())
+        self.assertIsNone(task.compute_cost())
+
+
+class IndexLogTests(TaskTestCase):
+    def setUp(self):
+        super().setUp()
+        self.task = Task.objects.get(build__change__project__repository__name='repo-0', slug='task-100')
+
+    def test_chunks(self):
+        lines = ['line %s' % i for i in range(120)]
+        self.assertEqual(list(index_log(self.task, iter(lines))), lines)
+
+        # Lines are indexed in groups, numbered from the first line of each.
+        chunks = list(self.task.log_chunks.all())
+        self.assertEqual([chunk.line for chunk in chunks], [0, 50, 100])
+        self.assertEqual(
+            [len(chunk.content.split('\n')) for chunk in chunks],
+            [SEARCH_CHUNK_LINES, SEARCH_CHUNK_LINES, 20]
+        )
+        self.assertEqual(chunks[1].content.split('\n')[0], 'line 50')
+        self.assertEqual(chunks[2].matching_lines('LINE 119'), [(120, 'line 119')])
+
+    def test_exact_chunks(self):
+        list(index_log(self.task, ('line %s' % i for i in range(2 * SEARCH_CHUNK_LINES))))
+        self.assertEqual([chunk.line for chunk in self.task.log_chunks.all()], [0, 50])
+
+    def test_reindex(self):
+        list(index_log(self.task, ['old line'] * 60))
+        list(index_log(self.task, ['new line']))
+
+        self.assertEqual([chunk.content for chunk in self.task.log_chunks.all()], ['new line'])
+
+    def test_empty(self):
+        self.assertEqual(list(index_log(self.task, [])), [])
+        self.assertFalse(self.task.log_chunks.exists())
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class SearchTests(TaskTestCase):
+    def setUp(self):
+        super().setUp()
+        # Index the logs of the finished tasks, oldest first.
+        self.tasks = []
+        for i in range(3):
+            task = Task.objects.get(build__change__project__repository__name='repo-%s' % i, slug='task-100')
+            list(index_log(task, ['collecting tests', 'ERROR: test_%s failed' % i, 'done']))
+            self.tasks.append(task)
+
+    def search(self, query):
+        response = self.client.get(reverse('tasks:search'), {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return response.context['results']
+
+    def test_search(self):
+        results = self.search('error: TEST_1')
+        self.assertEqual([result['task'] for result in results], [self.tasks[1]])
+        self.assertEqual(results[0]['lines'], [(2, 'ERROR: test_1 failed')])
+
+    def test_most_recent_first(self):
+        results = self.search('error')
+        self.assertEqual([result['task'] for result in results], self.tasks[::-1])
+
+    def test_short_query(self):
+        # Queries that are too short to use the index aren't run.
+        with self.assertNumQueries(0):
+            self.assertEqual(self.search('er'), [])
+
+    def test_max_tasks(self):
+        with mock.patch.object(project_views, 'MAX_SEARCH_TASKS', 2):
+            results = self.search('error')
+        self.assertEqual([result['task'] for result in results], [self.tasks[2], self.tasks[1]])
+
+    def test_max_lines(self):
+        list(index_log(self.tasks[0], ['ERROR %s' % i for i in range(20)]))
+
+        # Re-indexing the log makes it the most recent.
+        results = self.search('error')
+        self.assertEqual(results[0]['task'], self.tasks[0])
+        self.assertEqual(results[0]['lines'], [(i + 1, 'ERROR %s' % i) for i in range(project_views.MAX_SEARCH_LINES)])
+
+
+class SpeculationTests(TaskTestCase):
+    def setUp(self):
+        super().setUp()
+        self.build = Build.objects.get(change__project__repository__name='repo-0')
+        # 2 of the 3 tasks in phase 0 have passed; 1 is still running.
+        self.build.tasks.exclude(slug='task-20').update(status=Task.STATUS_DONE, result=Build.RESULT_PASS)
+        for slug, speculate_after in [('fast-lint', 0.5), ('docs', 1.0), ('package', None)]:
+            self.build.tasks.create(
+                name=slug,
+                slug=slug,
+                phase=1,
+                is_critical=True,
+                environment={},
+                image='beekeeper/python',
+                speculate_after=speculate_after,
+            )
+
+    def speculative_slugs(self):
+        return sorted(task.slug for task in speculative_tasks(self.build))
+
+    def test_fraction_passed(self):
+        # Only the task that needs half the phase to pass can start.
+        self.assertEqual(self.speculative_slugs(), ['fast-lint'])
+
+    def test_critical_passed(self):
+        # If the task that is still running isn't critical, any
+        # speculative task can start.
+        self.build.tasks.filter(slug='task-20').update(is_critical=False)
+        self.assertEqual(self.speculative_slugs(), ['docs', 'fast-lint'])
+
+    def test_phase_failed(self):
+        self.build.tasks.filter(slug='task-10').update(result=Build.RESULT_FAIL)
+        self.assertEqual(self.speculative_slugs(), [])
+
+    def test_already_started(self):
+        self.build.tasks.filter(slug='fast-lint').update(status=Task.STATUS_RUNNING, is_speculative=True)
+        self.assertEqual(self.speculative_slugs(), [])
+
+    def test_unblocked(self):
+        self.build.tasks.filter(slug='fast-lint').update(status=Task.STATUS_RUNNING, is_speculative=True)
+        self.assertEqual(unblocked_tasks(self.build), [])
+
+        # Once phase 0 has passed, the rest of phase 1 can start, even
+        # though the speculative task is still running.
+        self.build.tasks.filter(slug='task-20').update(status=Task.STATUS_DONE, result=Build.RESULT_PASS)
+        self.assertEqual(sorted(task.slug for task in unblocked_tasks(self.build)), ['docs', 'package'])
+
+        # But not if phase 0 failed.
+        self.build.tasks.filter(slug='task-20').update(result=Build.RESULT_FAIL)
+        self.assertEqual(unblocked_tasks(self.build), [])
+
+
+@override_settings(BEEKEEPER_URL='https://beekeeper.example.com')
+class DuplicateTaskTests(TaskTestCase):
+    def setUp(self):
+        super().setUp()
+        self.primary = Task.objects.get(build__change__project__repository__name='repo-0', slug='task-20')
+        self.primary.arn = 'arn:task/1'
+        self.primary.environment = {}
+        self.primary.fingerprint = self.primary.compute_fingerprint(self.primary.run_environment())
+        self.primary.save()
+
+        # Another build of the same commit.
+        build = Build.objects.create(
+            change=self.primary.build.change,
+            commit=self.primary.build.commit,
+            status=Build.STATUS_RUNNING,
+        )
+        self.task = build.tasks.create(
+            name='Task 20',
+            slug='task-20',
+            phase=0,
+            is_critical=True,
+            environment={},
+            image='beekeeper/python',
+        )
+
+    def test_share_run(self):
+        # No ECS or EC2 calls are needed to start the task.
+        self.task.start(ecs_client=None, ec2_client=None)
+
+        task = Task.objects.get(pk=self.task.pk)
+        self.assertEqual(task.primary, self.primary)
+        self.assertEqual(task.arn, 'arn:task/1')
+        self.assertEqual(task.status, Task.STATUS_RUNNING)
+        self.assertEqual(task.log_source, self.primary)
+
+    def test_reset_primary(self):
+        self.task.start(ecs_client=None, ec2_client=None)
+        LogChunk.objects.create(task=self.primary, line=0, content='output')
+        Task.objects.filter(pk=self.primary.pk).update(log_archive='logs/task-20.log.gz')
+        self.primary.refresh_from_db()
+
+        # The duplicate takes over the run, and its log.
+        self.primary.reset()
+
+        task = Task.objects.get(pk=self.task.pk)
+        self.assertIsNone(task.primary)
+        self.assertEqual(task.arn, 'arn:task/1')
+        self.assertEqual(task.log_archive.name, 'logs/task-20.log.gz')
+        self.assertEqual(list(task.log_chunks.values_list('content', flat=True)), ['output'])
+
+    def test_delete_primary(self):
+        self.task.start(ecs_client=None, ec2_client=None)
+        self.primary.delete()
+
+        task = Task.objects.get(pk=self.task.pk)
+        self.assertIsNone(task.primary)
+        self.assertEqual(task.log_source, task)
+
+    def test_different_environment(self):
+        self.task.environment = {'PYTHON_VERSION': '3.7'}
+
+        self.assertNotEqual(
+            self.task.compute_fingerprint(self.task.run_environment()),
+            self.primary.fingerprint
+        )
+
+    def test_ignored_environment(self):
+        # The URL of the code differs between builds, but doesn't
+        # change what the task does.
+        environment = self.task.run_environment()
+        environment['CODE_URL'] = 'https://example.com/other'
+
+        self.assertEqual(self.task.compute_fingerprint(environment), self.primary.fingerprint)
+
+
+@override_settings(BEEKEEPER_URL='https://beekeeper.example.com')
+class QuotaTests(TaskTestCase):
+    def setUp(self):
+        super().setUp()
+        self.build = Build.objects.get(change__project__repository__name='repo-0')
+        self.project = self.build.change.project
+        self.build.tasks.filter(slug='task-20').update(arn='arn:task/1')
+
+        self.other_build = Build.objects.create(
+            change=self.build.change,
+            commit=self.build.commit,
+            status=Build.STATUS_RUNNING,
+        )
+        self.other_task = self.other_build.tasks.create(
+            name='Other task',
+            slug='other',
+            phase=0,
+            is_critical=True,
+            environment={},
+            image='beekeeper/other',
+        )
+
+    def test_no_quota(self):
+        self.assertEqual(self.other_task.quota_reason(), '')
+
+    def test_task_quota(self):
+        self.project.max_concurrent_tasks = 1
+        self.project.save()
+
+        self.assertEqual(self.other_task.quota_reason(), 'repo-0 already has 1 tasks running')
+
+    def test_build_quota(self):
+        self.project.max_concurrent_builds = 1
+        self.project.save()
+
+        self.assertEqual(self.other_task.quota_reason(), 'repo-0 already has 1 builds running')
+        # Tasks in a build that is already running aren't held.
+        self.assertEqual(self.build.tasks.get(slug='task-10').quota_reason(), '')
+
+    def test_held_task(self):
+        self.project.max_concurrent_tasks = 1
+        self.project.save()
+
+        # No ECS or EC2 calls are made for a task that is held.
+        self.other_task.start(ecs_client=None, ec2_client=None)
+
+        task = Task.objects.get(pk=self.other_task.pk)
+        self.assertEqual(task.status, Task.STATUS_WAITING)
+        self.assertIsNone(task.arn)
+        self.assertEqual(task.waiting_reason, 'repo-0 already has 1 tasks running')
+        self.assertTrue(task.full_status_display().endswith(': repo-0 already has 1 tasks running'))
+
+
+class ClusterTests(TaskTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profile = Profile.objects.create(
+            name='Default',
+            slug='default',
+            instance_type='t2.micro',
+        )
+        self.ecs_client = boto3.session.Session(
+            region_name='us-west-2',
+            aws_access_key_id='test',
+            aws_secret_access_key='test',
+        ).client('ecs')
+
+    def test_default_cluster(self):
+        self.assertEqual(
+            [(cluster.pk, cluster.name) for cluster in self.profile.placements()],
+            [(None, 'workers')]
+        )
+
+    def test_placements(self):
+        busy = Cluster.objects.create(profile=self.profile, name='busy', weight=5)
+        throttled = Cluster.objects.create(
+            profile=self.profile,
+            name='throttled',
+            region='us-east-1',
+            weight=100,
+            throttled_until=timezone.now() + timedelta(minutes=1),
+        )
+        Cluster.objects.create(profile=self.profile, name='disabled', weight=0)
+
+        # Throttled clusters are tried last, no matter their weight;
+        # clusters with no weight aren't used.
+        self.assertEqual(self.profile.placements(), [busy, throttled])
+
+    def test_run_on(self):
+        cluster = Cluster.objects.create(profile=self.profile, name='other')
+        task = Task.objects.get(build__change__project__repository__name='repo-0', slug='task-10')
+
+        with Stubber(self.ecs_client) as stubber:
+            stubber.add_response(
+                'run_task',
+                {'tasks': [], 'failures': [{'arn': 'arn:container/1', 'reason': 'RESOURCE:CPU'}]},
+                {'cluster': 'other', 'taskDefinition': 'python', 'overrides': {}},
+            )
+            response = task.run_on(cluster, self.ecs_client, self.profile, {})
+
+        self.assertEqual(response['failures'][0]['reason'], 'RESOURCE:CPU')
+
+    def test_describe_tasks(self):
+        cluster = Cluster.objects.create(profile=self.profile, name='other')
+        tasks = list(Task.objects.filter(build__change__project__repository__name='repo-0'))
+        for i, task in enumerate(tasks):
+            task.arn = 'arn:task/%s' % i
+        tasks[0].cluster = cluster
+
+        # Each cluster is asked about its own tasks.
+        with Stubber(self.ecs_client) as stubber:
+            stubber.add_response(
+                'describe_tasks',
+                {'tasks': [{'taskArn': 'arn:task/0', 'lastStatus': 'RUNNING'}]},
+                {'cluster': 'other', 'tasks': ['arn:task/0']},
+            )
+            stubber.add_response(
+                'describe_tasks',
+                {'tasks': [
+                    {'taskArn': 'arn:task/1', 'lastStatus': 'RUNNING'},
+                    {'taskArn': 'arn:task/2', 'lastStatus': 'STOPPED'},
+                ]},
+                {'cluster': 'workers', 'tasks': ['arn:task/1', 'arn:task/2']},
+            )
+            task_responses = describe_tasks(tasks, self.ecs_client)
+
+        self.assertEqual(
+            [task_response['taskArn'] for task_response in task_responses],
+            ['arn:task/0', 'arn:task/1', 'arn:task/2']
+        )
+
+
+@override_settings(AWS_ECS_SUBNET_ID='subnet-1', AWS_ECS_SECURITY_GROUP_IDS='sg-1:sg-2')
+class FargateTests(TaskTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profile = Profile.objects.create(
+            name='Default',
+            slug='default',
+            launch_type=Profile.LAUNCH_TYPE_FARGATE,
+            cpu=256,
+            memory=512,
+        )
+        self.ecs_client = boto3.session.Session(
+            region_name='us-west-2',
+            aws_access_key_id='test',
+            aws_secret_access_key='test',
+        ).client('ecs')
+
+    def test_clean(self):
+        self.profile.clean()
+
+        self.profile.memory = 0
+        with self.assertRaises(ValidationError):
+            self.profile.clean()
+
+    def test_run_on(self):
+        task = Task.objects.get(build__change__project__repository__name='repo-0', slug='task-10')
+        overrides = {'cpu': '256', 'memory': '512', 'containerOverrides': []}
+
+        # Fargate tasks are never placed on a specific instance.
+        with Stubber(self.ecs_client) as stubber:
+            stubber.add_response(
+                'run_task',
+                {'tasks': [], 'failures': [{'reason': 'Capacity is unavailable at this time.'}]},
+                {
+                    'cluster': 'workers',
+                    'taskDefinition': 'python',
+                    'overrides': overrides,
+                    'launchType': 'FARGATE',
+                    'networkConfiguration': {
+                        'awsvpcConfiguration': {
+                            'subnets': ['subnet-1'],
+                            'securityGroups': ['sg-1', 'sg-2'],
+                            'assignPublicIp': 'ENABLED',
+                        }
+                    },
+                },
+            )
+            task.run_on(Cluster.default(), self.ecs_client, self.profile, overrides)
+
+    def test_no_instances(self):
+        self.assertIsNone(self.profile.start_instance(
+            key_name='key',
+            security_groups=['sg-1'],
+            subnet='subnet-1',
+            cluster_name='workers',
+            ec2_client=object(),
+            ecs_client=object(),
+        ))
+        self.assertFalse(Instance.objects.exists())
+
+
+class InstanceTypeTests(TaskTestCase):
+    def setUp(self):
+        super().setUp()
+        self.catalog_dir = tempfile.mkdtemp()
+        catalog_file = os.path.join(self.catalog_dir, 'ec2_types.json')
+        with open(catalog_file, 'w') as catalog:
+            json.dump({
+                'instance_types': [
+                    {'name': 'small', 'vcpu': 1, 'mem': 2, 'price': 0.05},
+                    {'name': 'large', 'vcpu': 4, 'mem': 8, 'price': 0.12},
+                    {'name': 'huge', 'vcpu': 16, 'mem': 64, 'price': 1.0},
+                ],
+                'fargate': {'vcpu_hour': 0.04, 'gb_hour': 0.005},
+            }, catalog)
+
+        # Use the test catalog, rather than any catalog already loaded.
+        settings_override = override_settings(AWS_EC2_TYPES_FILE=catalog_file)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        catalog_patch = mock.patch.object(models, '_ec2_catalog', None)
+        catalog_patch.start()
+        self.addCleanup(catalog_patch.stop)
+
+        self.profile = Profile.objects.create(
+            name='Default',
+            slug='default',
+            cpu=1024,
+            memory=1024,
+            hot_image_count=0,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.catalog_dir)
+
+    def test_tasks_per_instance(self):
+        catalog = models.ec2_catalog()['instance_types']
+        self.assertEqual(
+            [self.profile.tasks_per_instance(catalog[name]) for name in ('small', 'large', 'huge')],
+            [1, 4, 16]
+        )
+
+    def test_choose_instance_type(self):
+        # The cheapest type per task is chosen for the tasks that are
+        # waiting, or that will fit on one instance.
+        self.assertEqual(self.profile.choose_instance_type(1)['name'], 'small')
+        self.assertEqual(self.profile.choose_instance_type(4)['name'], 'large')
+        self.assertEqual(self.profile.choose_instance_type(50)['name'], 'large')
+
+        self.profile.instance_types = 'small:huge'
+        self.assertEqual(self.profile.choose_instance_type(4)['name'], 'small')
+
+        self.profile.min_vcpu = 8
+        self.assertEqual(self.profile.choose_instance_type(1)['name'], 'huge')
+
+    def test_clean(self):
+        self.profile.clean()
+
+        self.profile.instance_types = 'small:tiny'
+        with self.assertRaises(ValidationError):
+            self.profile.clean()
+
+        # No allowed type can fit a task.
+        self.profile.instance_types = 'small'
+        self.profile.memory = 4096
+        self.assertIsNone(self.profile.choose_instance_type())
+        with self.assertRaises(ValidationError):
+            self.profile.clean()
+
+    def test_start_instance(self):
+        ec2_client = boto3.session.Session(
+            region_name='us-west-2',
+            aws_access_key_id='test',
+            aws_secret_access_key='test',
+        ).client('ec2')
+        with Stubber(ec2_client) as stubber:
+            stubber.add_response(
+                'run_instances',
+                {'Instances': [{'InstanceId': 'i-1234'}]},
+                {
+                    'MinCount': 1,
+                    'MaxCount': 1,
+                    'ImageId': 'ami-57d9cd2e',
+                    'InstanceType': 'large',
+                    'KeyName': 'key',
+                    'SecurityGroupIds': ['sg-1'],
+                    'SubnetId': 'subnet-1',
+                    'IamInstanceProfile': {'Name': 'ecsInstanceRole'},
+                    'UserData': '#!/bin/bash\necho ECS_CLUSTER=workers >> /etc/ecs/ecs.config\n',
+                },
+            )
+            instance = self.profile.start_instance(
+                key_name='key',
+                security_groups=['sg-1'],
+                subnet='subnet-1',
+                cluster_name='workers',
+                ec2_client=ec2_client,
+                ecs_client=object(),
+                waiting=3,
+            )
+
+        self.assertEqual((instance.instance_type, instance.price), ('large', 0.12))
+        # The new instance will be able to run 4 tasks once it has started.
+        self.assertEqual(self.profile.booting_capacity(), 4)
+
+        # An instance that never registers with ECS isn't counted forever.
+        Instance.objects.filter(pk=instance.pk).update(created=timezone.now() - timedelta(hours=1))
+        self.assertEqual(self.profile.booting_capacity(), 0)
+
+    def test_cost(self):
+        task = Task.objects.get(build__change__project__repository__name='repo-0', slug='task-100')
+        task.started = timezone.now() - timedelta(hours=2)
+        task.completed = task.started + timedelta(hours=2)
+
+        # The cost of an instance is shared by the tasks that fit on it.
+        instance = Instance.objects.create(
+            profile=self.profile,
+            ec2_id='i-1234',
+            instance_type='large',
+            price=0.12,
+        )
+        instance.tasks.add(task)
+        self.assertAlmostEqual(task.compute_cost(), 0.06)
+
+        self.profile.launch_type = Profile.LAUNCH_TYPE_FARGATE
+        self.profile.save()
+        self.assertAlmostEqual(task.compute_cost(), 2 * (0.04 + 0.005))
+
+        # A task that shared another task's run didn't cost anything.
+        task.primary = Task.objects.get(build__change__project__repository__name='repo-1', slug='task-100')
+        self.assertEqual(task.compute_cost(), 0.0)
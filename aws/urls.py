@@ -1,9 +1,10 @@
 from django.conf.urls import url
-from django.contrib import admin
 
-from . import views as aws
+from projects import views as projects
 
 
 urlpatterns = [
-    url(r'^$', aws.current_tasks, name='current-tasks'),
+    url(r'^$', projects.current_tasks, name='current-tasks'),
+    url(r'^events$', projects.current_tasks_events, name='current-tasks-events'),
+    url(r'^search$', projects.search, name='search'),
 ]
@@ -0,0 +1,190 @@
+"""An agent that runs BeeKeeper tasks on this machine.
+
+The agent asks a BeeKeeper server (configured to use the `workers` build
+app) for tasks, runs each task in a Docker container, and sends the log
+and exit code of the container back to the server.
+"""
+from argparse import ArgumentParser
+import json
+import os
+import subprocess
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.parse import urljoin
+from urllib.request import Request, urlopen
+
+
+# How long (in seconds) the server is asked to wait for a task to
+# become available before replying that there is nothing to run. The
+# server won't wait for longer than 20 seconds.
+CLAIM_WAIT = 20
+
+# How often (in seconds) new log output is sent while a task is running,
+# and how often the server is told the task is still running.
+LOG_INTERVAL = 1
+HEARTBEAT_INTERVAL = 10
+
+# How long (in seconds) to wait before trying again after the server
+# couldn't be reached.
+RETRY_DELAY = 5
+
+
+class Agent:
+    def __init__(self, server, token, docker='docker'):
+        self.server = server
+        self.token = token
+        self.docker = docker
+
+    def request(self, path, data=None, timeout=30):
+        """Make a request of the worker API.
+
+        Returns the decoded JSON response, or None if the response
+        has no content.
+        """
+        request = Request(
+            urljoin(self.server, path),
+            data=json.dumps(data or {}).encode('utf-8'),
+            headers={
+                'Authorization': 'Token %s' % self.token,
+                'Content-Type': 'application/json',
+            },
+            method='POST',
+        )
+        with urlopen(request, timeout=timeout) as response:
+            content = response.read()
+        if content:
+            return json.loads(content.decode('utf-8'))
+        return None
+
+    def run(self):
+        "Run tasks, forever."
+        while True:
+            try:
+                task = self.request('/tasks/api/claim?wait=%s' % CLAIM_WAIT, timeout=CLAIM_WAIT + 10)
+            except OSError as e:
+                print("Unable to reach {server}: {error}".format(server=self.server, error=e))
+                time.sleep(RETRY_DELAY)
+                continue
+
+            if task:
+                self.run_task(task)
+
+    def run_task(self, task):
+        "Run a task in a Docker container, reporting on it as it runs."
+        print("Running {name}...".format(**task))
+        container = 'beekeeper-{id}'.format(**task)
+        api = '/tasks/api/{id}/'.format(**task)
+
+        # Pass the values of the environment through the environment of
+        # the Docker client, so they don't appear on the command line.
+        command = [self.docker, 'run', '--rm', '--name', container]
+        for var in task['environment']:
+            command.extend(['-e', var])
+        command.append(task['image'])
+
+        try:
+            process = subprocess.Popen(
+                command,
+                env=dict(os.environ, **task['environment']),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+        except OSError as e:
+            self.complete(api, {'error': "Unable to start Docker: %s" % e})
+            return
+
+        # Collect the output of the container as it is produced.
+        output = []
+        reader = threading.Thread(target=self.read_output, args=(process.stdout, output))
+        reader.start()
+
+        sent = 0
+        stopping = False
+        last_heartbeat = time.time()
+        while True:
+            finished = process.poll() is not None
+            if finished:
+                reader.join()
+            else:
+                time.sleep(LOG_INTERVAL)
+
+            # Only move past lines once the server has received them.
+            lines = output[sent:]
+            if lines:
+                try:
+                    self.request(api + 'log', {'line': sent, 'lines': lines})
+                    sent += len(lines)
+                except HTTPError as e:
+                    # The server won't accept the lines; don't resend them.
+                    print("Log for {name} rejected: {error}".format(error=e, **task))
+                    sent += len(lines)
+                except OSError as e:
+                    print("Unable to send log for {name}: {error}".format(error=e, **task))
+
+            if finished:
+                if sent == len(output):
+                    break
+                time.sleep(RETRY_DELAY)
+            elif time.time() - last_heartbeat >= HEARTBEAT_INTERVAL:
+                try:
+                    stop = self.request(api + 'heartbeat')['stop']
+                    last_heartbeat = time.time()
+                except HTTPError as e:
+                    # The server has given up on the task.
+                    stop = e.code == 404
+                except OSError as e:
+                    print("Unable to send heartbeat for {name}: {error}".format(error=e, **task))
+                    continue
+
+                if stop and not stopping:
+                    print("Stopping {name}...".format(**task))
+                    subprocess.run([self.docker, 'stop', container])
+                    stopping = True
+
+        print("{name} exited with code {code}.".format(code=process.returncode, **task))
+        self.complete(api, {'exit_code': process.returncode})
+
+    def read_output(self, stream, output):
+        for line in stream:
+            output.append(line.decode('utf-8', errors='replace').rstrip('\n'))
+
+    def complete(self, api, outcome):
+        "Tell the server a task has finished, retrying until it hears."
+        while True:
+            try:
+                self.request(api + 'complete', outcome)
+                return
+            except HTTPError as e:
+                print("Outcome of task rejected: {error}".format(error=e))
+                return
+            except OSError as e:
+                print("Unable to report outcome of task: {error}".format(error=e))
+                time.sleep(RETRY_DELAY)
+
+
+def main():
+    parser = ArgumentParser(description='Run BeeKeeper tasks on this machine.')
+    parser.add_argument(
+        '--server', '-s', dest='server',
+        default=os.environ.get('BEEKEEPER_SERVER'),
+        help='The URL of the BeeKeeper server (default: $BEEKEEPER_SERVER).',
+    )
+    parser.add_argument(
+        '--token', '-t', dest='token',
+        default=os.environ.get('BEEKEEPER_WORKER_TOKEN'),
+        help="The worker's token, from the BeeKeeper admin (default: $BEEKEEPER_WORKER_TOKEN).",
+    )
+    parser.add_argument(
+        '--docker', dest='docker', default='docker',
+        help='The Docker client to use.',
+    )
+    options = parser.parse_args()
+    if not options.server or not options.token:
+        parser.error('A server URL and worker token must be provided.')
+
+    Agent(options.server, options.token, docker=options.docker).run()
+
+
+if __name__ == '__main__':
+    main()
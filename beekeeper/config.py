@@ -1,4 +1,69 @@
 
+def cache_files(*configs):
+    """Find the files that define the dependency cache for a task.
+
+    The first config that declares a cache is used; a cache can be
+    declared as a single filename, or a list of filenames.
+    """
+    for config in configs:
+        if config and 'cache' in config:
+            files = config['cache']
+            if isinstance(files, str):
+                return [files]
+            return list(files)
+    return []
+
+
+def shard_count(*configs):
+    """Find the number of shards that a task should be split into.
+
+    The first config that declares shards is used; shards can be a
+    positive integer, or 'auto' to pick a count based on how long the
+    task has taken in the past.
+    """
+    for config in configs:
+        if config and 'shards' in config:
+            shards = config['shards']
+            if shards == 'auto':
+                return shards
+            if not isinstance(shards, int) or isinstance(shards, bool) or shards < 1:
+                raise ValueError("Shards must be a positive integer or 'auto'; got %r." % shards)
+            return shards
+    return 1
+
+
+def shard_target(*configs):
+    """Find the target duration (in seconds) of a shard of a task.
+
+    Returns None if no target has been declared.
+    """
+    for config in configs:
+        if config and 'shard_target' in config:
+            return int(config['shard_target'])
+    return None
+
+
+def speculation(*configs):
+    """Find when a task can be started before the previous phase finishes.
+
+    The first config that declares `speculative` is used. A task that
+    is speculative can start once all the critical tasks of the previous
+    phase have passed; if `speculative` is a fraction, the task can also
+    start once that fraction of the previous phase has passed.
+
+    Returns None if the task isn't speculative.
+    """
+    for config in configs:
+        if config and 'speculative' in config:
+            speculative = config['speculative']
+            if speculative is True:
+                return 1.0
+            elif speculative is False:
+                return None
+            return float(speculative)
+    return None
+
+
 def load_task_configs(config):
     task_data = []
     for phase, phase_configs in enumerate(config):
@@ -54,6 +119,10 @@ def load_task_configs(config):
                             'environment': task_env,
                             'profile_slug': task_profile,
                             'image': image,
+                            'cache': cache_files(task_config, phase_config),
+                            'shards': shard_count(task_config, phase_config),
+                            'shard_target': shard_target(task_config, phase_config),
+                            'speculate_after': speculation(task_config, phase_config),
                         })
             elif 'image' in phase_config:
                 task_data.append({
@@ -64,6 +133,10 @@ def load_task_configs(config):
                     'environment': phase_config.get('environment', {}),
                     'profile_slug': phase_config.get('profile', 'default'),
                     'image': phase_config['image'],
+                    'cache': cache_files(phase_config),
+                    'shards': shard_count(phase_config),
+                    'shard_target': shard_target(phase_config),
+                    'speculate_after': speculation(phase_config),
                 })
             elif 'task' in phase_config:
                 # Backward compatibility - look for a
@@ -76,6 +149,10 @@ def load_task_configs(config):
                     'environment': phase_config.get('environment', {}),
                     'profile_slug': phase_config.get('profile', 'default'),
                     'image': 'beekeeper/' + phase_config['task'],
+                    'cache': cache_files(phase_config),
+                    'shards': shard_count(phase_config),
+                    'shard_target': shard_target(phase_config),
+                    'speculate_after': speculation(phase_config),
                 })
             else:
                 raise ValueError("Phase %s task %s doesn't contain a task or subtask image." % (
@@ -71,6 +71,12 @@ def run_project(project_dir, slug=None, action='pull_request'):
         task['environment'].update({
             'TASK': task['slug'].split(':')[-1],
         })
+        # Run a sharded task as a single shard that does all the work.
+        if task['shards'] != 1:
+            task['environment'].update({
+                'SHARD_INDEX': 0,
+                'SHARD_TOTAL': 1,
+            })
 
         success = run_task(project_dir=project_dir, **task)
 
@@ -1,7 +1,13 @@
 from django.contrib.auth.decorators import login_required
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db.models import Case, Count, When
 from django.shortcuts import render, redirect
 
-from projects.models import Project
+from projects.models import Project, Change
+
+
+# The number of projects shown on each page of the home page.
+PROJECTS_PER_PAGE = 50
 
 
 def home(request):
@@ -17,7 +23,21 @@ def home(request):
 
         return redirect('home')
 
+    projects = Project.objects.active().select_related(
+            'repository__owner'
+        ).annotate(
+            active_changes=Count(Case(When(changes__status=Change.STATUS_ACTIVE, then=1)))
+        )
+
+    paginator = Paginator(projects, PROJECTS_PER_PAGE)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except PageNotAnInteger:
+        page = paginator.page(1)
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
+
     return render(request, 'home.html', {
-            'projects': Project.objects.active(),
-            'new_projects': Project.objects.pending_approval()
+            'projects': page,
+            'new_projects': Project.objects.pending_approval().select_related('repository__owner')
         })
@@ -53,7 +53,6 @@ INSTALLED_APPS = [
 
     'github',
     'projects',
-    'aws',
 ]
 
 MIDDLEWARE = [
@@ -170,13 +169,39 @@ SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 ######################################################################
 # Set up the Redis Queue for workers.
 ######################################################################
-CELERY_BROKER_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
-CELERY_RESULT_BACKEND = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+CELERY_BROKER_URL = REDIS_URL
+CELERY_RESULT_BACKEND = REDIS_URL
+
+# Tasks run by the local build app get a queue of their own, so that they
+# don't hold up build checks; the concurrency of the workers consuming that
+# queue limits how many tasks run at once.
+CELERY_TASK_ROUTES = {
+    'local.tasks.run_task': {'queue': 'local'},
+}
+
+######################################################################
+# Cache
+######################################################################
+# The cache is shared between web processes (e.g., to share CloudWatch
+# log data between viewers of a task), so use Redis if it's available.
+# Otherwise, fall back to Django's default local memory cache.
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
 
 ######################################################################
 # Media file storage
 ######################################################################
-DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
+DEFAULT_FILE_STORAGE = os.environ.get(
+    'DEFAULT_FILE_STORAGE',
+    'storages.backends.s3boto3.S3Boto3Storage'
+)
 
 ######################################################################
 # Beekeeper configuration
@@ -185,11 +210,40 @@ BEEKEEPER_NAMESPACE = os.environ.get('BEEKEEPER_NAMESPACE', 'beekeeper')
 BEEKEEPER_URL = os.environ.get('BEEKEEPER_URL')
 BEEKEEPER_BUILD_APP = os.environ.get('BEEKEEPER_BUILD_APP', 'aws')
 
+# The build app defines the tasks of a build; only one can be installed.
+INSTALLED_APPS.append(BEEKEEPER_BUILD_APP)
+
+# The maximum total size (in bytes) of the dependency cache for a project.
+BEEKEEPER_CACHE_MAX_SIZE = int(os.environ.get('BEEKEEPER_CACHE_MAX_SIZE', 5 * 1024 * 1024 * 1024))
+
+# How the local build app runs a task: 'docker' runs the task image in a
+# container, and 'subprocess' runs the image name as a command. The logs
+# of tasks are written to files in BEEKEEPER_LOCAL_LOG_DIR.
+BEEKEEPER_LOCAL_RUNNER = os.environ.get('BEEKEEPER_LOCAL_RUNNER', 'docker')
+BEEKEEPER_LOCAL_LOG_DIR = os.environ.get(
+    'BEEKEEPER_LOCAL_LOG_DIR',
+    os.path.join(BASE_DIR, 'runtime', 'logs')
+)
+
+# Environment variables that are ignored when deciding if two tasks are
+# identical (and so can share a single run).
+BEEKEEPER_FINGERPRINT_IGNORE = os.environ.get(
+    'BEEKEEPER_FINGERPRINT_IGNORE',
+    'CODE_URL:GITHUB_PR_NUMBER:CACHE_URL:CACHE_KEY'
+).split(':')
+
 ######################################################################
 # AWS configuration
 ######################################################################
 AWS_STORAGE_BUCKET_NAME = 'beekeeper'
 
+# Stored files (source archives of possibly private repositories, task
+# logs and dependency caches) must not be world readable; they are only
+# served through BeeKeeper, or through short-lived signed URLs.
+AWS_DEFAULT_ACL = 'private'
+AWS_BUCKET_ACL = 'private'
+AWS_QUERYSTRING_AUTH = True
+
 AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 AWS_REGION = os.environ.get('AWS_REGION')
@@ -200,6 +254,13 @@ AWS_ECS_CLUSTER_NAME = os.environ.get('AWS_ECS_CLUSTER_NAME', 'workers')
 AWS_ECS_SUBNET_ID = os.environ.get('AWS_ECS_SUBNET_ID')
 AWS_ECS_SECURITY_GROUP_IDS = os.environ.get('AWS_ECS_SECURITY_GROUP_IDS')
 
+# The catalog of EC2 instance types (with their prices) that profiles can
+# use, and the Fargate rates; update it as AWS changes its prices.
+AWS_EC2_TYPES_FILE = os.environ.get(
+    'AWS_EC2_TYPES_FILE',
+    os.path.join(BASE_DIR, 'aws', 'ec2_types.json')
+)
+
 ######################################################################
 # Sendgrid
 ######################################################################
@@ -13,6 +13,7 @@ Including another URLconf
     1. Import the include() function: from django.conf.urls import url, include
     2. Add a URL to urlpatterns:  url(r'^blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.conf.urls import url, include
 from django.contrib import admin
 
@@ -26,7 +27,7 @@ urlpatterns = [
     url(r'^github/', include('github.urls', namespace='github')),
     url(r'^projects/', include('projects.urls', namespace='projects')),
 
-    url(r'^tasks/', include('aws.urls', namespace='aws')),
+    url(r'^tasks/', include('%s.urls' % settings.BEEKEEPER_BUILD_APP, namespace='tasks')),
 
     url(r'^$', beekeeper.home, name='home')
 ]
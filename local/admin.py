@@ -0,0 +1,19 @@
+from django.contrib import admin
+
+from .models import Task
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ['project', 'build_pk', 'name', 'phase', 'is_critical', 'image', 'status', 'result', 'exit_code']
+    list_filter = ['status', 'result', 'is_critical']
+    raw_id_fields = ['build',]
+
+    def build_pk(self, task):
+        return task.build.display_pk
+    build_pk.short_description = 'Build'
+
+    def project(self, task):
+        return task.build.change.project
+    project.short_description = 'Project'
+
@@ -0,0 +1,49 @@
+from django.db import transaction
+
+from projects import events
+
+from .models import Task
+from .tasks import check_build
+
+def start_build(sender, build, *args, **kwargs):
+    check_build.delay(str(build.pk))
+
+
+def publish_task(sender, instance, *args, **kwargs):
+    """Publish the new state of a task to anyone watching it.
+
+    The event is published once the task has been committed, so watchers
+    never see a change that is rolled back.
+    """
+    task_pk = instance.pk
+    transaction.on_commit(lambda: _publish_task(task_pk))
+
+
+def _publish_task(task_pk):
+    try:
+        task = Task.objects.select_related(
+            'build__change__project__repository__owner'
+        ).get(pk=task_pk)
+    except Task.DoesNotExist:
+        return
+
+    events.publish(
+        [
+            events.channel('build', task.build_id),
+            events.channel('task', task.pk),
+            events.ALL_TASKS,
+        ],
+        'task',
+        {
+            'pk': task.pk,
+            'slug': task.slug,
+            'url': task.get_absolute_url(),
+            'name': task.name,
+            'phase': task.phase,
+            'status': task.get_status_display(),
+            'full_status': task.full_status_display(),
+            'result': task.result,
+            'started': task.has_started,
+            'finished': task.is_finished,
+        }
+    )
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 16:20
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('projects', '0012_project_quotas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.IntegerField(choices=[(10, 'Created'), (19, 'Waiting'), (20, 'Running'), (100, 'Done'), (200, 'Error'), (9998, 'Stopping'), (9999, 'Stopped')], default=10)),
+                ('result', models.IntegerField(choices=[(0, 'Pending'), (10, 'Fail'), (19, 'Non-critical Fail'), (20, 'Pass')], default=0)),
+                ('name', models.CharField(db_index=True, max_length=100)),
+                ('slug', models.CharField(db_index=True, max_length=100)),
+                ('phase', models.IntegerField()),
+                ('is_critical', models.BooleanField()),
+                ('queued', models.DateTimeField(blank=True, null=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('completed', models.DateTimeField(blank=True, null=True)),
+                ('environment', django.contrib.postgres.fields.jsonb.JSONField(blank=True)),
+                ('profile_slug', models.CharField(default='default', max_length=100)),
+                ('image', models.CharField(max_length=100)),
+                ('exit_code', models.IntegerField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('build', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tasks', to='projects.Build')),
+            ],
+            options={
+                'ordering': ('phase', 'name'),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='task',
+            unique_together=set([('build', 'slug')]),
+        ),
+    ]
@@ -0,0 +1,190 @@
+import os
+import shlex
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+from projects.models import Build, BaseTask, BaseTaskQuerySet
+
+
+# The longest a task can run before it is stopped.
+TASK_TIMEOUT = timedelta(hours=1)
+
+# How long a task can keep running after it should have been stopped for
+# exceeding TASK_TIMEOUT before it is considered lost; e.g., because the
+# worker running it was killed.
+LOST_TASK_GRACE = timedelta(minutes=5)
+
+# The maximum amount of log data (in bytes) returned by a single read.
+MAX_READ_SIZE = 256 * 1024
+
+# The number of recently finished tasks whose logs are searched.
+MAX_SEARCH_SCAN = 500
+
+
+class TaskQuerySet(BaseTaskQuerySet):
+    def using_capacity(self):
+        "Tasks that have a process of their own."
+        return self.running()
+
+    def exited(self):
+        "Tasks whose process has exited, but haven't been checked."
+        return self.filter(
+            status__in=(Task.STATUS_RUNNING, Task.STATUS_STOPPING),
+            completed__isnull=False
+        )
+
+    def lost(self):
+        "Tasks that have been running for too long to still have a process."
+        return self.filter(
+            status__in=(Task.STATUS_RUNNING, Task.STATUS_STOPPING),
+            completed__isnull=True,
+            started__lt=timezone.now() - TASK_TIMEOUT - LOST_TASK_GRACE
+        )
+
+
+class Task(BaseTask):
+    objects = TaskQuerySet.as_manager()
+
+    exit_code = models.IntegerField(null=True, blank=True)
+
+    @property
+    def log_path(self):
+        return os.path.join(settings.BEEKEEPER_LOCAL_LOG_DIR, str(self.build_id), '%s.log' % self.slug)
+
+    @property
+    def container_name(self):
+        return 'beekeeper-local-%s' % self.pk
+
+    def command(self, environment):
+        """The command that runs the task.
+
+        The values of the environment are passed through the environment
+        of the command, so they don't appear on the command line.
+        """
+        if settings.BEEKEEPER_LOCAL_RUNNER == 'subprocess':
+            return shlex.split(self.image)
+
+        command = ['docker', 'run', '--rm', '--name', self.container_name]
+        for var in environment:
+            command.extend(['-e', var])
+        command.append(self.image)
+        return command
+
+    def start(self):
+        "Queue the task to be run by a local worker."
+        from .tasks import run_task
+
+        self.status = Task.STATUS_WAITING
+        if self.queued is None:
+            self.queued = timezone.now()
+        self.save()
+        run_task.delay(str(self.pk))
+
+    def finish(self):
+        "Record the outcome of a task whose process has exited."
+        if self.status == Task.STATUS_STOPPING:
+            self.status = Task.STATUS_STOPPED
+        elif self.exit_code is None:
+            self.status = Task.STATUS_ERROR
+        else:
+            self.status = Task.STATUS_DONE
+            if self.exit_code == 0:
+                self.result = Build.RESULT_PASS
+            elif self.is_critical:
+                self.result = Build.RESULT_FAIL
+            else:
+                self.result = Build.RESULT_NON_CRITICAL_FAIL
+
+    def reset(self):
+        "Return this task to its initial state, so that it can be run again."
+        try:
+            os.remove(self.log_path)
+        except FileNotFoundError:
+            pass
+
+        self.status = Task.STATUS_CREATED
+        self.result = Build.RESULT_PENDING
+        self.queued = None
+        self.started = None
+        self.completed = None
+        self.exit_code = None
+        self.error = ''
+        self.save()
+
+    def read_log(self, offset=0):
+        """Read the log of the task, starting at the given byte offset.
+
+        Returns a tuple containing the log data, and the offset that
+        should be used for the next read.
+        """
+        try:
+            with open(self.log_path, 'rb') as logfile:
+                logfile.seek(offset)
+                data = logfile.read(MAX_READ_SIZE)
+        except FileNotFoundError:
+            return b'', offset
+
+        # Don't split a line (and possibly a character) between reads.
+        if len(data) == MAX_READ_SIZE and b'\n' in data:
+            data = data[:data.rindex(b'\n') + 1]
+        return data, offset + len(data)
+
+    def read_new_log(self, offset=0):
+        """Read the log of the task as text, starting at the given byte offset.
+
+        Returns the log data, the offset that should be used for the next
+        read, and whether the whole log has been read. The log file is
+        complete once the task has finished.
+        """
+        data, offset = self.read_log(offset)
+        return data.decode('utf-8', errors='replace'), offset, offset >= self.log_size()
+
+    def log_size(self):
+        try:
+            return os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            return 0
+
+    @classmethod
+    def search_logs(cls, query, max_tasks):
+        """Find the tasks whose logs contain the query.
+
+        Logs are kept in files, so only the logs of the most recently
+        finished tasks are searched.
+        """
+        tasks = Task.objects.finished().select_related(
+                        'build__commit',
+                        'build__change__project__repository__owner',
+                    ).order_by('-updated')[:MAX_SEARCH_SCAN]
+
+        results = []
+        for task in tasks:
+            lines = task.matching_lines(query)
+            if lines:
+                results.append({
+                    'task': task,
+                    'lines': lines,
+                })
+                if len(results) == max_tasks:
+                    break
+        return results
+
+    def matching_lines(self, query):
+        """Return the lines in the log of the task that contain the query.
+
+        Returns a list of (line number, line) pairs; the search is
+        case insensitive.
+        """
+        query = query.lower()
+        try:
+            with open(self.log_path, encoding='utf-8', errors='replace') as logfile:
+                return [
+                    (number + 1, line.rstrip('\n'))
+                    for number, line in enumerate(logfile)
+                    if query in line.lower()
+                ]
+        except FileNotFoundError:
+            return []
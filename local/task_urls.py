@@ -0,0 +1,12 @@
+from django.conf.urls import url
+
+from projects import views as projects
+from local import views as local
+
+
+urlpatterns = [
+    url(r'^(?P<task_slug>[-\w\._:]+)$', projects.task, name='task'),
+    url(r'^(?P<task_slug>[-\w\._:]+)/status$', projects.task_status, name='task-status'),
+    url(r'^(?P<task_slug>[-\w\._:]+)/log$', local.task_log, name='task-log'),
+    url(r'^(?P<task_slug>[-\w\._:]+)/events$', projects.task_events, name='task-events'),
+]
@@ -0,0 +1,173 @@
+import logging
+import os
+import subprocess
+
+from config.celery import app
+
+from django.conf import settings
+from django.utils import timezone
+
+from projects.models import Build
+from projects.phases import BuildChecker, github_repository, on_check_build_failure
+from local.models import Task, TASK_TIMEOUT
+
+
+log = logging.getLogger('local')
+
+# Turn down Github logging
+ghlog = logging.getLogger('github3')
+ghlog.setLevel(logging.WARNING)
+
+# Turn down urllib3 logging
+urllib3log = logging.getLogger('requests.packages.urllib3')
+urllib3log.setLevel(logging.WARNING)
+
+# How often (in seconds) a running task checks if it has been stopped.
+STOP_CHECK_INTERVAL = 1
+
+# The variables from the worker's own environment that the Docker client
+# needs. Nothing else is passed on, because the worker's environment holds
+# BeeKeeper's secrets, and a task runs code from the repository it builds.
+DOCKER_CLIENT_ENVIRONMENT = ('HOME', 'DOCKER_HOST', 'DOCKER_CONFIG', 'DOCKER_CERT_PATH', 'DOCKER_TLS_VERIFY')
+
+
+class LocalBuildChecker(BuildChecker):
+    """Check the progress of builds whose tasks are run on this machine.
+
+    Tasks are run by a Celery worker on the `local` queue, which records
+    the exit code of each task when its process exits.
+    """
+    log = log
+
+    def start_task(self, task):
+        task.start()
+
+    def update_tasks(self):
+        build = self.build
+        # Record the outcome of tasks whose process has exited.
+        for task in build.tasks.exited():
+            task.finish()
+            task.save()
+            log.info("Build %s: Task %s finished (%s)" % (build, task, task.get_status_display()))
+            if task.status == Task.STATUS_DONE:
+                task.report(self.gh_repo)
+
+        # A task whose worker was killed will never record an outcome.
+        for task in build.tasks.lost():
+            log.info("Build %s: Lost the process running task %s" % (build, task))
+            task.status = Task.STATUS_ERROR
+            task.error = "Lost the process running the task."
+            task.save()
+
+    def stop_tasks(self):
+        build = self.build
+        for task in build.tasks.exited():
+            task.finish()
+            task.save()
+
+        for task in build.tasks.lost():
+            task.status = Task.STATUS_STOPPED
+            task.save()
+
+        for task in build.tasks.filter(status__in=(Task.STATUS_WAITING, Task.STATUS_RUNNING)):
+            task.stop()
+
+        stopping_tasks = build.tasks.stopping()
+        if stopping_tasks:
+            log.info("Build %s: Waiting for %s tasks to stop." % (build, stopping_tasks.count()))
+            return False
+        return True
+
+
+@app.task(
+    bind=True,
+    on_failure=on_check_build_failure
+)
+def check_build(self, build_pk):
+    build = Build.objects.get(pk=build_pk)
+
+    if LocalBuildChecker(build, github_repository(build)).check():
+        log.debug("Build %s: Schedule another check..." % build)
+        check_build.apply_async((build_pk,), countdown=5)
+
+    log.debug("Build %s: Check complete." % build)
+
+
+@app.task(bind=True)
+def run_task(self, task_pk):
+    """Run a task in a process of its own, writing its output to a file.
+
+    The outcome of the task is recorded on the next check of the build.
+    """
+    try:
+        task = Task.objects.get(pk=task_pk)
+    except Task.DoesNotExist:
+        log.info("Task %s appears to have been purged; nothing to run." % task_pk)
+        return
+
+    if task.status != Task.STATUS_WAITING:
+        log.info("Task %s:%s is no longer waiting to run." % (task.build, task))
+        return
+
+    environment = {
+        str(key): str(value)
+        for key, value in task.run_environment().items()
+    }
+    process_environment = {'PATH': os.environ.get('PATH', os.defpath)}
+    if settings.BEEKEEPER_LOCAL_RUNNER != 'subprocess':
+        process_environment.update(
+            (var, os.environ[var])
+            for var in DOCKER_CLIENT_ENVIRONMENT
+            if var in os.environ
+        )
+    process_environment.update(environment)
+    os.makedirs(os.path.dirname(task.log_path), exist_ok=True)
+
+    log.info("Running %s:%s..." % (task.build, task))
+    task.status = Task.STATUS_RUNNING
+    task.started = timezone.now()
+    task.save()
+
+    with open(task.log_path, 'wb') as logfile:
+        try:
+            process = subprocess.Popen(
+                task.command(environment),
+                env=process_environment,
+                stdout=logfile,
+                stderr=subprocess.STDOUT,
+            )
+        except OSError as e:
+            log.info("Unable to run %s:%s: %s" % (task.build, task, e))
+            task.error = "Unable to run task: %s" % e
+            process = None
+
+        stopping = False
+        while process is not None:
+            try:
+                process.wait(timeout=STOP_CHECK_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+
+            if stopping:
+                continue
+            if task.started + TASK_TIMEOUT < timezone.now():
+                log.info("Task %s:%s has exceeded maximum duration; stopping" % (task.build, task))
+                task.stop()
+            if Task.objects.filter(pk=task.pk, status=Task.STATUS_STOPPING).exists():
+                log.info("Stopping %s:%s..." % (task.build, task))
+                if settings.BEEKEEPER_LOCAL_RUNNER == 'subprocess':
+                    process.terminate()
+                else:
+                    # Stopping the Docker client doesn't stop the container.
+                    subprocess.run(['docker', 'stop', task.container_name])
+                stopping = True
+
+    # Use an update, so that a stop request made while the task was
+    # running isn't overwritten.
+    Task.objects.filter(pk=task.pk).update(
+        exit_code=process.returncode if process else None,
+        error=task.error,
+        completed=timezone.now(),
+    )
+    log.info("%s:%s exited with code %s." % (task.build, task, process.returncode if process else None))
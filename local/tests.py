@@ -0,0 +1,138 @@
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+from django.apps import apps
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from projects.models import Build
+from projects.tests.utils import create_build
+
+# The models of a build app can only be loaded when it is the app in use;
+# CI runs the tests once for each build app (see .travis.yml).
+if not apps.is_installed('local'):
+    raise unittest.SkipTest("BEEKEEPER_BUILD_APP isn't local.")
+
+from .models import Task
+from .tasks import LocalBuildChecker, run_task
+
+
+class RunTaskTests(TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_dir)
+        settings_override = override_settings(
+            BEEKEEPER_LOCAL_RUNNER='subprocess',
+            BEEKEEPER_LOCAL_LOG_DIR=self.log_dir,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.build = create_build()
+
+    def run_script(self, script, is_critical=True):
+        "Run a task that runs a Python script, and return the task."
+        task = self.build.tasks.create(
+            name='Script',
+            slug='script',
+            phase=0,
+            is_critical=is_critical,
+            environment={},
+            image='%s -c "%s"' % (sys.executable, script),
+            status=Task.STATUS_WAITING,
+            queued=timezone.now(),
+        )
+        with mock.patch.object(Task, 'run_environment', return_value={'TASK': 'script'}):
+            run_task(task.pk)
+        return Task.objects.get(pk=task.pk)
+
+    def test_pass(self):
+        task = self.run_script("import os; print('hello', os.environ['TASK'])")
+        self.assertEqual(task.status, Task.STATUS_RUNNING)
+        self.assertEqual(task.exit_code, 0)
+
+        # The outcome is recorded when the build is next checked.
+        self.assertEqual(list(Task.objects.exited()), [task])
+        task.finish()
+        self.assertEqual(task.status, Task.STATUS_DONE)
+        self.assertEqual(task.result, Build.RESULT_PASS)
+
+        self.assertEqual(task.read_log(), (b'hello script\n', 13))
+        self.assertEqual(task.read_log(13), (b'', 13))
+        self.assertEqual(task.matching_lines('HELLO'), [(1, 'hello script')])
+
+    def test_environment(self):
+        # The task doesn't see the worker's environment, or its secrets.
+        with mock.patch.dict('os.environ', {'SECRET_KEY': 'secret'}):
+            task = self.run_script("import os; print(os.environ.get('SECRET_KEY'), os.environ['TASK'])")
+
+        self.assertEqual(task.read_log()[0], b"None script\n")
+
+    def test_fail(self):
+        task = self.run_script("import sys; sys.exit(3)", is_critical=False)
+        self.assertEqual(task.exit_code, 3)
+
+        task.finish()
+        self.assertEqual(task.status, Task.STATUS_DONE)
+        self.assertEqual(task.result, Build.RESULT_NON_CRITICAL_FAIL)
+
+    def test_not_waiting(self):
+        task = self.build.tasks.create(
+            name='Script',
+            slug='script',
+            phase=0,
+            is_critical=True,
+            environment={},
+            image='%s -c "print()"' % sys.executable,
+            status=Task.STATUS_STOPPED,
+        )
+        run_task(task.pk)
+
+        task.refresh_from_db()
+        self.assertIsNone(task.completed)
+        self.assertEqual(task.read_log(), (b'', 0))
+
+    def test_reset(self):
+        task = self.run_script("print('hello')")
+        task.reset()
+
+        self.assertEqual(task.status, Task.STATUS_CREATED)
+        self.assertIsNone(task.exit_code)
+        self.assertEqual(task.read_log(), (b'', 0))
+
+
+class LostTaskTests(TestCase):
+    def setUp(self):
+        self.build = create_build()
+        for slug, started in [('recent', timedelta(minutes=5)), ('lost', timedelta(hours=2))]:
+            self.build.tasks.create(
+                name=slug.title(),
+                slug=slug,
+                phase=0,
+                is_critical=True,
+                environment={},
+                image='beekeeper/python',
+                status=Task.STATUS_RUNNING,
+                started=timezone.now() - started,
+            )
+
+    def test_lost(self):
+        self.assertEqual([task.slug for task in Task.objects.lost()], ['lost'])
+
+        LocalBuildChecker(self.build, gh_repo=None).update_tasks()
+
+        task = Task.objects.get(slug='lost')
+        self.assertEqual(task.status, Task.STATUS_ERROR)
+        self.assertEqual(task.error, 'Lost the process running the task.')
+        self.assertEqual(Task.objects.get(slug='recent').status, Task.STATUS_RUNNING)
+
+    def test_stop_lost(self):
+        Task.objects.filter(slug='recent').update(completed=timezone.now())
+
+        # Once the lost task is stopped, nothing is left running.
+        self.assertTrue(LocalBuildChecker(self.build, gh_repo=None).stop_tasks())
+        self.assertEqual(Task.objects.get(slug='lost').status, Task.STATUS_STOPPED)
@@ -0,0 +1,10 @@
+from django.conf.urls import url
+
+from projects import views as projects
+
+
+urlpatterns = [
+    url(r'^$', projects.current_tasks, name='current-tasks'),
+    url(r'^events$', projects.current_tasks_events, name='current-tasks-events'),
+    url(r'^search$', projects.search, name='search'),
+]
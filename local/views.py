@@ -0,0 +1,12 @@
+from django.http import FileResponse, Http404
+
+from projects.views import get_task
+
+
+def task_log(request, owner, repo_name, change_pk, build_pk, task_slug):
+    task = get_task(owner, repo_name, change_pk, build_pk, task_slug)
+
+    try:
+        return FileResponse(open(task.log_path, 'rb'), content_type="text/plain; charset=utf-8")
+    except FileNotFoundError:
+        raise Http404
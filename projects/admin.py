@@ -3,7 +3,7 @@ from django.conf import settings
 from django.contrib import admin, messages
 from django.utils.safestring import mark_safe
 
-from .models import Project, ProjectSetting, Change, Build
+from .models import Project, ProjectSetting, Change, Build, BranchStatus, CacheEntry
 
 
 def approve(modeladmin, request, queryset):
@@ -35,12 +35,30 @@ class ProjectSettingInline(admin.TabularInline):
 
 @admin.register(Project)
 class ProjectAdmin(admin.ModelAdmin):
-    list_display = ['repository', 'status']
+    list_display = ['repository', 'status', 'task_usage', 'build_usage']
     list_filter = ['status']
     raw_id_fields = ['repository']
     actions = [approve, attic, ignore]
     inlines = [ProjectSettingInline]
 
+    def running_tasks(self, project):
+        Task = apps.get_model(settings.BEEKEEPER_BUILD_APP, 'Task')
+        return Task.objects.using_capacity().filter(build__change__project=project)
+
+    def task_usage(self, project):
+        return '%s / %s' % (
+            self.running_tasks(project).count(),
+            project.max_concurrent_tasks if project.max_concurrent_tasks is not None else '-'
+        )
+    task_usage.short_description = 'Running tasks'
+
+    def build_usage(self, project):
+        return '%s / %s' % (
+            self.running_tasks(project).values('build').distinct().count(),
+            project.max_concurrent_builds if project.max_concurrent_builds is not None else '-'
+        )
+    build_usage.short_description = 'Running builds'
+
 
 @admin.register(ProjectSetting)
 class ProjectSettingAdmin(admin.ModelAdmin):
@@ -77,6 +95,13 @@ def restart_build(modeladmin, request, queryset):
 restart_build.short_description = "Restart build"
 
 
+def rerun_failed_tasks(modeladmin, request, queryset):
+    for obj in queryset:
+        obj.rerun_failed()
+        messages.info(request, 'Rerunning failed tasks of build %s' % obj)
+rerun_failed_tasks.short_description = "Rerun failed tasks"
+
+
 def resume_build(modeladmin, request, queryset):
     for obj in queryset:
         obj.resume()
@@ -99,10 +124,10 @@ class TaskInline(admin.TabularInline):
 
 @admin.register(Build)
 class BuildAdmin(admin.ModelAdmin):
-    list_display = ['display_pk', 'project', 'change', 'commit_sha', 'user_with_avatar', 'status', 'result']
+    list_display = ['display_pk', 'project', 'change', 'commit_sha', 'user_with_avatar', 'status', 'result', 'cost']
     list_filter = ['change__change_type', 'status']
     raw_id_fields = ['commit', 'change']
-    actions = [restart_build, resume_build, stop_build]
+    actions = [restart_build, rerun_failed_tasks, resume_build, stop_build]
     inlines = [TaskInline]
 
     def display_pk(self, build):
@@ -122,3 +147,17 @@ class BuildAdmin(admin.ModelAdmin):
             build.commit.user.avatar_url, build.commit.user, build.commit.user
         ))
     user_with_avatar.short_description = 'user'
+
+
+@admin.register(BranchStatus)
+class BranchStatusAdmin(admin.ModelAdmin):
+    list_display = ['project', 'branch_name', 'result', 'updated']
+    list_filter = ['result']
+    raw_id_fields = ['project', 'build']
+
+
+@admin.register(CacheEntry)
+class CacheEntryAdmin(admin.ModelAdmin):
+    list_display = ['project', 'namespace', 'key', 'size', 'last_used']
+    list_filter = ['project']
+    raw_id_fields = ['project']
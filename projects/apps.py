@@ -8,9 +8,19 @@ class ProjectsConfig(AppConfig):
         from django.db.models import signals as django
         from github import signals as github
         from github.models import Repository, Commit, PullRequestUpdate, Push
-        from .handlers import new_project, new_pull_request_build, new_push_build
+        from .handlers import (
+            new_project, new_pull_request_build, new_push_build, publish_build,
+            update_branch_status, clear_project_row, clear_change_row, clear_build_row
+        )
+        from .models import Project, Change, Build
 
         django.post_save.connect(new_project, sender=Repository)
+        django.post_save.connect(publish_build, sender=Build)
+        django.post_save.connect(update_branch_status, sender=Build)
+
+        django.post_save.connect(clear_project_row, sender=Project)
+        django.post_save.connect(clear_change_row, sender=Change)
+        django.post_save.connect(clear_build_row, sender=Build)
 
         github.new_build.connect(new_push_build, sender=Push)
         github.new_build.connect(new_pull_request_build, sender=PullRequestUpdate)
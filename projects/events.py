@@ -0,0 +1,114 @@
+import json
+import logging
+import time
+
+import redis
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+
+log = logging.getLogger('projects')
+
+# How long (in seconds) a single event stream is held open. Browsers
+# automatically reconnect when an event stream is closed. A stream holds
+# a thread of a web worker for its whole duration (see the Procfile), so
+# streams are kept short enough that a thread can't be held indefinitely.
+STREAM_DURATION = 20
+
+# How often (in seconds) a comment is sent to keep an idle stream alive.
+KEEPALIVE_INTERVAL = 15
+
+# How long (in milliseconds) browsers wait before reconnecting to a stream.
+RECONNECT_DELAY = 1000
+
+# How long (in milliseconds) browsers wait before reconnecting when events
+# aren't available. Pages that refresh their content when a stream is
+# opened fall back to polling at this interval.
+UNAVAILABLE_RECONNECT_DELAY = 30000
+
+# The channel that receives events about every task.
+ALL_TASKS = 'beekeeper:tasks'
+
+
+_connection = None
+
+
+def connection():
+    "Return a Redis connection that can be shared by the entire process."
+    global _connection
+    if _connection is None:
+        _connection = redis.StrictRedis.from_url(settings.REDIS_URL)
+    return _connection
+
+
+def channel(kind, pk):
+    "Return the name of the channel for events about a single object."
+    return 'beekeeper:%s:%s' % (kind, pk)
+
+
+def publish(channels, event, data):
+    """Publish an event to a list of channels.
+
+    Failure to publish is logged, but is otherwise ignored; an event
+    that can't be delivered shouldn't stop a build.
+    """
+    message = json.dumps({
+        'event': event,
+        'data': data,
+    })
+    try:
+        for name in channels:
+            connection().publish(name, message)
+    except redis.RedisError as e:
+        log.warning("Unable to publish %s event: %s" % (event, e))
+
+
+def stream(channels, duration=STREAM_DURATION):
+    """Generate a Server-Sent Events stream of events published to channels.
+
+    The stream is closed after `duration` seconds; browsers will then
+    reconnect to start a new stream. If Redis can't be reached, the stream
+    is closed straight away, and browsers are asked to wait a while before
+    reconnecting.
+    """
+    pubsub = connection().pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(*channels)
+    except redis.RedisError as e:
+        log.warning("Unable to subscribe to events: %s" % e)
+        pubsub.close()
+        yield 'retry: %s\n\n' % UNAVAILABLE_RECONNECT_DELAY
+        return
+
+    try:
+        # Ask the browser to reconnect promptly when the stream is closed.
+        yield 'retry: %s\n\n' % RECONNECT_DELAY
+
+        end = time.time() + duration
+        last_sent = time.time()
+        while time.time() < end:
+            message = pubsub.get_message(timeout=1.0)
+            if message:
+                payload = json.loads(message['data'].decode('utf-8'))
+                yield 'event: %s\ndata: %s\n\n' % (
+                    payload['event'], json.dumps(payload['data'])
+                )
+                last_sent = time.time()
+            elif time.time() - last_sent > KEEPALIVE_INTERVAL:
+                yield ': keepalive\n\n'
+                last_sent = time.time()
+    except redis.RedisError as e:
+        log.warning("Lost connection to events: %s" % e)
+        yield 'retry: %s\n\n' % UNAVAILABLE_RECONNECT_DELAY
+    finally:
+        pubsub.close()
+
+
+def event_response(channels):
+    "Return a streaming response of the events published to channels."
+    response = StreamingHttpResponse(stream(channels), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop proxies (e.g., nginx) from buffering the stream.
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,6 +1,11 @@
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.db import transaction
+
 from github.models import PullRequest
 
-from .models import Project, Change, Build
+from . import events
+from .models import Project, Change, Build, BranchStatus
 
 
 def new_project(sender, instance, created, *args, **kwargs):
@@ -80,3 +85,102 @@ def new_pull_request_build(sender, update=None, *args, **kwargs):
 
     except Project.DoesNotExist:
         pass
+
+
+def publish_build(sender, instance, *args, **kwargs):
+    """Publish the new state of a build to anyone watching it.
+
+    The event is published once the build has been committed, so watchers
+    never see a change that is rolled back.
+    """
+    build_pk = instance.pk
+    transaction.on_commit(lambda: _publish_build(build_pk))
+
+
+def _publish_build(build_pk):
+    try:
+        build = Build.objects.select_related(
+            'commit', 'change__project__repository__owner'
+        ).get(pk=build_pk)
+    except Build.DoesNotExist:
+        return
+
+    events.publish(
+        [
+            events.channel('build', build.pk),
+            events.channel('change', build.change_id),
+        ],
+        'build',
+        {
+            'pk': build.display_pk,
+            'url': build.get_absolute_url(),
+            'label': build.commit.display_sha,
+            'title': build.commit.title,
+            'timestamp': build.created.strftime('%-d %b %Y, %H:%M'),
+            'status': build.get_status_display(),
+            'full_status': build.full_status_display(),
+            'result': build.result,
+            'has_failures': build.has_failures,
+            'finished': build.is_finished,
+        }
+    )
+
+
+def update_branch_status(sender, instance, *args, **kwargs):
+    """Record the result of a push build when it finishes."""
+    build = instance
+    if not build.is_finished or build.change.change_type != Change.CHANGE_TYPE_PUSH:
+        return
+
+    project = build.change.project
+    branch_name = build.commit.branch_name
+    try:
+        status = BranchStatus.objects.select_related('build').get(
+            project=project,
+            branch_name=branch_name,
+        )
+        # Don't let an older build (e.g., one that has been restarted)
+        # replace the result of a newer build.
+        if status.build.created > build.created:
+            return
+        if status.build_id == build.pk and status.result == build.result:
+            return
+        status.build = build
+        status.result = build.result
+        status.save()
+    except BranchStatus.DoesNotExist:
+        BranchStatus.objects.create(
+            project=project,
+            branch_name=branch_name,
+            build=build,
+            result=build.result,
+        )
+
+    owner = project.repository.owner.login
+    repo_name = project.repository.name
+    cache.delete_many([
+        BranchStatus.cache_key(owner, repo_name, branch_name),
+        BranchStatus.cache_key(owner, repo_name),
+    ])
+
+
+def clear_project_row(sender, instance, *args, **kwargs):
+    """Clear the cached dashboard row for a project that has changed."""
+    cache.delete(make_template_fragment_key('project-row', [instance.pk]))
+
+
+def clear_change_row(sender, instance, *args, **kwargs):
+    """Clear the cached rows for a change that has changed.
+
+    The dashboard row for the project is also cleared, as it shows the
+    number of active changes.
+    """
+    cache.delete_many([
+        make_template_fragment_key('change-row', [instance.pk]),
+        make_template_fragment_key('project-row', [instance.project_id]),
+    ])
+
+
+def clear_build_row(sender, instance, *args, **kwargs):
+    """Clear the cached row for the change that a build belongs to."""
+    cache.delete(make_template_fragment_key('change-row', [instance.change_id]))
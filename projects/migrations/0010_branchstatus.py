@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 11:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Build statuses and change types, as defined on the models.
+FINISHED = (100, 200, 9999)
+CHANGE_TYPE_PUSH = 20
+
+
+def populate_branch_statuses(apps, schema_editor):
+    Build = apps.get_model('projects', 'Build')
+    BranchStatus = apps.get_model('projects', 'BranchStatus')
+
+    builds = Build.objects.filter(
+        change__change_type=CHANGE_TYPE_PUSH,
+        status__in=FINISHED,
+    ).select_related('change', 'commit').order_by('created')
+
+    statuses = {}
+    for build in builds.iterator():
+        statuses[(build.change.project_id, build.commit.branch_name)] = build
+
+    BranchStatus.objects.bulk_create([
+        BranchStatus(
+            project_id=project_id,
+            branch_name=branch_name,
+            build=build,
+            result=build.result,
+        )
+        for (project_id, branch_name), build in statuses.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0009_add_task_profiles'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BranchStatus',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('branch_name', models.CharField(max_length=100)),
+                ('result', models.IntegerField(choices=[(0, 'Pending'), (10, 'Fail'), (19, 'Non-critical Fail'), (20, 'Pass')])),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('build', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='projects.Build')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='branch_statuses', to='projects.Project')),
+            ],
+            options={
+                'verbose_name_plural': 'branch statuses',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='branchstatus',
+            unique_together=set([('project', 'branch_name')]),
+        ),
+        migrations.RunPython(populate_branch_statuses, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 11:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0010_branchstatus'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('namespace', models.CharField(max_length=100)),
+                ('key', models.CharField(max_length=64)),
+                ('archive', models.FileField(blank=True, max_length=255, upload_to='')),
+                ('size', models.BigIntegerField(default=0)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_used', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cache_entries', to='projects.Project')),
+            ],
+            options={
+                'verbose_name_plural': 'cache entries',
+                'ordering': ('-last_used',),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='cacheentry',
+            unique_together=set([('project', 'namespace', 'key')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 16:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0011_cacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='max_concurrent_builds',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='max_concurrent_tasks',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
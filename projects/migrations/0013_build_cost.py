@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 17:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0012_project_quotas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='build',
+            name='cost',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -1,8 +1,15 @@
 import uuid
+from datetime import timedelta
 
+from github3.exceptions import GitHubError
+
+from django.conf import settings
+from django.contrib.postgres import fields as postgres
+from django.core import signing
 from django.db import models
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.timesince import timesince
 
 from github import models as github
 
@@ -41,6 +48,11 @@ class Project(models.Model):
 
     repository = models.OneToOneField(github.Repository, related_name='project')
 
+    # Limits on the resources the project can use at any one time;
+    # None means there is no limit.
+    max_concurrent_tasks = models.IntegerField(null=True, blank=True)
+    max_concurrent_builds = models.IntegerField(null=True, blank=True)
+
     created = models.DateTimeField(default=timezone.now)
     updated = models.DateTimeField(auto_now=True)
 
@@ -171,6 +183,14 @@ class Change(models.Model):
                     'repo_name': self.project.repository.name,
                     'change_pk': str(self.pk),
                 })
+
+    def get_events_url(self):
+        return reverse('projects:change-events', kwargs={
+                    'owner': self.project.repository.owner.login,
+                    'repo_name': self.project.repository.name,
+                    'change_pk': str(self.pk),
+                })
+
     @property
     def latest_build(self):
         return self.builds.latest('updated')
@@ -296,16 +316,38 @@ class Build(models.Model):
 
     error = models.TextField(blank=True)
 
+    # The estimated cost (in US dollars) of running the build's tasks;
+    # recorded when the build finishes, if the build app knows it.
+    cost = models.FloatField(null=True, blank=True)
+
     class Meta:
         ordering = ('-updated',)
 
     def __str__(self):
         return self.display_pk
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Remember the last saved status and result, so we can tell
+        # whether a save actually changes anything visible on the change.
+        self._saved_state = (self.status, self.result)
+
     def save(self, *args, **kwargs):
+        is_new = self._state.adding
         super().save(*args, **kwargs)
-        # Bump the updated timestamp on the change
-        self.change.save()
+
+        # Bump the updated timestamp on the change - but only if this is a
+        # new build, or the status/result of the build has changed. Use a
+        # targeted update, rather than re-saving the entire change.
+        state = (self.status, self.result)
+        if is_new or state != self._saved_state:
+            Change.objects.filter(pk=self.change_id).update(updated=timezone.now())
+            self._saved_state = state
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        # The reloaded status and result are what's saved now.
+        self._saved_state = (self.status, self.result)
 
     def get_absolute_url(self):
         return reverse('projects:build', kwargs={
@@ -323,6 +365,14 @@ class Build(models.Model):
                     'build_pk': str(self.pk)
                 })
 
+    def get_events_url(self):
+        return reverse('projects:build-events', kwargs={
+                    'owner': self.change.project.repository.owner.login,
+                    'repo_name': self.change.project.repository.name,
+                    'change_pk': str(self.change.pk),
+                    'build_pk': str(self.pk)
+                })
+
     def get_code_url(self):
         return reverse('projects:build-code', kwargs={
                     'owner': self.change.project.repository.owner.login,
@@ -353,6 +403,10 @@ class Build(models.Model):
     def is_error(self):
         return self.status == Build.STATUS_ERROR
 
+    @property
+    def has_failures(self):
+        return self.result == Build.RESULT_FAIL
+
     @property
     def previous_success(self):
         try:
@@ -382,10 +436,43 @@ class Build(models.Model):
 
     def restart(self):
         if self.is_finished:
-            self.tasks.all().delete()
+            # Delete the tasks one at a time, so each task can clean up
+            # after itself (e.g., hand over a run that other tasks share).
+            for task in self.tasks.all():
+                task.delete()
             self.status = Build.STATUS_CREATED
             self.result = Build.RESULT_PENDING
             self.error = ''
+            self.cost = None
+            self.save()
+            self.start()
+
+    def rerun_failed(self):
+        """Rerun the tasks that failed or errored.
+
+        Tasks that passed keep their results; any tasks that didn't
+        finish (e.g., because the build was stopped, or never reached
+        their phase) are also run. The build resumes from the earliest
+        phase with a task to run.
+        """
+        if self.is_finished:
+            failed = self.tasks.filter(
+                models.Q(result=Build.RESULT_FAIL) | models.Q(status=BaseTask.STATUS_ERROR)
+            )
+            if not failed.exists():
+                return
+
+            for task in self.tasks.filter(
+                        models.Q(result=Build.RESULT_FAIL)
+                        | models.Q(status=BaseTask.STATUS_ERROR)
+                        | models.Q(result=Build.RESULT_PENDING)
+                    ):
+                task.reset()
+
+            self.status = Build.STATUS_CREATED
+            self.result = Build.RESULT_PENDING
+            self.error = ''
+            self.cost = None
             self.save()
             self.start()
 
@@ -394,6 +481,7 @@ class Build(models.Model):
             self.status = Build.STATUS_RUNNING
             self.result = Build.RESULT_PENDING
             self.error = ''
+            self.cost = None
             self.save()
             self.start()
 
@@ -408,3 +496,423 @@ class Build(models.Model):
         elif self.status == Build.STATUS_RUNNING:
             self.status = Build.STATUS_STOPPING
             self.save()
+
+
+class BranchStatus(models.Model):
+    """The result of the most recent finished push build on a branch.
+
+    This is a denormalized copy of information that could be computed
+    from the builds on a project, so that badges can be served cheaply.
+    """
+    project = models.ForeignKey(Project, related_name='branch_statuses')
+    branch_name = models.CharField(max_length=100)
+
+    build = models.ForeignKey(Build, related_name='+')
+    result = models.IntegerField(choices=Build.RESULT_CHOICES)
+
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'branch statuses'
+        unique_together = [('project', 'branch_name')]
+
+    def __str__(self):
+        return '%s:%s' % (self.project, self.branch_name)
+
+    @staticmethod
+    def cache_key(owner, repo_name, branch_name=None):
+        """The cache key for the shield status of a branch.
+
+        The key is built from request parameters, so a cached shield can
+        be found without touching the database. A branch_name of None
+        is the project's default branch.
+        """
+        return 'projects:shield:%s/%s:%s' % (owner, repo_name, branch_name or '')
+
+
+class CacheEntry(models.Model):
+    """A tarball of dependencies, cached by a task for use by later builds.
+
+    Entries are stored in a namespace (the task slug) for each project,
+    under a key computed from the files that define the dependencies.
+    """
+    # The salt used to sign cache URLs, and how long (in seconds)
+    # a signed URL is valid.
+    SIGNING_SALT = 'projects.cache'
+    MAX_AGE = 24 * 60 * 60
+
+    project = models.ForeignKey(Project, related_name='cache_entries')
+    namespace = models.CharField(max_length=100)
+    key = models.CharField(max_length=64)
+
+    archive = models.FileField(max_length=255, blank=True)
+    size = models.BigIntegerField(default=0)
+
+    created = models.DateTimeField(default=timezone.now)
+    last_used = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        verbose_name_plural = 'cache entries'
+        ordering = ('-last_used',)
+        unique_together = [('project', 'namespace', 'key')]
+
+    def __str__(self):
+        return '%s:%s:%s' % (self.project, self.namespace, self.key)
+
+    @staticmethod
+    def get_url(project, namespace, key, writable=False):
+        """The URL a task can use to retrieve (and, if writable, store) a
+        cache entry.
+
+        The URL contains a signed token, so a task can't use it to access
+        any other cache entry, or to store an entry if it isn't writable.
+        """
+        return reverse('projects:cache', kwargs={
+                'owner': project.repository.owner.login,
+                'repo_name': project.repository.name,
+                'token': signing.dumps(
+                    [project.pk, namespace, key, writable],
+                    salt=CacheEntry.SIGNING_SALT,
+                ),
+            })
+
+    @property
+    def archive_name(self):
+        return 'caches/%s/%s/%s.tar.gz' % (
+            self.project_id, self.namespace.replace(':', '/'), self.key
+        )
+
+    def delete(self, *args, **kwargs):
+        self.archive.delete(save=False)
+        super().delete(*args, **kwargs)
+
+    @staticmethod
+    def evict(project_id, max_size):
+        """Delete the least recently used entries for a project, until the
+        total size of the project's cache is no more than max_size."""
+        total = 0
+        for entry in CacheEntry.objects.filter(project_id=project_id).order_by('-last_used'):
+            total += entry.size
+            if total > max_size:
+                entry.delete()
+
+
+class BaseTaskQuerySet(models.QuerySet):
+    def started(self):
+        return self.filter(status__in=(
+                    BaseTask.STATUS_WAITING,
+                    BaseTask.STATUS_RUNNING,
+                ))
+
+    def not_finished(self):
+        return self.filter(status__in=(
+                    BaseTask.STATUS_WAITING,
+                    BaseTask.STATUS_RUNNING,
+                    BaseTask.STATUS_STOPPING,
+                ))
+
+    def created(self):
+        return self.filter(status=BaseTask.STATUS_CREATED)
+
+    def waiting(self):
+        return self.filter(status=BaseTask.STATUS_WAITING)
+
+    def running(self):
+        return self.filter(status=BaseTask.STATUS_RUNNING)
+
+    def stopping(self):
+        return self.filter(status=BaseTask.STATUS_STOPPING)
+
+    def finished(self):
+        return self.filter(status__in=[
+                                BaseTask.STATUS_DONE,
+                                BaseTask.STATUS_ERROR,
+                                BaseTask.STATUS_STOPPED,
+                            ])
+
+    def recently_finished(self):
+        return self.filter(
+            status__in=[
+                BaseTask.STATUS_DONE,
+                BaseTask.STATUS_ERROR,
+                BaseTask.STATUS_STOPPED,
+            ],
+            updated__gt=timezone.now() - timedelta(hours=1)
+        )
+
+    def done(self):
+        return self.filter(status=BaseTask.STATUS_DONE)
+
+    def error(self):
+        return self.filter(status=BaseTask.STATUS_ERROR)
+
+    def failed(self):
+        return self.filter(result=Build.RESULT_FAIL)
+
+
+class BaseTask(models.Model):
+    """The parts of a task that are the same in every build app.
+
+    Each build app provides a Task model that extends this with the
+    details of how the app runs its tasks.
+    """
+    STATUS_CREATED = Build.STATUS_CREATED
+    STATUS_WAITING = Build.STATUS_WAITING
+    STATUS_RUNNING = Build.STATUS_RUNNING
+    STATUS_DONE = Build.STATUS_DONE
+    STATUS_ERROR = Build.STATUS_ERROR
+    STATUS_STOPPING = Build.STATUS_STOPPING
+    STATUS_STOPPED = Build.STATUS_STOPPED
+
+    STATUS_CHOICES = [
+        (STATUS_CREATED, 'Created'),
+        (STATUS_WAITING, 'Waiting'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_ERROR, 'Error'),
+        (STATUS_STOPPING, 'Stopping'),
+        (STATUS_STOPPED, 'Stopped'),
+    ]
+    objects = BaseTaskQuerySet.as_manager()
+
+    build = models.ForeignKey(Build, related_name='tasks')
+    status = models.IntegerField(choices=STATUS_CHOICES, default=STATUS_CREATED)
+    result = models.IntegerField(choices=Build.RESULT_CHOICES, default=Build.RESULT_PENDING)
+
+    name = models.CharField(max_length=100, db_index=True)
+    slug = models.CharField(max_length=100, db_index=True)
+
+    phase = models.IntegerField()
+    is_critical = models.BooleanField()
+    queued = models.DateTimeField(null=True, blank=True)
+    started = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+    completed = models.DateTimeField(null=True, blank=True)
+
+    environment = postgres.JSONField(blank=True)
+    profile_slug = models.CharField(max_length=100, default='default')
+    image = models.CharField(max_length=100)
+
+    error = models.TextField(blank=True)
+
+    class Meta:
+        abstract = True
+        ordering = ('phase', 'name',)
+        unique_together = [('build', 'slug')]
+
+    def get_absolute_url(self):
+        return reverse('projects:task', kwargs={
+                    'owner': self.build.change.project.repository.owner.login,
+                    'repo_name': self.build.change.project.repository.name,
+                    'change_pk': str(self.build.change.pk),
+                    'build_pk': str(self.build.pk),
+                    'task_slug': self.slug
+                })
+
+    def get_status_url(self):
+        return reverse('projects:task-status', kwargs={
+                    'owner': self.build.change.project.repository.owner.login,
+                    'repo_name': self.build.change.project.repository.name,
+                    'change_pk': str(self.build.change.pk),
+                    'build_pk': str(self.build.pk),
+                    'task_slug': self.slug
+                })
+
+    def get_events_url(self):
+        return reverse('projects:task-events', kwargs={
+                    'owner': self.build.change.project.repository.owner.login,
+                    'repo_name': self.build.change.project.repository.name,
+                    'change_pk': str(self.build.change.pk),
+                    'build_pk': str(self.build.pk),
+                    'task_slug': self.slug
+                })
+
+    def get_log_url(self):
+        return reverse('projects:task-log', kwargs={
+                    'owner': self.build.change.project.repository.owner.login,
+                    'repo_name': self.build.change.project.repository.name,
+                    'change_pk': str(self.build.change.pk),
+                    'build_pk': str(self.build.pk),
+                    'task_slug': self.slug
+                })
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def has_started(self):
+        return self.status in [
+            BaseTask.STATUS_RUNNING,
+            BaseTask.STATUS_DONE,
+            BaseTask.STATUS_ERROR,
+        ]
+
+    @property
+    def is_finished(self):
+        return self.status in (
+            BaseTask.STATUS_DONE,
+            BaseTask.STATUS_ERROR,
+            BaseTask.STATUS_STOPPED
+        )
+
+    @property
+    def has_error(self):
+        return self.status == BaseTask.STATUS_ERROR
+
+    @property
+    def log_source(self):
+        "The task whose run (and log) this task is using."
+        return self
+
+    @property
+    def base_slug(self):
+        "The slug of the task, as it appears in the build configuration."
+        return self.slug
+
+    @property
+    def descriptor(self):
+        "The name used to look up project settings for the task."
+        if '/' in self.image:
+            return self.image.split('/')[1]
+        return self.image
+
+    def full_status_display(self):
+        if self.status == BaseTask.STATUS_ERROR:
+            return "Error: %s" % self.error
+        elif self.status == BaseTask.STATUS_WAITING:
+            return "Waiting (for %s)" % timesince(self.queued)
+        elif self.status == BaseTask.STATUS_RUNNING:
+            return "Running (for %s)" % timesince(self.started)
+        elif self.status == BaseTask.STATUS_DONE:
+            return "Done (Task took %s)" % timesince(self.started, now=self.completed)
+        else:
+            return self.get_status_display()
+
+    def build_environment(self):
+        "The environment variables that describe the build the task is part of."
+        if self.build.change.is_pull_request:
+            pr_number = self.build.change.pull_request.number
+        else:
+            pr_number = ''
+
+        return {
+            'GITHUB_OWNER': self.build.commit.repository.owner.login,
+            'GITHUB_PROJECT_NAME': self.build.commit.repository.name,
+            'GITHUB_PR_NUMBER': pr_number,
+            'CODE_URL': settings.BEEKEEPER_URL + self.build.get_code_url(),
+            'SHA': self.build.commit.sha,
+            'TASK': self.base_slug.split(':')[-1],
+        }
+
+    def run_environment(self):
+        "The environment variables the task will be run with."
+        environment = self.build_environment()
+
+        # Add environment variables from the project configuration.
+        # Include, in order:
+        #  * Global variables for all tasks
+        #  * Global variables for a specific task
+        #  * Project variables for all tasks
+        #  * Project variables for a specific task
+        for project in [None, self.build.change.project]:
+            for descriptor in ['*', self.descriptor]:
+                for var in ProjectSetting.objects.filter(project=project, descriptor=descriptor):
+                    environment[var.key] = var.value
+
+        # Add environment variables from the task configuration
+        environment.update(self.environment)
+
+        return environment
+
+    def read_new_log(self, offset=0):
+        """Read the log of the task, starting at the given offset.
+
+        Returns the log data, the offset that should be used for the next
+        read, and whether the whole log has been read.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def search_logs(cls, query, max_tasks):
+        """Find the tasks whose logs contain the query.
+
+        Returns a list of up to max_tasks results, most recent first. Each
+        result has the task, and the (line number, line) pairs that match.
+        By default, the log chunks recorded for each task are searched.
+        """
+        LogChunk = cls._meta.get_field('log_chunks').related_model
+
+        # Chunks are created as tasks run, so the most recent chunks
+        # are the ones with the highest primary keys.
+        chunks = LogChunk.objects.filter(
+                        content__icontains=query
+                    ).select_related(
+                        'task__build__commit',
+                        'task__build__change__project__repository__owner',
+                    ).order_by('-pk')
+
+        tasks = {}
+        results = []
+        for chunk in chunks.iterator():
+            try:
+                result = tasks[chunk.task_id]
+            except KeyError:
+                if len(tasks) == max_tasks:
+                    break
+                result = {
+                    'task': chunk.task,
+                    'lines': [],
+                }
+                tasks[chunk.task_id] = result
+                results.append(result)
+
+            result['lines'].extend(chunk.matching_lines(query))
+
+        for result in results:
+            result['lines'].sort()
+        return results
+
+    def stop(self):
+        """Stop the task.
+
+        A task that hasn't started is stopped immediately; otherwise, the
+        task is stopping until whatever is running it confirms it has stopped.
+        """
+        if self.status in (BaseTask.STATUS_CREATED, BaseTask.STATUS_WAITING):
+            self.status = BaseTask.STATUS_STOPPED
+        else:
+            self.status = BaseTask.STATUS_STOPPING
+        self.save()
+
+    def reported_status(self):
+        "The name, result, and URL of the status reported to GitHub."
+        return self.name, self.result, settings.BEEKEEPER_URL + self.get_absolute_url()
+
+    def report(self, gh_repo):
+        """Report the status of this task to GitHub
+
+        gh_repo: An active GitHub API session.
+        """
+        name, result, target_url = self.reported_status()
+
+        gh_commit = gh_repo.commit(self.build.commit.sha)
+        url = gh_commit._api.replace('commits', 'statuses')
+        payload = {
+            'context': '%s:%s/%s' % (settings.BEEKEEPER_NAMESPACE, self.phase, self.base_slug),
+            'state': {
+                Build.RESULT_PENDING: 'pending',
+                Build.RESULT_FAIL: 'failure',
+                Build.RESULT_NON_CRITICAL_FAIL: 'success',
+                Build.RESULT_PASS: 'success',
+            }[result],
+            'target_url': target_url,
+            'description': {
+                Build.RESULT_PENDING: '%s pending...' % name,
+                Build.RESULT_FAIL: '%s failed! Click for details.' % name,
+                Build.RESULT_NON_CRITICAL_FAIL: '%s: non-critical problem found. Click for details.' % name,
+                Build.RESULT_PASS: '%s passed.' % name,
+            }[result],
+        }
+        response = gh_commit._post(url, payload)
+        if not response.ok:
+            raise GitHubError(response.reason)
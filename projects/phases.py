@@ -0,0 +1,251 @@
+import logging
+
+from github3 import GitHub
+
+import requests
+import yaml
+
+from django.conf import settings
+
+from beekeeper.config import load_task_configs
+
+from .models import Change, Build
+from .storage import mirror_archive
+
+
+log = logging.getLogger('projects')
+
+
+def github_repository(build):
+    "Open a GitHub API session for the repository that a build is building."
+    gh_session = GitHub(
+            settings.GITHUB_USERNAME,
+            password=settings.GITHUB_ACCESS_TOKEN
+        )
+    return gh_session.repository(
+            build.change.project.repository.owner.login,
+            build.change.project.repository.name
+        )
+
+
+def on_check_build_failure(self, exc, task_id, args, kwargs, einfo):
+    build = Build.objects.get(pk=args[0])
+    log.error("Error checking build %s: %s" % (build, str(exc)))
+    build.status = Build.STATUS_ERROR
+    build.error = str(exc)
+    build.save()
+
+
+class BuildChecker:
+    """Move a build through the phases of its tasks.
+
+    Each build app subclasses this with the details of how its tasks
+    are started, how the outcome of a running task is found, and how
+    running tasks are stopped.
+    """
+    # Build apps log the progress of builds to a logger of their own.
+    log = log
+
+    def __init__(self, build, gh_repo):
+        self.build = build
+        self.gh_repo = gh_repo
+
+    def create_task(self, task_config):
+        """Create the task described by a task configuration.
+
+        By default, tasks don't share a dependency cache, and each task
+        is run in a single piece.
+        """
+        task_config.pop('cache')
+        task_config.pop('shard_target')
+        task_config.pop('speculate_after')
+        if task_config.pop('shards') != 1:
+            # Run a sharded task as a single shard that does all the work.
+            task_config['environment'].update({
+                'SHARD_INDEX': 0,
+                'SHARD_TOTAL': 1,
+            })
+
+        self.log.debug("Created phase %(phase)s task %(name)s" % task_config)
+        task = self.build.tasks.create(**task_config)
+        task.report(self.gh_repo)
+
+    def order(self, tasks):
+        "Order a queryset of tasks that are about to be started."
+        return tasks
+
+    def start_task(self, task):
+        raise NotImplementedError()
+
+    def update_tasks(self):
+        "Record what has happened to the started tasks of a running build."
+        raise NotImplementedError()
+
+    def phase_running(self):
+        "Called on each check of a build while a phase is still running."
+        pass
+
+    def stop_tasks(self):
+        """Stop the tasks of a stopping build.
+
+        Returns True once there are no tasks left running.
+        """
+        raise NotImplementedError()
+
+    def build_finished(self):
+        "Called on each check of a build that has finished."
+        pass
+
+    def check(self):
+        """Check on the progress of the build, and start its next phase.
+
+        Returns True if the build needs to be checked again.
+        """
+        build = self.build
+        if build.status == Build.STATUS_CREATED:
+            self.start_build()
+
+        elif build.status == Build.STATUS_RUNNING:
+            self.log.info("Build %s: Checking status of build..." % build)
+            self.update_tasks()
+            self.advance()
+
+        elif build.status == Build.STATUS_STOPPING:
+            self.log.info("Build %s: Stopping..." % build)
+            if self.stop_tasks():
+                self.log.info("Build %s: There are no tasks running; Build has been stopped." % build)
+                build.status = Build.STATUS_STOPPED
+                build.save()
+
+        if build.status in (Build.STATUS_DONE, Build.STATUS_ERROR, Build.STATUS_STOPPED):
+            self.build_finished()
+            return False
+        return True
+
+    def create_tasks(self):
+        build = self.build
+
+        # Download the config file from Github.
+        content = self.gh_repo.contents('beekeeper.yml', ref=build.commit.sha)
+        if content is None:
+            raise ValueError("Repository doesn't contain BeeKeeper config file.")
+
+        # Parse the raw configuration content and extract the appropriate phase.
+        config = yaml.load(content.decoded.decode('utf-8'))
+        if build.change.change_type == Change.CHANGE_TYPE_PULL_REQUEST:
+            phases = config.get('pull_request', [])
+        elif build.change.change_type == Change.CHANGE_TYPE_PUSH:
+            phases = config.get('push', [])
+
+        # Parse the phase configuration and create tasks
+        for task_config in load_task_configs(phases):
+            self.create_task(task_config)
+
+    def start_build(self):
+        build = self.build
+        self.log.info("Build %s: Starting..." % build)
+        # Record that the build has started.
+        build.status = Build.STATUS_RUNNING
+        build.save()
+
+        # Mirror the source archive, so that tasks can retrieve the code
+        # from file storage, rather than from Github. If this fails, tasks
+        # will fall back to retrieving the code from Github.
+        self.log.debug("Build %s: Mirroring source archive..." % build)
+        try:
+            mirror_archive(
+                build.change.project.repository.owner.login,
+                build.change.project.repository.name,
+                build.commit.sha,
+            )
+        except requests.RequestException as e:
+            self.log.warning("Build %s: Unable to mirror source archive: %s" % (build, e))
+
+        if build.tasks.exists():
+            # The build is rerunning some of its tasks; the rest of the
+            # tasks keep their results.
+            self.log.debug("Build %s: Rerunning tasks..." % build)
+            for task in build.tasks.created():
+                task.report(self.gh_repo)
+        else:
+            # Retrieve task definition
+            self.log.debug("Build %s: Creating task definitions..." % build)
+            self.create_tasks()
+
+        # Start the tasks in the earliest phase that hasn't run; on a
+        # new build, that's the tasks with no prerequisites.
+        self.log.debug("Build %s: Starting initial tasks..." % build)
+        initial_tasks = self.order(build.tasks.filter(
+                            status=Build.STATUS_CREATED,
+                            phase=min(build.tasks.created().values_list('phase', flat=True), default=0)
+                        ))
+        if initial_tasks:
+            for task in initial_tasks:
+                self.log.info("Build %s: Starting task %s..." % (build, task.name))
+                self.start_task(task)
+        else:
+            raise ValueError("No phase 0 tasks defined for build type '%s'" % build.change.change_type)
+
+    def advance(self):
+        "Wait for the running phase to finish, then start the next phase."
+        build = self.build
+
+        # If there are still tasks running, wait for them to finish.
+        unfinished_tasks = build.tasks.not_finished()
+        if unfinished_tasks.exists():
+            running_phase = max(unfinished_tasks.values_list('phase', flat=True))
+            self.log.info("Build %s: Still waiting for %s tasks in phase %s to complete." % (
+                build, len(unfinished_tasks), running_phase)
+            )
+            self.phase_running()
+            return
+
+        # There are no unfinished tasks.
+        # If there have been any failures or task errors, stop right now.
+        # Otherwise, start the tasks for the next phase.
+        finished_tasks = build.tasks.finished()
+        finished_phase = max(finished_tasks.values_list('phase', flat=True))
+
+        if finished_tasks.error().exists():
+            self.log.info("Build %s: Errors encountered during phase %s" % (build, finished_phase))
+            new_tasks = None
+            build.status = Build.STATUS_ERROR
+            build.result = Build.RESULT_FAIL
+            build.error = "%s tasks generated errors" % build.tasks.error().count()
+        elif finished_tasks.failed().exists():
+            self.log.info("Build %s: Failures encountered during phase %s" % (build, finished_phase))
+            new_tasks = None
+            build.status = Build.STATUS_DONE
+            build.result = Build.RESULT_FAIL
+        else:
+            # Start the earliest phase that has tasks waiting to run.
+            # Some tasks in that phase may already have been started
+            # speculatively.
+            new_tasks = self.order(build.tasks.filter(
+                            status=Build.STATUS_CREATED,
+                            phase=min(
+                                build.tasks.created().values_list('phase', flat=True),
+                                default=finished_phase + 1
+                            )
+                        ))
+
+        if new_tasks:
+            self.log.debug("Build %s: Starting new tasks..." % build)
+            for task in new_tasks:
+                self.log.info("Build %s: Starting task %s..." % (build, task.name))
+                self.start_task(task)
+        elif new_tasks is None:
+            self.log.info("Build %s: Aborted." % build)
+            build.save()
+        else:
+            self.log.info("Build %s: No new tasks required." % build)
+            build.status = Build.STATUS_DONE
+            build.result = min(
+                t.result
+                for t in build.tasks.all()
+                if t.result != Build.RESULT_PENDING
+            )
+
+            build.save()
+            self.log.info("Build %s: Status %s" % (build, build.get_status_display()))
+            self.log.info("Build %s: Result %s" % (build, build.get_result_display()))
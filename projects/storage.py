@@ -0,0 +1,73 @@
+import logging
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+import requests
+
+
+log = logging.getLogger('projects')
+
+# The size (in bytes) of each piece of a source archive downloaded
+# from Github.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def read_range(name, start, length, storage=default_storage):
+    """Read part of a stored file.
+
+    If the storage is backed by S3, this makes a ranged request for the
+    bytes that are required, rather than retrieving the entire object.
+
+    name: The name of the file in storage.
+    start: The byte offset of the first byte to read.
+    length: The number of bytes to read.
+    storage: The storage that holds the file.
+    """
+    bucket = getattr(storage, 'bucket', None)
+    if bucket is not None:
+        key = storage._normalize_name(storage._clean_name(name))
+        response = bucket.Object(key).get(
+            Range='bytes=%s-%s' % (start, start + length - 1)
+        )
+        return response['Body'].read()
+
+    with storage.open(name, 'rb') as stored_file:
+        stored_file.seek(start)
+        return stored_file.read(length)
+
+
+def archive_name(owner, repo_name, sha):
+    "The name of the mirrored source archive for a commit."
+    return 'archives/%s/%s/%s.zip' % (owner, repo_name, sha)
+
+
+def mirror_archive(owner, repo_name, sha, storage=default_storage):
+    """Copy the Github source archive for a commit into file storage.
+
+    Archives are content-addressed by commit SHA, so an archive that
+    has already been mirrored is never retrieved again.
+
+    Returns the name of the archive in storage.
+    """
+    name = archive_name(owner, repo_name, sha)
+    if storage.exists(name):
+        return name
+
+    response = requests.get(
+        'https://github.com/%s/%s/archive/%s.zip' % (owner, repo_name, sha),
+        auth=(settings.GITHUB_USERNAME, settings.GITHUB_ACCESS_TOKEN),
+        stream=True,
+    )
+    response.raise_for_status()
+
+    with tempfile.TemporaryFile() as archive:
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            archive.write(chunk)
+        archive.seek(0)
+        name = storage.save(name, File(archive))
+
+    log.info("Mirrored source archive %s" % name)
+    return name
@@ -8,6 +8,8 @@ from projects.models import Build
 
 register = template.Library()
 
+BUILD_STATUSES = dict(Build.STATUS_CHOICES)
+
 
 @register.simple_tag
 def result(value):
@@ -21,3 +23,8 @@ def result(value):
         return mark_safe('<i class="fa fa-2x fa-check-circle pass" aria-hidden="true"></i>')
     else:
         return mark_safe('<i class="fa fa-2x fa-question-circle fail" aria-hidden="true"></i>')
+
+
+@register.simple_tag
+def build_status(value):
+    return BUILD_STATUSES.get(value, '')
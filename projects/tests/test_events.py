@@ -0,0 +1,202 @@
+import json
+from unittest import mock
+
+import redis
+
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+
+from .. import events
+from .utils import create_build
+
+
+class FakePubSub:
+    "A Redis subscription that delivers a list of messages."
+    def __init__(self, clock, messages, error=None):
+        self.clock = clock
+        self.messages = list(messages)
+        self.error = error
+        self.channels = None
+        self.closed = False
+
+    def subscribe(self, *channels):
+        if self.error:
+            raise self.error
+        self.channels = channels
+
+    def get_message(self, timeout):
+        # Waiting for a message takes the full timeout, unless there is
+        # a message to deliver.
+        if self.messages:
+            return {'data': self.messages.pop(0)}
+        self.clock.now += timeout
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRedis:
+    "A Redis connection that records what is published to it."
+    def __init__(self, clock, messages=(), error=None):
+        self.clock = clock
+        self.messages = messages
+        self.error = error
+        self.published = []
+        self.pubsubs = []
+
+    def publish(self, channel, message):
+        if self.error:
+            raise self.error
+        self.published.append((channel, json.loads(message)))
+
+    def pubsub(self, ignore_subscribe_messages):
+        pubsub = FakePubSub(self.clock, self.messages, error=self.error)
+        self.pubsubs.append(pubsub)
+        return pubsub
+
+
+class FakeClock:
+    "A replacement for the time module, so that streams don't take real time."
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class EventTestCase(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(events, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def use_redis(self, connection):
+        patcher = mock.patch.object(events, 'connection', return_value=connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return connection
+
+    def message(self, event, data):
+        return json.dumps({'event': event, 'data': data}).encode('utf-8')
+
+
+class PublishTests(EventTestCase):
+    def test_publish(self):
+        connection = self.use_redis(FakeRedis(self.clock))
+        events.publish(['beekeeper:build:1', events.ALL_TASKS], 'build', {'pk': 1})
+
+        self.assertEqual(connection.published, [
+            ('beekeeper:build:1', {'event': 'build', 'data': {'pk': 1}}),
+            (events.ALL_TASKS, {'event': 'build', 'data': {'pk': 1}}),
+        ])
+
+    def test_unavailable(self):
+        self.use_redis(FakeRedis(self.clock, error=redis.ConnectionError('Connection refused')))
+        with self.assertLogs('projects', 'WARNING'):
+            events.publish(['beekeeper:build:1'], 'build', {'pk': 1})
+
+
+class StreamTests(EventTestCase):
+    def test_events(self):
+        connection = self.use_redis(FakeRedis(self.clock, messages=[
+            self.message('build', {'pk': 1}),
+            self.message('task', {'pk': 2}),
+        ]))
+        content = list(events.stream(['beekeeper:build:1']))
+
+        self.assertEqual(content[:3], [
+            'retry: %s\n\n' % events.RECONNECT_DELAY,
+            'event: build\ndata: {"pk": 1}\n\n',
+            'event: task\ndata: {"pk": 2}\n\n',
+        ])
+        self.assertEqual(connection.pubsubs[0].channels, ('beekeeper:build:1',))
+        self.assertTrue(connection.pubsubs[0].closed)
+
+    def test_expiry(self):
+        self.use_redis(FakeRedis(self.clock))
+        start = self.clock.now
+        list(events.stream(['beekeeper:build:1'], duration=5))
+
+        self.assertEqual(self.clock.now - start, 5)
+
+    def test_keepalive(self):
+        self.use_redis(FakeRedis(self.clock))
+        content = list(events.stream(['beekeeper:build:1'], duration=40))
+
+        # A keepalive is sent after each 15 seconds without an event.
+        self.assertEqual(content, [
+            'retry: %s\n\n' % events.RECONNECT_DELAY,
+            ': keepalive\n\n',
+            ': keepalive\n\n',
+        ])
+
+    def test_unavailable(self):
+        connection = self.use_redis(FakeRedis(self.clock, error=redis.ConnectionError('Connection refused')))
+        with self.assertLogs('projects', 'WARNING'):
+            content = list(events.stream(['beekeeper:build:1']))
+
+        # The browser is asked to wait before it tries again.
+        self.assertEqual(content, ['retry: %s\n\n' % events.UNAVAILABLE_RECONNECT_DELAY])
+        self.assertTrue(connection.pubsubs[0].closed)
+
+    def test_connection_lost(self):
+        connection = self.use_redis(FakeRedis(self.clock))
+        stream = events.stream(['beekeeper:build:1'])
+        self.assertEqual(next(stream), 'retry: %s\n\n' % events.RECONNECT_DELAY)
+
+        connection.pubsubs[0].get_message = mock.Mock(side_effect=redis.ConnectionError('Connection lost'))
+        with self.assertLogs('projects', 'WARNING'):
+            content = list(stream)
+
+        self.assertEqual(content, ['retry: %s\n\n' % events.UNAVAILABLE_RECONNECT_DELAY])
+        self.assertTrue(connection.pubsubs[0].closed)
+
+
+class EventViewTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(events, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.redis = FakeRedis(self.clock)
+        patcher = mock.patch.object(events, 'connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.build = create_build()
+        self.task = self.build.tasks.create(
+            name='Test',
+            slug='test',
+            phase=0,
+            is_critical=True,
+            environment={},
+            image='beekeeper/python',
+        )
+
+    def test_task_events(self):
+        response = self.client.get(self.task.get_events_url())
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        content = b''.join(response.streaming_content)
+        self.assertTrue(content.startswith(b'retry: '))
+        self.assertEqual(self.redis.pubsubs[0].channels, (events.channel('task', self.task.pk),))
+
+    def test_unknown_task(self):
+        response = self.client.get(reverse('projects:task-events', kwargs={
+            'owner': 'pybee',
+            'repo_name': 'repo-0',
+            'change_pk': str(self.build.change.pk),
+            'build_pk': str(self.build.pk),
+            'task_slug': 'unknown',
+        }))
+        self.assertEqual(response.status_code, 404)
+
+    def test_current_tasks_events(self):
+        response = self.client.get(reverse('tasks:current-tasks-events'))
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        b''.join(response.streaming_content)
+        self.assertEqual(self.redis.pubsubs[0].channels, (events.ALL_TASKS,))
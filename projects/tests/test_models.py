@@ -0,0 +1,45 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from ..models import Build, Change
+from .utils import create_build
+
+
+class BuildSaveTests(TestCase):
+    def setUp(self):
+        self.build = create_build()
+        # Move the change into the past, so a bump is easy to see.
+        self.earlier = timezone.now() - timedelta(hours=1)
+        Change.objects.filter(pk=self.build.change_id).update(updated=self.earlier)
+
+    def change_updated(self):
+        return Change.objects.get(pk=self.build.change_id).updated
+
+    def test_status_change(self):
+        self.build.status = Build.STATUS_DONE
+        self.build.save()
+        self.assertGreater(self.change_updated(), self.earlier)
+
+    def test_result_change(self):
+        self.build.result = Build.RESULT_FAIL
+        self.build.save()
+        self.assertGreater(self.change_updated(), self.earlier)
+
+    def test_other_change(self):
+        self.build.save()
+        self.assertEqual(self.change_updated(), self.earlier)
+
+    def test_refreshed(self):
+        # Another process finishes the build; saving the reloaded build
+        # doesn't change anything.
+        Build.objects.filter(pk=self.build.pk).update(status=Build.STATUS_DONE)
+        self.build.refresh_from_db()
+        self.build.save()
+        self.assertEqual(self.change_updated(), self.earlier)
+
+        # ...but changing it back to running does.
+        self.build.status = Build.STATUS_RUNNING
+        self.build.save()
+        self.assertGreater(self.change_updated(), self.earlier)
@@ -0,0 +1,73 @@
+from django.test import TestCase
+
+from ..models import Build
+from ..phases import BuildChecker
+from .utils import create_build
+
+
+class RecordingChecker(BuildChecker):
+    "A build checker that records the tasks it starts, rather than running them."
+    def __init__(self, build):
+        super().__init__(build, gh_repo=None)
+        self.started = []
+
+    def start_task(self, task):
+        self.started.append(task.slug)
+        type(task).objects.filter(pk=task.pk).update(status=task.STATUS_RUNNING)
+
+    def update_tasks(self):
+        pass
+
+
+class AdvanceTests(TestCase):
+    def setUp(self):
+        self.build = create_build()
+        for phase, slug in [(0, 'lint'), (0, 'docs'), (1, 'test')]:
+            self.build.tasks.create(
+                name=slug.title(),
+                slug=slug,
+                phase=phase,
+                is_critical=True,
+                environment={},
+                image='beekeeper/python',
+            )
+
+    def finish(self, slug, result=Build.RESULT_PASS):
+        # Update the task directly, rather than saving, so that finishing
+        # the task doesn't queue any cleanup.
+        self.build.tasks.filter(slug=slug).update(status=Build.STATUS_DONE, result=result)
+
+    def test_waiting(self):
+        self.finish('lint')
+        self.build.tasks.filter(slug='docs').update(status=Build.STATUS_RUNNING)
+
+        checker = RecordingChecker(self.build)
+        self.assertTrue(checker.check())
+        self.assertEqual(checker.started, [])
+
+    def test_next_phase(self):
+        self.finish('lint')
+        self.finish('docs')
+
+        checker = RecordingChecker(self.build)
+        self.assertTrue(checker.check())
+        self.assertEqual(checker.started, ['test'])
+
+        self.finish('test')
+        self.assertFalse(checker.check())
+
+        self.build.refresh_from_db()
+        self.assertEqual(self.build.status, Build.STATUS_DONE)
+        self.assertEqual(self.build.result, Build.RESULT_PASS)
+
+    def test_failure(self):
+        self.finish('lint', result=Build.RESULT_FAIL)
+        self.finish('docs')
+
+        checker = RecordingChecker(self.build)
+        self.assertFalse(checker.check())
+        self.assertEqual(checker.started, [])
+
+        self.build.refresh_from_db()
+        self.assertEqual(self.build.status, Build.STATUS_DONE)
+        self.assertEqual(self.build.result, Build.RESULT_FAIL)
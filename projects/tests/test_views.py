@@ -0,0 +1,498 @@
+import shutil
+import tempfile
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from beekeeper import views as beekeeper_views
+from github.models import User as GithubUser, Repository, Commit, Push, PullRequest
+
+from ..models import Change, Build, BranchStatus, CacheEntry
+from ..storage import archive_name
+
+
+class BuildTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+        owner = GithubUser.objects.create(
+            github_id=5001767,
+            login='pybee',
+            avatar_url='https://avatars3.githubusercontent.com/u/5001767?v=3',
+            html_url='https://github.com/pybee',
+            user_type=GithubUser.USER_TYPE_ORGANIZATION,
+        )
+        repository = Repository.objects.create(
+            owner=owner,
+            name='webhook-trigger',
+            github_id=95284391,
+            html_url='https://github.com/pybee/webhook-trigger',
+            description='A test repository',
+        )
+        commit = Commit.objects.create(
+            repository=repository,
+            branch_name='master',
+            sha='936ce824549a2a794df739c1ffab91f5644d812b',
+            user=owner,
+            created=timezone.now(),
+            message='Initial commit',
+            url='https://github.com/pybee/webhook-trigger/commit/936ce824549a2a794df739c1ffab91f5644d812b',
+        )
+        push = Push.objects.create(commit=commit, created=timezone.now())
+
+        self.change = Change.objects.create(
+            project=repository.project,
+            change_type=Change.CHANGE_TYPE_PUSH,
+            push=push,
+        )
+        self.build = Build.objects.create(change=self.change, commit=commit)
+        for phase in range(3):
+            for i in range(10):
+                self.build.tasks.create(
+                    name='Task %s' % i,
+                    slug='task-%s-%s' % (phase, i),
+                    phase=phase,
+                    is_critical=True,
+                    environment={},
+                )
+
+
+class StatusViewTests(BuildTestCase):
+    def test_build_status_queries(self):
+        # The number of queries doesn't depend on the number of tasks:
+        # 1 for the ETag, 1 for the build, 1 for the tasks.
+        with self.assertNumQueries(3):
+            response = self.client.get(self.build.get_status_url())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['tasks']), 30)
+        self.assertEqual(
+            response.json()['tasks']['task-1-3']['url'],
+            self.build.tasks.get(slug='task-1-3').get_absolute_url()
+        )
+
+    def test_build_status_not_modified(self):
+        response = self.client.get(self.build.get_status_url())
+        etag = response['ETag']
+
+        # An unchanged build only needs the ETag query.
+        with self.assertNumQueries(1):
+            response = self.client.get(self.build.get_status_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # A change to a task changes the ETag.
+        task = self.build.tasks.get(slug='task-0-0')
+        task.status = task.STATUS_RUNNING
+        task.started = timezone.now()
+        task.save()
+
+        response = self.client.get(self.build.get_status_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_change_status_queries(self):
+        for i in range(5):
+            Build.objects.create(change=self.change, commit=self.build.commit)
+
+        # 1 for the ETag, 1 for the change, 1 for the builds and commits.
+        with self.assertNumQueries(3):
+            response = self.client.get(self.change.get_status_url())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['builds']), 6)
+        self.assertEqual(
+            response.json()['builds'][self.build.display_pk]['url'],
+            self.build.get_absolute_url()
+        )
+
+    def test_change_status_not_modified(self):
+        response = self.client.get(self.change.get_status_url())
+        etag = response['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.change.get_status_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # A new build changes the ETag.
+        Build.objects.create(change=self.change, commit=self.build.commit)
+
+        response = self.client.get(self.change.get_status_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class ShieldViewTests(BuildTestCase):
+    def finish(self, build, result):
+        build.status = Build.STATUS_DONE
+        build.result = result
+        build.save()
+
+    def test_unknown(self):
+        response = self.client.get(self.change.project.get_shield_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/svg+xml;charset=utf-8')
+        self.assertIn(b'unknown', response.content)
+
+    def test_cached(self):
+        self.finish(self.build, Build.RESULT_PASS)
+        self.assertEqual(
+            BranchStatus.objects.get(project=self.change.project, branch_name='master').build,
+            self.build
+        )
+
+        response = self.client.get(self.change.project.get_shield_url())
+        self.assertIn(b'passing', response.content)
+        self.assertIn('max-age', response['Cache-Control'])
+        etag = response['ETag']
+
+        # Once the status is cached, shields don't touch the database.
+        with self.assertNumQueries(0):
+            response = self.client.get(self.change.project.get_shield_url())
+            self.assertEqual(response.status_code, 200)
+
+            response = self.client.get(self.change.project.get_shield_url(), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+
+        # A newer build on the branch replaces the cached status.
+        build = Build.objects.create(change=self.change, commit=self.build.commit)
+        self.finish(build, Build.RESULT_FAIL)
+
+        response = self.client.get(self.change.project.get_shield_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'failing', response.content)
+
+        # ... but finishing an older build doesn't.
+        self.finish(self.build, Build.RESULT_PASS)
+
+        response = self.client.get(self.change.project.get_shield_url())
+        self.assertIn(b'failing', response.content)
+
+    def test_other_branch(self):
+        self.finish(self.build, Build.RESULT_PASS)
+
+        response = self.client.get(self.change.project.get_shield_url(), {'branch': 'other'})
+        self.assertIn(b'unknown', response.content)
+
+
+# Rendering pages shouldn't depend on having run collectstatic.
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class DashboardViewTests(BuildTestCase):
+    def setUp(self):
+        super().setUp()
+        project = self.change.project
+        project.approve()
+
+        # Add some pull requests, each with a couple of builds.
+        for number in range(1, 6):
+            user = GithubUser.objects.create(
+                github_id=1000 + number,
+                login='user%s' % number,
+                avatar_url='https://avatars.githubusercontent.com/u/%s' % number,
+                html_url='https://github.com/user%s' % number,
+            )
+            pull_request = PullRequest.objects.create(
+                repository=project.repository,
+                number=number,
+                github_id=2000 + number,
+                created=timezone.now(),
+                updated=timezone.now(),
+                user=user,
+                title='Pull request %s' % number,
+                html_url='https://github.com/pybee/webhook-trigger/pull/%s' % number,
+                diff_url='https://github.com/pybee/webhook-trigger/pull/%s.diff' % number,
+                patch_url='https://github.com/pybee/webhook-trigger/pull/%s.patch' % number,
+            )
+            change = Change.objects.create(
+                project=project,
+                change_type=Change.CHANGE_TYPE_PULL_REQUEST,
+                pull_request=pull_request,
+            )
+            Build.objects.create(change=change, commit=self.build.commit)
+            Build.objects.create(
+                change=change,
+                commit=self.build.commit,
+                status=Build.STATUS_DONE,
+                result=Build.RESULT_PASS,
+            )
+
+        # Add some other projects.
+        for i in range(5):
+            repository = Repository.objects.create(
+                owner=project.repository.owner,
+                name='repo-%s' % i,
+                github_id=3000 + i,
+                html_url='https://github.com/pybee/repo-%s' % i,
+                description='Another test repository',
+            )
+            if i % 2:
+                repository.project.approve()
+
+    def test_home(self):
+        # Projects awaiting approval are only shown to superusers, so the
+        # only queries are to count the active projects, and to get them.
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('home'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['projects']), 3)
+        self.assertEqual(
+            {
+                project.repository.name: project.active_changes
+                for project in response.context['projects']
+            },
+            {'webhook-trigger': 6, 'repo-1': 0, 'repo-3': 0}
+        )
+
+    def test_home_pages(self):
+        with mock.patch.object(beekeeper_views, 'PROJECTS_PER_PAGE', 2):
+            response = self.client.get(reverse('home'))
+            self.assertEqual(
+                [project.repository.name for project in response.context['projects']],
+                ['repo-1', 'repo-3']
+            )
+            self.assertContains(response, 'Page 1 of 2')
+
+            response = self.client.get(reverse('home'), {'page': 2})
+            self.assertEqual(
+                [project.repository.name for project in response.context['projects']],
+                ['webhook-trigger']
+            )
+            self.assertEqual(response.context['projects'][0].active_changes, 6)
+
+            response = self.client.get(reverse('home'), {'page': 99})
+            self.assertEqual(response.context['projects'].number, 2)
+
+    def test_project(self):
+        # 1 for the project, 1 to count the changes, 1 for the changes.
+        with self.assertNumQueries(3):
+            response = self.client.get(self.change.project.get_absolute_url())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['changes']), 6)
+        change = response.context['changes'][0]
+        self.assertEqual(change.latest_build_status, change.latest_build.status)
+        self.assertEqual(change.latest_build_result, change.latest_build.result)
+        self.assertContains(response, 'Pull request 3')
+        self.assertContains(response, 'user3')
+
+    def test_home_rows_cleared(self):
+        response = self.client.get(reverse('home'))
+        self.assertContains(response, '<td class="minimal">6</td>', html=True)
+
+        # Ignoring a change updates the count on the cached row.
+        change = Change.objects.filter(change_type=Change.CHANGE_TYPE_PULL_REQUEST).first()
+        change.ignore()
+
+        response = self.client.get(reverse('home'))
+        self.assertContains(response, '<td class="minimal">5</td>', html=True)
+
+    def test_project_rows_cleared(self):
+        response = self.client.get(self.change.project.get_absolute_url())
+        self.assertNotContains(response, 'Running')
+
+        # A change in the status of a build updates the cached row.
+        self.build.status = Build.STATUS_RUNNING
+        self.build.save()
+
+        response = self.client.get(self.change.project.get_absolute_url())
+        self.assertContains(response, 'Running')
+
+    def test_project_pages(self):
+        response = self.client.get(self.change.project.get_absolute_url(), {'page': 'last'})
+        self.assertEqual(response.context['changes'].number, 1)
+
+        response = self.client.get(self.change.project.get_absolute_url(), {'page': 99})
+        self.assertEqual(response.context['changes'].number, 1)
+
+
+class BuildCodeTests(BuildTestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.storage_settings = self.settings(
+            DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+            MEDIA_ROOT=self.media_root,
+        )
+        self.storage_settings.enable()
+
+        self.content = bytes(range(256)) * 4
+        default_storage.save(
+            archive_name('pybee', 'webhook-trigger', self.build.commit.sha),
+            ContentFile(self.content)
+        )
+
+    def tearDown(self):
+        self.storage_settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_full(self):
+        response = self.client.get(self.build.get_code_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['ETag'], '"%s"' % self.build.commit.sha)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_not_modified(self):
+        response = self.client.get(
+            self.build.get_code_url(),
+            HTTP_IF_NONE_MATCH='"%s"' % self.build.commit.sha
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_range(self):
+        response = self.client.get(self.build.get_code_url(), HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.content[100:200])
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/1024')
+
+        response = self.client.get(self.build.get_code_url(), HTTP_RANGE='bytes=1000-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.content[1000:])
+
+        response = self.client.get(self.build.get_code_url(), HTTP_RANGE='bytes=-10')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.content[-10:])
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.build.get_code_url(), HTTP_RANGE='bytes=2000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+
+class TaskCacheTests(BuildTestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.storage_settings = self.settings(
+            DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+            MEDIA_ROOT=self.media_root,
+        )
+        self.storage_settings.enable()
+
+        self.project = self.change.project
+        self.url = CacheEntry.get_url(self.project, 'test:py36', 'abc123', writable=True)
+
+    def tearDown(self):
+        self.storage_settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_miss(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_store_and_retrieve(self):
+        response = self.client.put(self.url, b'cached content', content_type='application/gzip')
+        self.assertEqual(response.status_code, 201)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'cached content')
+
+        # Storing again replaces the entry.
+        response = self.client.put(self.url, b'new content', content_type='application/gzip')
+        self.assertEqual(response.status_code, 204)
+
+        response = self.client.get(self.url)
+        self.assertEqual(b''.join(response.streaming_content), b'new content')
+        self.assertEqual(CacheEntry.objects.get().size, 11)
+
+    def test_read_only(self):
+        self.client.put(self.url, b'cached content', content_type='application/gzip')
+
+        # A read only URL can retrieve the entry, but not replace it.
+        url = CacheEntry.get_url(self.project, 'test:py36', 'abc123')
+        response = self.client.put(url, b'poisoned', content_type='application/gzip')
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), b'cached content')
+
+    def test_bad_token(self):
+        response = self.client.get(self.url + 'x')
+        self.assertEqual(response.status_code, 403)
+
+    def test_eviction(self):
+        urls = [
+            CacheEntry.get_url(self.project, 'test:py36', 'key-%s' % i, writable=True)
+            for i in range(4)
+        ]
+        with self.settings(BEEKEEPER_CACHE_MAX_SIZE=300):
+            for url in urls[:3]:
+                self.client.put(url, b'x' * 100, content_type='application/gzip')
+
+            # Using the first entry makes the second the least recently used.
+            self.client.get(urls[0])
+            self.client.put(urls[3], b'x' * 100, content_type='application/gzip')
+
+        self.assertEqual(
+            sorted(CacheEntry.objects.values_list('key', flat=True)),
+            ['key-0', 'key-2', 'key-3']
+        )
+        self.assertEqual(self.client.get(urls[1]).status_code, 404)
+
+
+class RerunFailedTests(BuildTestCase):
+    def setUp(self):
+        super().setUp()
+        # Phase 0 passed; phase 1 had a failure and an error, so phase 2
+        # never ran.
+        self.build.tasks.filter(phase__lt=2).update(status=Build.STATUS_DONE, result=Build.RESULT_PASS)
+        self.build.tasks.filter(slug='task-1-3').update(result=Build.RESULT_FAIL)
+        self.build.tasks.filter(slug='task-1-4').update(status=Build.STATUS_ERROR, result=Build.RESULT_PENDING)
+        Build.objects.filter(pk=self.build.pk).update(status=Build.STATUS_ERROR, result=Build.RESULT_FAIL)
+
+        get_user_model().objects.create_superuser('admin@example.com', 'password')
+        self.client.login(email='admin@example.com', password='password')
+
+    def test_rerun_failed(self):
+        with mock.patch.object(Build, 'start') as start:
+            response = self.client.post(self.build.get_absolute_url(), {'rerun': 'Rerun failed'})
+
+        self.assertRedirects(response, self.build.get_absolute_url(), fetch_redirect_response=False)
+        start.assert_called_once_with()
+
+        build = Build.objects.get(pk=self.build.pk)
+        self.assertEqual(build.status, Build.STATUS_CREATED)
+        self.assertEqual(build.result, Build.RESULT_PENDING)
+
+        # Only the failed tasks, and the tasks that never ran, will be run.
+        self.assertEqual(
+            set(build.tasks.filter(status=Build.STATUS_CREATED).values_list('slug', flat=True)),
+            {'task-1-3', 'task-1-4'} | {'task-2-%s' % i for i in range(10)}
+        )
+        self.assertEqual(build.tasks.filter(result=Build.RESULT_PASS).count(), 18)
+
+    def test_stopped_mid_phase(self):
+        # The build was stopped while phase 1 was running; some tasks in
+        # phase 1 had passed, one had failed, and the rest were stopped.
+        self.build.tasks.filter(slug='task-1-4').update(status=Build.STATUS_DONE, result=Build.RESULT_PASS)
+        self.build.tasks.filter(slug__in=['task-1-5', 'task-1-6']).update(
+            status=Build.STATUS_STOPPED,
+            result=Build.RESULT_PENDING
+        )
+        Build.objects.filter(pk=self.build.pk).update(status=Build.STATUS_STOPPED, result=Build.RESULT_PENDING)
+
+        with mock.patch.object(Build, 'start'):
+            Build.objects.get(pk=self.build.pk).rerun_failed()
+
+        # The stopped tasks are run, as well as the failed task.
+        self.assertEqual(
+            set(self.build.tasks.filter(status=Build.STATUS_CREATED).values_list('slug', flat=True)),
+            {'task-1-3', 'task-1-5', 'task-1-6'} | {'task-2-%s' % i for i in range(10)}
+        )
+
+    def test_nothing_failed(self):
+        self.build.tasks.update(status=Build.STATUS_DONE, result=Build.RESULT_PASS)
+        Build.objects.filter(pk=self.build.pk).update(status=Build.STATUS_DONE, result=Build.RESULT_PASS)
+
+        with mock.patch.object(Build, 'start') as start:
+            Build.objects.get(pk=self.build.pk).rerun_failed()
+
+        self.assertFalse(start.called)
+        self.assertEqual(Build.objects.get(pk=self.build.pk).status, Build.STATUS_DONE)
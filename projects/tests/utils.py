@@ -0,0 +1,48 @@
+from django.utils import timezone
+
+from github.models import User as GithubUser, Repository, Commit, Push
+
+from ..models import Change, Build
+
+
+def create_build(number=0, status=Build.STATUS_RUNNING):
+    """Create a build of a push to a new repository, named repo-<number>.
+
+    Every repository belongs to the same owner, so builds created with
+    different numbers can be used together in a single test.
+    """
+    owner, _ = GithubUser.objects.get_or_create(
+        github_id=5001767,
+        defaults={
+            'login': 'pybee',
+            'avatar_url': 'https://avatars3.githubusercontent.com/u/5001767?v=3',
+            'html_url': 'https://github.com/pybee',
+            'user_type': GithubUser.USER_TYPE_ORGANIZATION,
+        }
+    )
+    repository = Repository.objects.create(
+        owner=owner,
+        name='repo-%s' % number,
+        github_id=1000 + number,
+        html_url='https://github.com/pybee/repo-%s' % number,
+        description='A test repository',
+    )
+    commit = Commit.objects.create(
+        repository=repository,
+        branch_name='master',
+        sha='%040x' % number,
+        user=owner,
+        created=timezone.now(),
+        message='Commit %s' % number,
+        url='https://github.com/pybee/repo-%s/commit/%040x' % (number, number),
+    )
+    change = Change.objects.create(
+        project=repository.project,
+        change_type=Change.CHANGE_TYPE_PUSH,
+        push=Push.objects.create(commit=commit, created=timezone.now()),
+    )
+    return Build.objects.create(
+        change=change,
+        commit=commit,
+        status=status,
+    )
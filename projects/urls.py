@@ -10,14 +10,20 @@ urlpatterns = [
         projects.project, name='project'),
     url(r'^(?P<owner>[-\w]+)/(?P<repo_name>[-\w]+)/shield$',
         projects.project_shield, name='project-shield'),
+    url(r'^(?P<owner>[-\w]+)/(?P<repo_name>[-\w]+)/cache/(?P<token>[-:\w]+)$',
+        projects.task_cache, name='cache'),
     url(r'^(?P<owner>[-\w]+)/(?P<repo_name>[-\w]+)/change/(?P<change_pk>[-\da-fA-F]{8}-[-\da-fA-F]{4}-4[-\da-fA-F]{3}-[-\da-fA-F]{4}-[-\da-fA-F]{12})$',
         projects.change, name='change'),
     url(r'^(?P<owner>[-\w]+)/(?P<repo_name>[-\w]+)/change/(?P<change_pk>[-\da-fA-F]{8}-[-\da-fA-F]{4}-4[-\da-fA-F]{3}-[-\da-fA-F]{4}-[-\da-fA-F]{12})/status$',
         projects.change_status, name='change-status'),
+    url(r'^(?P<owner>[-\w]+)/(?P<repo_name>[-\w]+)/change/(?P<change_pk>[-\da-fA-F]{8}-[-\da-fA-F]{4}-4[-\da-fA-F]{3}-[-\da-fA-F]{4}-[-\da-fA-F]{12})/events$',
+        projects.change_events, name='change-events'),
     url(r'^(?P<owner>[-\w]+)/(?P<repo_name>[-\w]+)/change/(?P<change_pk>[-\da-fA-F]{8}-[-\da-fA-F]{4}-4[-\da-fA-F]{3}-[-\da-fA-F]{4}-[-\da-fA-F]{12})/build/(?P<build_pk>[-\da-fA-F]{8}-[-\da-fA-F]{4}-4[-\da-fA-F]{3}-[-\da-fA-F]{4}-[-\da-fA-F]{12})$',
         projects.build, name='build'),
     url(r'^(?P<owner>[-\w]+)/(?P<repo_name>[-\w]+)/change/(?P<change_pk>[-\da-fA-F]{8}-[-\da-fA-F]{4}-4[-\da-fA-F]{3}-[-\da-fA-F]{4}-[-\da-fA-F]{12})/build/(?P<build_pk>[-\da-fA-F]{8}-[-\da-fA-F]{4}-4[-\da-fA-F]{3}-[-\da-fA-F]{4}-[-\da-fA-F]{12})/status$',
         projects.build_status, name='build-status'),
+    url(r'^(?P<owner>[-\w]+)/(?P<repo_name>[-\w]+)/change/(?P<change_pk>[-\da-fA-F]{8}-[-\da-fA-F]{4}-4[-\da-fA-F]{3}-[-\da-fA-F]{4}-[-\da-fA-F]{12})/build/(?P<build_pk>[-\da-fA-F]{8}-[-\da-fA-F]{4}-4[-\da-fA-F]{3}-[-\da-fA-F]{4}-[-\da-fA-F]{12})/events$',
+        projects.build_events, name='build-events'),
     url(r'^(?P<owner>[-\w]+)/(?P<repo_name>[-\w]+)/change/(?P<change_pk>[-\da-fA-F]{8}-[-\da-fA-F]{4}-4[-\da-fA-F]{3}-[-\da-fA-F]{4}-[-\da-fA-F]{12})/build/(?P<build_pk>[-\da-fA-F]{8}-[-\da-fA-F]{4}-4[-\da-fA-F]{3}-[-\da-fA-F]{4}-[-\da-fA-F]{12})/code$',
         projects.build_code, name='build-code'),
 
@@ -1,64 +1,205 @@
 import hashlib
 import json
+import re
+import tempfile
+from urllib.parse import urlparse
 
+from django.apps import apps
 from django.conf import settings
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.core import signing
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed,
+    HttpResponseRedirect
+)
 from django.views.decorators.http import etag
 from django.shortcuts import render, redirect
-from django.views.decorators.cache import never_cache
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils import timezone
+from django.utils.http import quote_etag
+from django.views.decorators.csrf import csrf_exempt
 
 import requests
 
-from .models import Project, Change, Build
+from . import events
+from .models import Project, Change, Build, BranchStatus, CacheEntry
+from .storage import archive_name, read_range
+
+
+# A single byte range, as requested by a Range header.
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# The size (in bytes) of each piece of an uploaded cache entry.
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# The maximum number of tasks, and matching lines per task, in search results.
+MAX_SEARCH_TASKS = 50
+MAX_SEARCH_LINES = 5
+
+# The number of changes shown on each page of a project.
+CHANGES_PER_PAGE = 50
 
 
 def project(request, owner, repo_name):
     try:
-        project = Project.objects.get(
+        project = Project.objects.select_related('repository__owner').get(
                         repository__owner__login=owner,
                         repository__name=repo_name,
                     )
     except Project.DoesNotExist:
         raise Http404
 
+    latest_builds = Build.objects.filter(change=OuterRef('pk')).order_by('-updated')
+    changes = project.changes.active().select_related(
+            'pull_request__user',
+            'push__commit__user',
+        ).annotate(
+            latest_build_status=Subquery(latest_builds.values('status')[:1]),
+            latest_build_result=Subquery(latest_builds.values('result')[:1]),
+        )
+
+    paginator = Paginator(changes, CHANGES_PER_PAGE)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except PageNotAnInteger:
+        page = paginator.page(1)
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
+
+    # Every change belongs to this project; avoid looking it up again
+    # when constructing URLs.
+    for change in page:
+        change.project = project
+
     return render(request, 'projects/project.html', {
             'project': project,
+            'changes': page,
         })
 
 
-def etag_func(request, *args, **kwargs):
-    return hashlib.sha256(str(timezone.now()).encode('utf-8')).hexdigest()
+# How long (in seconds) a shield can be cached by a browser or proxy.
+SHIELD_MAX_AGE = 5 * 60
+
+# How long (in seconds) the status of a branch is cached for shields.
+# Cached statuses are also cleared when a build on the branch finishes.
+SHIELD_CACHE_TIMEOUT = 60 * 60
+
+SHIELD_STATUSES = {
+    Build.RESULT_PASS: 'pass',
+    Build.RESULT_FAIL: 'fail',
+    Build.RESULT_NON_CRITICAL_FAIL: 'non_critical_fail',
+}
+
+# Rendered shields, keyed by status.
+_shields = {}
+
+
+def shield(status):
+    "Return the rendered SVG content and ETag for a shield."
+    if status not in _shields:
+        content = render_to_string('projects/shields/%s.svg' % status).encode('utf-8')
+        _shields[status] = (content, quote_etag(hashlib.sha256(content).hexdigest()))
+    return _shields[status]
 
 
-@never_cache
-@etag(etag_func=etag_func)
 def project_shield(request, owner, repo_name):
-    try:
-        project = Project.objects.get(
-                        repository__owner__login=owner,
-                        repository__name=repo_name,
-                    )
-    except Project.DoesNotExist:
-        raise Http404
+    branch = request.GET.get('branch')
+    key = BranchStatus.cache_key(owner, repo_name, branch)
+    status = cache.get(key)
+    if status is None:
+        try:
+            project = Project.objects.select_related('repository').get(
+                            repository__owner__login=owner,
+                            repository__name=repo_name,
+                        )
+        except Project.DoesNotExist:
+            raise Http404
 
-    branch = request.GET.get('branch', project.repository.master_branch_name)
-    build = project.current_build(branch)
-    if build:
-        if build.result == Build.RESULT_PASS:
-            status = 'pass'
-        elif build.result == Build.RESULT_FAIL:
-            status = 'fail'
-        elif build.result == Build.RESULT_NON_CRITICAL_FAIL:
-            status = 'non_critical_fail'
-        else:
+        try:
+            result = BranchStatus.objects.values_list('result', flat=True).get(
+                project=project,
+                branch_name=branch or project.repository.master_branch_name,
+            )
+            status = SHIELD_STATUSES.get(result, 'unknown')
+        except BranchStatus.DoesNotExist:
             status = 'unknown'
-    else:
-        status = 'unknown'
 
-    return render(request, 'projects/shields/%s.svg' % status, {},
-        content_type='image/svg+xml;charset=utf-8'
-    )
+        cache.set(key, status, SHIELD_CACHE_TIMEOUT)
+
+    content, etag = shield(status)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(content, content_type='image/svg+xml;charset=utf-8')
+    response['ETag'] = etag
+    patch_cache_control(response, max_age=SHIELD_MAX_AGE)
+    return response
+
+
+@csrf_exempt
+def task_cache(request, owner, repo_name, token):
+    try:
+        project_pk, namespace, key, writable = signing.loads(
+            token,
+            salt=CacheEntry.SIGNING_SALT,
+            max_age=CacheEntry.MAX_AGE,
+        )
+    except (signing.BadSignature, ValueError):
+        return HttpResponseForbidden('Permission denied.')
+
+    if request.method in ('GET', 'HEAD'):
+        try:
+            entry = CacheEntry.objects.get(
+                project_id=project_pk,
+                namespace=namespace,
+                key=key,
+            )
+        except CacheEntry.DoesNotExist:
+            raise Http404
+
+        CacheEntry.objects.filter(pk=entry.pk).update(last_used=timezone.now())
+
+        url = entry.archive.url
+        if urlparse(url).scheme:
+            return HttpResponseRedirect(url)
+        response = FileResponse(entry.archive.storage.open(entry.archive.name, 'rb'), content_type='application/gzip')
+        response['Content-Length'] = entry.size
+        return response
+
+    elif request.method == 'PUT':
+        # Builds of pull requests (possibly from forks) can use the cache,
+        # but can't change what the project's other builds will use.
+        if not writable:
+            return HttpResponseForbidden('This cache entry is read only.')
+
+        entry, created = CacheEntry.objects.get_or_create(
+            project_id=project_pk,
+            namespace=namespace,
+            key=key,
+        )
+        with tempfile.TemporaryFile() as upload:
+            for chunk in iter(lambda: request.read(UPLOAD_CHUNK_SIZE), b''):
+                upload.write(chunk)
+            size = upload.tell()
+            upload.seek(0)
+
+            if entry.archive:
+                entry.archive.delete(save=False)
+            entry.archive.save(entry.archive_name, File(upload), save=False)
+
+        entry.size = size
+        entry.last_used = timezone.now()
+        entry.save()
+
+        CacheEntry.evict(project_pk, settings.BEEKEEPER_CACHE_MAX_SIZE)
+        return HttpResponse(status=201 if created else 204)
+
+    return HttpResponseNotAllowed(['GET', 'HEAD', 'PUT'])
 
 
 def change(request, owner, repo_name, change_pk):
@@ -77,6 +218,28 @@ def change(request, owner, repo_name, change_pk):
         })
 
 
+def change_status_etag(request, owner, repo_name, change_pk):
+    """Compute an ETag for the status of a change.
+
+    The ETag changes whenever the change, or any of its builds, is saved,
+    or when a build is added or removed.
+    """
+    try:
+        state = Change.objects.filter(
+                    project__repository__owner__login=owner,
+                    project__repository__name=repo_name,
+                    pk=change_pk
+                ).annotate(
+                    builds_updated=Max('builds__updated'),
+                    build_count=Count('builds'),
+                ).values_list('updated', 'builds_updated', 'build_count').get()
+    except Change.DoesNotExist:
+        return None
+
+    return hashlib.sha256(str(state).encode('utf-8')).hexdigest()
+
+
+@etag(etag_func=change_status_etag)
 def change_status(request, owner, repo_name, change_pk):
     try:
         change = Change.objects.get(
@@ -87,22 +250,42 @@ def change_status(request, owner, repo_name, change_pk):
     except Change.DoesNotExist:
         raise Http404
 
+    # All the builds share an owner, repository and change, so the URLs
+    # can be constructed from the request, rather than the database.
+    builds = change.builds.select_related('commit')
+
     return HttpResponse(json.dumps({
             'builds': {
                 build.display_pk: {
-                        'url': build.get_absolute_url(),
+                        'url': reverse('projects:build', kwargs={
+                            'owner': owner,
+                            'repo_name': repo_name,
+                            'change_pk': change_pk,
+                            'build_pk': str(build.pk),
+                        }),
                         'label': build.commit.display_sha,
                         'title': build.commit.title,
                         'timestamp': build.created.strftime('%-d %b %Y, %H:%M'),
                         'status': build.get_status_display(),
                         'result': build.result,
                     }
-                for build in change.builds.all()
+                for build in builds
             },
             'complete': change.is_complete
         }), content_type="application/json")
 
 
+def change_events(request, owner, repo_name, change_pk):
+    if not Change.objects.filter(
+                project__repository__owner__login=owner,
+                project__repository__name=repo_name,
+                pk=change_pk
+            ).exists():
+        raise Http404
+
+    return events.event_response([events.channel('change', change_pk)])
+
+
 def build(request, owner, repo_name, change_pk, build_pk):
     try:
         build = Build.objects.get(
@@ -119,6 +302,8 @@ def build(request, owner, repo_name, change_pk, build_pk):
             build.resume()
         elif 'restart' in request.POST:
             build.restart()
+        elif 'rerun' in request.POST:
+            build.rerun_failed()
         elif 'stop' in request.POST:
             build.stop()
 
@@ -132,6 +317,29 @@ def build(request, owner, repo_name, change_pk, build_pk):
         })
 
 
+def build_status_etag(request, owner, repo_name, change_pk, build_pk):
+    """Compute an ETag for the status of a build.
+
+    The ETag changes whenever the build, or any of its tasks, is saved,
+    or when a task is added or removed.
+    """
+    try:
+        state = Build.objects.filter(
+                    change__project__repository__owner__login=owner,
+                    change__project__repository__name=repo_name,
+                    change__pk=change_pk,
+                    pk=build_pk,
+                ).annotate(
+                    tasks_updated=Max('tasks__updated'),
+                    task_count=Count('tasks'),
+                ).values_list('updated', 'tasks_updated', 'task_count').get()
+    except Build.DoesNotExist:
+        return None
+
+    return hashlib.sha256(str(state).encode('utf-8')).hexdigest()
+
+
+@etag(etag_func=build_status_etag)
 def build_status(request, owner, repo_name, change_pk, build_pk):
     try:
         build = Build.objects.get(
@@ -143,12 +351,20 @@ def build_status(request, owner, repo_name, change_pk, build_pk):
     except Build.DoesNotExist:
         raise Http404
 
+    # All the tasks share an owner, repository, change and build, so the
+    # URLs can be constructed from the request, rather than the database.
     return HttpResponse(json.dumps({
             'status': build.full_status_display(),
             'result': build.result,
             'tasks': {
                 task.slug: {
-                        'url': task.get_absolute_url(),
+                        'url': reverse('projects:task', kwargs={
+                            'owner': owner,
+                            'repo_name': repo_name,
+                            'change_pk': change_pk,
+                            'build_pk': build_pk,
+                            'task_slug': task.slug,
+                        }),
                         'name': task.name,
                         'phase': task.phase,
                         'status': task.get_status_display(),
@@ -156,13 +372,62 @@ def build_status(request, owner, repo_name, change_pk, build_pk):
                     }
                 for task in build.tasks.all()
             },
+            'has_failures': build.has_failures,
             'finished': build.is_finished
         }), content_type="application/json")
 
 
+def build_events(request, owner, repo_name, change_pk, build_pk):
+    if not Build.objects.filter(
+                change__project__repository__owner__login=owner,
+                change__project__repository__name=repo_name,
+                change__pk=change_pk,
+                pk=build_pk,
+            ).exists():
+        raise Http404
+
+    return events.event_response([events.channel('build', build_pk)])
+
+
+def ranged_file_response(request, name, content_type, storage=default_storage):
+    """Serve a stored file, honoring a single-range Range header."""
+    size = storage.size(name)
+
+    match = RANGE_RE.match(request.META.get('HTTP_RANGE', ''))
+    if match:
+        start, end = match.groups()
+        if start:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        elif end:
+            # A suffix range; the last N bytes of the file.
+            start = max(size - int(end), 0)
+            end = size - 1
+        else:
+            start = size
+
+        if start > end or start >= size:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%s' % size
+            return response
+
+        response = HttpResponse(
+            read_range(name, start, end - start + 1, storage=storage),
+            status=206,
+            content_type=content_type,
+        )
+        response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
+    else:
+        response = FileResponse(storage.open(name, 'rb'), content_type=content_type)
+        response['Content-Length'] = size
+
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
 def build_code(request, owner, repo_name, change_pk, build_pk):
     try:
-        build = Build.objects.get(
+        build = Build.objects.select_related('commit').get(
                         change__project__repository__owner__login=owner,
                         change__project__repository__name=repo_name,
                         change__pk=change_pk,
@@ -171,14 +436,150 @@ def build_code(request, owner, repo_name, change_pk, build_pk):
     except Build.DoesNotExist:
         raise Http404
 
-    response = requests.get(
-        'https://github.com/%s/%s/archive/%s.zip' % (
-            owner,
-            repo_name,
-            build.commit.sha
-        ),
-        auth=(settings.GITHUB_USERNAME, settings.GITHUB_ACCESS_TOKEN),
-        allow_redirects=False
+    # The archive for a commit never changes, so the SHA is a strong ETag.
+    etag = quote_etag(build.commit.sha)
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        return response
+
+    name = archive_name(owner, repo_name, build.commit.sha)
+    if default_storage.exists(name):
+        url = default_storage.url(name)
+        if urlparse(url).scheme:
+            # The storage can serve the file directly (e.g., S3);
+            # it will handle range and conditional requests itself.
+            response = HttpResponseRedirect(url)
+        else:
+            response = ranged_file_response(request, name, 'application/zip')
+    else:
+        # The archive hasn't been mirrored; use the copy on Github.
+        github_response = requests.get(
+            'https://github.com/%s/%s/archive/%s.zip' % (
+                owner,
+                repo_name,
+                build.commit.sha
+            ),
+            auth=(settings.GITHUB_USERNAME, settings.GITHUB_ACCESS_TOKEN),
+            allow_redirects=False
+        )
+        response = HttpResponseRedirect(github_response.headers['Location'])
+
+    response['ETag'] = etag
+    return response
+
+
+def task_model():
+    "The Task model of the build app that is in use."
+    return apps.get_model(settings.BEEKEEPER_BUILD_APP, 'Task')
+
+
+def get_task(owner, repo_name, change_pk, build_pk, task_slug):
+    Task = task_model()
+    try:
+        return Task.objects.get(
+                        build__change__project__repository__owner__login=owner,
+                        build__change__project__repository__name=repo_name,
+                        build__change__pk=change_pk,
+                        build__pk=build_pk,
+                        slug=task_slug
+                    )
+    except Task.DoesNotExist:
+        raise Http404
+
+
+def task(request, owner, repo_name, change_pk, build_pk, task_slug):
+    task = get_task(owner, repo_name, change_pk, build_pk, task_slug)
+
+    return render(request, 'projects/task.html', {
+            'project': task.build.change.project,
+            'change': task.build.change,
+            'commit': task.build.commit,
+            'build': task.build,
+            'task': task,
+        })
+
+
+def task_status(request, owner, repo_name, change_pk, build_pk, task_slug):
+    task = get_task(owner, repo_name, change_pk, build_pk, task_slug)
+
+    try:
+        offset = int(request.GET.get('offset', 0))
+    except ValueError:
+        offset = 0
+
+    log_data, offset, log_complete = task.read_new_log(offset)
+    if log_data or offset:
+        message = None
+    elif task.has_error:
+        log_data = None
+        message = 'No logs; task did not start.'
+    else:
+        log_data = None
+        message = 'Waiting for logs to become available...'
+
+    return HttpResponse(json.dumps({
+            'started': task.has_started,
+            'log': log_data,
+            'message': message,
+            'status': task.full_status_display(),
+            'result': task.result,
+            'offset': offset,
+            'finished': task.is_finished and log_complete,
+        }), content_type="application/json")
+
+
+def task_events(request, owner, repo_name, change_pk, build_pk, task_slug):
+    Task = task_model()
+    try:
+        task = Task.objects.only('pk').get(
+                        build__change__project__repository__owner__login=owner,
+                        build__change__project__repository__name=repo_name,
+                        build__change__pk=change_pk,
+                        build__pk=build_pk,
+                        slug=task_slug
+                    )
+    except Task.DoesNotExist:
+        raise Http404
+
+    return events.event_response([events.channel('task', task.pk)])
+
+
+def current_tasks(request):
+    Task = task_model()
+    # Everything the page displays about the build, change and project
+    # that each task belongs to.
+    related = (
+        'build__change__project__repository__owner',
+        'build__change__pull_request__user',
+        'build__change__push__commit__user',
     )
+    return render(request, 'tasks/current_tasks.html', {
+        'pending': Task.objects.created().filter(build__status__in=(
+                        Build.STATUS_CREATED,
+                        Build.STATUS_RUNNING)
+                    ).select_related(*related).order_by('-updated'),
+        'started': Task.objects.not_finished().filter(build__status__in=(
+                        Build.STATUS_CREATED,
+                        Build.STATUS_RUNNING)
+                    ).select_related(*related).order_by('-updated'),
+        'recents': Task.objects.recently_finished().select_related(*related).order_by('-updated'),
+    })
+
+
+def current_tasks_events(request):
+    return events.event_response([events.ALL_TASKS])
+
+
+def search(request):
+    query = request.GET.get('q', '').strip()
+
+    results = []
+    if len(query) >= 3:
+        results = task_model().search_logs(query, MAX_SEARCH_TASKS)
+        for result in results:
+            result['lines'] = result['lines'][:MAX_SEARCH_LINES]
 
-    return HttpResponseRedirect(response.headers['Location'])
+    return render(request, 'tasks/search.html', {
+        'query': query,
+        'results': results,
+    })
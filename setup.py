@@ -29,6 +29,7 @@ setup(
     entry_points={
         'console_scripts': [
             'beekeeper = beekeeper.__main__:main',
+            'beekeeper-agent = beekeeper.agent:main',
         ]
     },
     license='New BSD',
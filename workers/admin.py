@@ -0,0 +1,29 @@
+from django.contrib import admin
+
+from .models import Task, Worker
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ['project', 'build_pk', 'name', 'phase', 'is_critical', 'image', 'worker', 'status', 'result']
+    list_filter = ['status', 'result', 'is_critical', 'worker']
+    raw_id_fields = ['build',]
+
+    def build_pk(self, task):
+        return task.build.display_pk
+    build_pk.short_description = 'Build'
+
+    def project(self, task):
+        return task.build.change.project
+    project.short_description = 'Project'
+
+
+@admin.register(Worker)
+class WorkerAdmin(admin.ModelAdmin):
+    list_display = ['name', 'profiles', 'active', 'last_seen', 'running']
+    list_filter = ['active']
+    readonly_fields = ['token', 'last_seen']
+
+    def running(self, worker):
+        return worker.tasks.running().count()
+    running.short_description = 'Running tasks'
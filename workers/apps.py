@@ -0,0 +1,16 @@
+from django.apps import AppConfig
+
+
+class WorkersConfig(AppConfig):
+    name = 'workers'
+    verbose_name = 'BeeKeeper workers'
+
+    def ready(self):
+        from django.db.models import signals as django
+        from projects import signals as projects
+        from projects.models import Build
+        from .handlers import start_build, publish_task
+        from .models import Task
+
+        projects.start_build.connect(start_build, sender=Build)
+        django.post_save.connect(publish_task, sender=Task)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 15:12
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import workers.models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('projects', '0012_project_quotas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line', models.IntegerField()),
+                ('content', models.TextField()),
+            ],
+            options={
+                'ordering': ('task', 'line'),
+            },
+        ),
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.IntegerField(choices=[(10, 'Created'), (19, 'Waiting'), (20, 'Running'), (100, 'Done'), (200, 'Error'), (9998, 'Stopping'), (9999, 'Stopped')], default=10)),
+                ('result', models.IntegerField(choices=[(0, 'Pending'), (10, 'Fail'), (19, 'Non-critical Fail'), (20, 'Pass')], default=0)),
+                ('name', models.CharField(db_index=True, max_length=100)),
+                ('slug', models.CharField(db_index=True, max_length=100)),
+                ('phase', models.IntegerField()),
+                ('is_critical', models.BooleanField()),
+                ('queued', models.DateTimeField(blank=True, null=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('completed', models.DateTimeField(blank=True, null=True)),
+                ('environment', django.contrib.postgres.fields.jsonb.JSONField(blank=True)),
+                ('profile_slug', models.CharField(default='default', max_length=100)),
+                ('image', models.CharField(max_length=100)),
+                ('heartbeat', models.DateTimeField(blank=True, null=True)),
+                ('exit_code', models.IntegerField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('build', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tasks', to='projects.Build')),
+            ],
+            options={
+                'ordering': ('phase', 'name'),
+            },
+        ),
+        migrations.CreateModel(
+            name='Worker',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('token', models.CharField(default=workers.models.new_token, max_length=64, unique=True)),
+                ('profiles', models.CharField(default='default', help_text='The profiles of task the worker can run, separated by colons.', max_length=200)),
+                ('active', models.BooleanField(default=True)),
+                ('last_seen', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ('name',),
+            },
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='worker',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='tasks', to='workers.Worker'),
+        ),
+        migrations.AddField(
+            model_name='logchunk',
+            name='task',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='log_chunks', to='workers.Task'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='task',
+            unique_together=set([('build', 'slug')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='logchunk',
+            unique_together=set([('task', 'line')]),
+        ),
+    ]
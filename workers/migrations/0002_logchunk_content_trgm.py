@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-20 09:15
+from __future__ import unicode_literals
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workers', '0001_initial'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        # Log search uses content__icontains, which is compiled to
+        # UPPER("content"::text) LIKE UPPER(...); index that expression.
+        migrations.RunSQL(
+            'CREATE INDEX workers_logchunk_content_upper_trgm ON workers_logchunk USING gin ((UPPER("content"::text)) gin_trgm_ops);',
+            'DROP INDEX workers_logchunk_content_upper_trgm;',
+        ),
+    ]
@@ -0,0 +1,224 @@
+import logging
+import secrets
+from datetime import timedelta
+
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.timesince import timesince
+
+from projects import events
+from projects.models import Build, BaseTask, BaseTaskQuerySet
+
+
+log = logging.getLogger('workers')
+
+# The channel that is notified whenever a task is queued, so that idle
+# workers can claim it straight away.
+WORK_QUEUE = 'beekeeper:work'
+
+# How long a worker can go without sending a heartbeat before the task
+# it is running is considered lost.
+HEARTBEAT_TIMEOUT = timedelta(seconds=60)
+
+# The longest a task can run before it is stopped.
+TASK_TIMEOUT = timedelta(hours=1)
+
+# The maximum number of log chunks returned by a single read.
+MAX_READ_CHUNKS = 100
+
+
+def new_token():
+    return secrets.token_hex(20)
+
+
+class Worker(models.Model):
+    """A machine running a BeeKeeper agent, which pulls tasks to run.
+
+    Agents identify themselves with the worker's token.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    token = models.CharField(max_length=64, unique=True, default=new_token)
+    profiles = models.CharField(
+        max_length=200,
+        default='default',
+        help_text="The profiles of task the worker can run, separated by colons."
+    )
+
+    active = models.BooleanField(default=True)
+    last_seen = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('name',)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def profile_slugs(self):
+        return self.profiles.split(':')
+
+    def seen(self):
+        "Record that the worker's agent has been in contact."
+        self.last_seen = timezone.now()
+        Worker.objects.filter(pk=self.pk).update(last_seen=self.last_seen)
+
+
+class TaskQuerySet(BaseTaskQuerySet):
+    def using_capacity(self):
+        "Tasks that have been claimed by a worker."
+        return self.running()
+
+    def exited(self):
+        "Tasks that a worker has finished running, but haven't been checked."
+        return self.filter(
+            status__in=(Task.STATUS_RUNNING, Task.STATUS_STOPPING),
+            completed__isnull=False
+        )
+
+    def lost(self):
+        "Tasks whose worker has stopped sending heartbeats."
+        return self.filter(
+            status__in=(Task.STATUS_RUNNING, Task.STATUS_STOPPING),
+            completed__isnull=True,
+            heartbeat__lt=timezone.now() - HEARTBEAT_TIMEOUT
+        )
+
+    def claim(self, worker):
+        """Assign the longest waiting task that the worker can run to it.
+
+        Workers claim tasks concurrently; rows that another worker is
+        in the middle of claiming are skipped, rather than waited for.
+
+        Returns the task, or None if there is nothing to run.
+        """
+        with transaction.atomic():
+            task = self.select_for_update(skip_locked=True).filter(
+                    status=Task.STATUS_WAITING,
+                    worker__isnull=True,
+                    profile_slug__in=worker.profile_slugs,
+                ).order_by('queued').first()
+            if task is None:
+                return None
+
+            log.info("%s:%s claimed by %s." % (task.build, task, worker))
+            task.worker = worker
+            task.status = Task.STATUS_RUNNING
+            task.started = timezone.now()
+            task.heartbeat = task.started
+            task.save()
+        return task
+
+
+class Task(BaseTask):
+    objects = TaskQuerySet.as_manager()
+
+    worker = models.ForeignKey(
+        Worker, null=True, blank=True, related_name='tasks', on_delete=models.SET_NULL
+    )
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    exit_code = models.IntegerField(null=True, blank=True)
+
+    def full_status_display(self):
+        if self.status == Task.STATUS_RUNNING:
+            return "Running on %s (for %s)" % (self.worker, timesince(self.started))
+        return super().full_status_display()
+
+    def queue(self):
+        "Make this task available for a worker to claim."
+        self.status = Task.STATUS_WAITING
+        if self.queued is None:
+            self.queued = timezone.now()
+        self.save()
+
+        # Wake up any workers that are waiting for something to do.
+        events.publish([WORK_QUEUE], 'queued', {
+            'pk': self.pk,
+            'profile': self.profile_slug,
+        })
+
+    def finish(self):
+        "Record the outcome of a task that its worker has finished running."
+        if self.status == Task.STATUS_STOPPING:
+            self.status = Task.STATUS_STOPPED
+        elif self.exit_code is None:
+            self.status = Task.STATUS_ERROR
+        else:
+            self.status = Task.STATUS_DONE
+            if self.exit_code == 0:
+                self.result = Build.RESULT_PASS
+            elif self.is_critical:
+                self.result = Build.RESULT_FAIL
+            else:
+                self.result = Build.RESULT_NON_CRITICAL_FAIL
+
+    def reset(self):
+        "Return this task to its initial state, so that it can be run again."
+        self.log_chunks.all().delete()
+
+        self.status = Task.STATUS_CREATED
+        self.result = Build.RESULT_PENDING
+        self.queued = None
+        self.started = None
+        self.completed = None
+        self.worker = None
+        self.heartbeat = None
+        self.exit_code = None
+        self.error = ''
+        self.save()
+
+    def read_log(self, offset=0):
+        """Read the log received from the worker, starting at a line number.
+
+        Returns a tuple containing the log data, and the offset that
+        should be used for the next read.
+        """
+        chunks = list(self.log_chunks.filter(line__gte=offset)[:MAX_READ_CHUNKS])
+        if not chunks:
+            return '', offset
+
+        return ''.join(chunk.content + '\n' for chunk in chunks), chunks[-1].next_line
+
+    def read_new_log(self, offset=0):
+        """Read the log received from the worker, starting at a line number.
+
+        Returns the log data, the offset that should be used for the next
+        read, and whether the whole log has been read. Workers send all of
+        a task's log before reporting that it has finished, so once the
+        task has finished, the log is complete.
+        """
+        log_data, offset = self.read_log(offset)
+        return log_data, offset, not self.log_chunks.filter(line__gte=offset).exists()
+
+
+class LogChunk(models.Model):
+    """A group of consecutive lines from the log of a task, as sent by
+    the worker running the task.
+    """
+    task = models.ForeignKey(Task, related_name='log_chunks')
+    line = models.IntegerField()
+    content = models.TextField()
+
+    class Meta:
+        ordering = ('task', 'line')
+        unique_together = [('task', 'line')]
+
+    def __str__(self):
+        return '%s, line %s' % (self.task, self.line + 1)
+
+    @property
+    def next_line(self):
+        "The number of the line that follows this chunk."
+        return self.line + self.content.count('\n') + 1
+
+    def matching_lines(self, query):
+        """Return the lines in this chunk that contain the query.
+
+        Returns a list of (line number, line) pairs; the search is
+        case insensitive.
+        """
+        query = query.lower()
+        return [
+            (self.line + i + 1, line)
+            for i, line in enumerate(self.content.split('\n'))
+            if query in line.lower()
+        ]
@@ -0,0 +1,86 @@
+import logging
+
+from config.celery import app
+
+from django.utils import timezone
+
+from projects.models import Build
+from projects.phases import BuildChecker, github_repository, on_check_build_failure
+from workers.models import Task, TASK_TIMEOUT
+
+
+log = logging.getLogger('workers')
+
+# Turn down Github logging
+ghlog = logging.getLogger('github3')
+ghlog.setLevel(logging.WARNING)
+
+# Turn down urllib3 logging
+urllib3log = logging.getLogger('requests.packages.urllib3')
+urllib3log.setLevel(logging.WARNING)
+
+
+class WorkerBuildChecker(BuildChecker):
+    """Check the progress of builds whose tasks are run by workers.
+
+    Tasks are queued for workers to claim; workers report the outcome of
+    the tasks they run.
+    """
+    log = log
+
+    def start_task(self, task):
+        task.queue()
+
+    def update_tasks(self):
+        build = self.build
+        # Record the outcome of tasks that workers have finished running.
+        for task in build.tasks.exited():
+            task.finish()
+            task.save()
+            log.info("Build %s: Task %s finished (%s)" % (build, task, task.get_status_display()))
+            if task.status == Task.STATUS_DONE:
+                task.report(self.gh_repo)
+
+        for task in build.tasks.lost():
+            log.info("Build %s: Lost contact with %s, running task %s" % (build, task.worker, task))
+            task.status = Task.STATUS_ERROR
+            task.error = "Lost contact with worker %s." % task.worker
+            task.save()
+
+        for task in build.tasks.running().filter(started__lt=timezone.now() - TASK_TIMEOUT):
+            log.info("Build %s: Task %s has exceeded maximum duration; stopping" % (build, task))
+            task.stop()
+
+    def stop_tasks(self):
+        build = self.build
+        for task in build.tasks.exited():
+            task.finish()
+            task.save()
+
+        # Workers that have gone away can't confirm their task has stopped.
+        for task in build.tasks.lost():
+            task.status = Task.STATUS_STOPPED
+            task.save()
+
+        for task in build.tasks.filter(status__in=(Task.STATUS_WAITING, Task.STATUS_RUNNING)):
+            task.stop()
+
+        stopping_tasks = build.tasks.stopping()
+        if stopping_tasks:
+            log.info("Build %s: Waiting for %s tasks to stop." % (build, stopping_tasks.count()))
+            return False
+        return True
+
+
+@app.task(
+    bind=True,
+    on_failure=on_check_build_failure
+)
+def check_build(self, build_pk):
+    build = Build.objects.get(pk=build_pk)
+
+    if WorkerBuildChecker(build, github_repository(build)).check():
+        log.debug("Build %s: Schedule another check..." % build)
+        check_build.apply_async((build_pk,), countdown=5)
+
+    log.debug("Build %s: Check complete." % build)
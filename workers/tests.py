@@ -0,0 +1,160 @@
+import json
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+from django.apps import apps
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from projects.models import Build
+from projects.tests.utils import create_build
+
+# The models of a build app can only be loaded when it is the app in use;
+# CI runs the tests once for each build app (see .travis.yml).
+if not apps.is_installed('workers'):
+    raise unittest.SkipTest("BEEKEEPER_BUILD_APP isn't workers.")
+
+from . import views
+from .models import Task, Worker
+
+
+class WorkerTestCase(TestCase):
+    def setUp(self):
+        self.build = create_build()
+        for slug, profile in [('first', 'default'), ('second', 'default'), ('gpu', 'gpu')]:
+            self.build.tasks.create(
+                name=slug.title(),
+                slug=slug,
+                phase=0,
+                is_critical=slug != 'second',
+                environment={},
+                profile_slug=profile,
+                image='beekeeper/python',
+            ).queue()
+
+        self.worker = Worker.objects.create(name='local')
+
+    def post(self, name, data=None, token=None, **kwargs):
+        return self.client.post(
+            reverse('tasks:%s' % name, kwargs=kwargs),
+            json.dumps(data or {}),
+            content_type='application/json',
+            HTTP_AUTHORIZATION='Token %s' % (token or self.worker.token),
+        )
+
+
+class ClaimTests(WorkerTestCase):
+    def test_claim(self):
+        # Tasks are claimed in the order they were queued, and only by
+        # workers that run their profile.
+        claimed = [Task.objects.claim(self.worker) for i in range(3)]
+        self.assertEqual([task.slug if task else None for task in claimed], ['first', 'second', None])
+
+        task = Task.objects.get(slug='first')
+        self.assertEqual(task.status, Task.STATUS_RUNNING)
+        self.assertEqual(task.worker, self.worker)
+
+    def test_nothing_to_run(self):
+        self.build.tasks.update(status=Task.STATUS_DONE)
+
+        response = self.post('claim')
+        self.assertEqual(response.status_code, 204)
+
+        self.worker.refresh_from_db()
+        self.assertIsNotNone(self.worker.last_seen)
+
+    def test_unknown_worker(self):
+        response = self.post('claim', token='not-a-token')
+        self.assertEqual(response.status_code, 403)
+
+
+class RunTests(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.task = Task.objects.claim(self.worker)
+
+    def test_heartbeat(self):
+        response = self.post('heartbeat', task_pk=self.task.pk)
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {'stop': False})
+
+        # A stopped task is stopped by the worker on its next heartbeat.
+        self.task.stop()
+        response = self.post('heartbeat', task_pk=self.task.pk)
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {'stop': True})
+
+    def test_other_worker(self):
+        other = Worker.objects.create(name='other')
+        response = self.post('heartbeat', token=other.token, task_pk=self.task.pk)
+        self.assertEqual(response.status_code, 404)
+
+    def test_log(self):
+        self.post('append-log', {'line': 0, 'lines': ['one', 'two']}, task_pk=self.task.pk)
+        self.post('append-log', {'line': 2, 'lines': ['three']}, task_pk=self.task.pk)
+        # Resending lines doesn't duplicate them.
+        self.post('append-log', {'line': 2, 'lines': ['three']}, task_pk=self.task.pk)
+
+        self.assertEqual(self.task.read_log(), ('one\ntwo\nthree\n', 3))
+        self.assertEqual(self.task.read_log(2), ('three\n', 3))
+        self.assertEqual(self.task.read_log(3), ('', 3))
+
+    def test_complete(self):
+        response = self.post('complete', {'exit_code': 1}, task_pk=self.task.pk)
+        self.assertEqual(response.status_code, 204)
+
+        # The outcome is recorded when the build is next checked.
+        task = Task.objects.exited().get()
+        task.finish()
+        self.assertEqual(task.status, Task.STATUS_DONE)
+        self.assertEqual(task.result, Build.RESULT_FAIL)
+
+    def test_error(self):
+        self.post('complete', {'error': 'No Docker'}, task_pk=self.task.pk)
+
+        task = Task.objects.exited().get()
+        task.finish()
+        self.assertEqual(task.status, Task.STATUS_ERROR)
+        self.assertEqual(task.error, 'No Docker')
+
+    def test_stopped_while_completing(self):
+        retrieve = views.worker_task
+
+        def stop_after_retrieving(request, task_pk):
+            task = retrieve(request, task_pk)
+            Task.objects.filter(pk=task.pk).update(status=Task.STATUS_STOPPING)
+            return task
+
+        with mock.patch.object(views, 'worker_task', stop_after_retrieving):
+            self.post('complete', {'exit_code': 0}, task_pk=self.task.pk)
+
+        # The stop request isn't lost when the outcome is recorded.
+        task = Task.objects.exited().get()
+        task.finish()
+        self.assertEqual(task.status, Task.STATUS_STOPPED)
+
+    def test_lost(self):
+        self.assertFalse(Task.objects.lost().exists())
+
+        Task.objects.filter(pk=self.task.pk).update(heartbeat=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(list(Task.objects.lost()), [self.task])
+
+
+# Rendering pages shouldn't depend on having run collectstatic.
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class LogTests(WorkerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.task = Task.objects.get(slug='first')
+        self.task.log_chunks.create(line=0, content='hello\nHELLO world\nbye')
+
+    def test_status(self):
+        response = self.client.get(self.task.get_status_url())
+        self.assertEqual(response.json()['log'], 'hello\nHELLO world\nbye\n')
+        self.assertEqual(response.json()['offset'], 3)
+
+    def test_search(self):
+        response = self.client.get(reverse('tasks:search'), {'q': 'hello'})
+        self.assertEqual(response.context['results'], [
+            {'task': self.task, 'lines': [(1, 'hello'), (2, 'HELLO world')]},
+        ])
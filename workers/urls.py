@@ -0,0 +1,17 @@
+from django.conf.urls import url
+
+from projects import views as projects
+from . import views as workers
+
+
+urlpatterns = [
+    url(r'^$', projects.current_tasks, name='current-tasks'),
+    url(r'^events$', projects.current_tasks_events, name='current-tasks-events'),
+    url(r'^search$', projects.search, name='search'),
+
+    # The API used by worker agents.
+    url(r'^api/claim$', workers.claim, name='claim'),
+    url(r'^api/(?P<task_pk>\d+)/heartbeat$', workers.heartbeat, name='heartbeat'),
+    url(r'^api/(?P<task_pk>\d+)/log$', workers.append_log, name='append-log'),
+    url(r'^api/(?P<task_pk>\d+)/complete$', workers.complete, name='complete'),
+]
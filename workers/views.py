@@ -0,0 +1,203 @@
+import functools
+import json
+import time
+
+import redis
+
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden,
+    StreamingHttpResponse
+)
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from projects import events
+from projects.views import get_task
+
+from .models import Task, LogChunk, Worker, WORK_QUEUE
+
+# The longest (in seconds) a worker's request for a task is held open
+# when there is nothing to run. A waiting request holds a thread of a web
+# worker (see the Procfile), so each idle agent holds one thread.
+MAX_CLAIM_WAIT = 20
+
+# How often (in seconds) a waiting request checks for work, in case
+# the notification of a new task was missed.
+CLAIM_POLL_INTERVAL = 1
+
+
+def task_log(request, owner, repo_name, change_pk, build_pk, task_slug):
+    task = get_task(owner, repo_name, change_pk, build_pk, task_slug)
+
+    return StreamingHttpResponse(
+        (chunk.content + '\n' for chunk in task.log_chunks.iterator()),
+        content_type="text/plain; charset=utf-8"
+    )
+
+
+def worker_api(view):
+    """Decorate a view that is called by a worker's agent.
+
+    The agent authenticates with its worker's token; the worker is
+    provided to the view as request.worker, and the request body is
+    decoded as JSON into request.data.
+    """
+    @csrf_exempt
+    @require_POST
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            scheme, token = request.META.get('HTTP_AUTHORIZATION', '').split(' ', 1)
+            if scheme != 'Token':
+                raise ValueError()
+            request.worker = Worker.objects.get(token=token, active=True)
+        except (ValueError, Worker.DoesNotExist):
+            return HttpResponseForbidden('Permission denied.')
+
+        try:
+            request.data = json.loads(request.body.decode('utf-8')) if request.body else {}
+        except ValueError:
+            return HttpResponseBadRequest('Invalid JSON.')
+
+        request.worker.seen()
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def subscribe_to_work():
+    """Subscribe to notifications of newly queued tasks.
+
+    Returns None if the notifications aren't available.
+    """
+    try:
+        pubsub = events.connection().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(WORK_QUEUE)
+        return pubsub
+    except redis.RedisError:
+        return None
+
+
+@worker_api
+def claim(request):
+    """Assign a task to the worker.
+
+    If there is nothing to run, the request is held open for up to
+    `wait` seconds (given as a query argument), so that the worker
+    can claim a task as soon as it is queued.
+    """
+    try:
+        wait = max(0, min(float(request.GET.get('wait', 0)), MAX_CLAIM_WAIT))
+    except ValueError:
+        wait = 0
+
+    deadline = time.time() + wait
+    # Subscribe before looking for work, so a task queued while we look
+    # isn't missed.
+    pubsub = subscribe_to_work() if wait else None
+    try:
+        while True:
+            task = Task.objects.claim(request.worker)
+            remaining = deadline - time.time()
+            if task or remaining <= 0:
+                break
+
+            timeout = min(remaining, CLAIM_POLL_INTERVAL)
+            try:
+                if pubsub:
+                    pubsub.get_message(timeout=timeout)
+                else:
+                    time.sleep(timeout)
+            except redis.RedisError:
+                pubsub = None
+    finally:
+        if pubsub:
+            pubsub.close()
+
+    if task is None:
+        return HttpResponse(status=204)
+
+    return HttpResponse(json.dumps({
+            'id': task.pk,
+            'name': '%s:%s' % (task.build, task.slug),
+            'image': task.image,
+            'environment': {
+                str(key): str(value)
+                for key, value in task.run_environment().items()
+            },
+        }), content_type="application/json")
+
+
+def worker_task(request, task_pk):
+    "Retrieve a task that has been claimed by the worker making the request."
+    try:
+        return Task.objects.get(pk=task_pk, worker=request.worker)
+    except Task.DoesNotExist:
+        raise Http404
+
+
+@worker_api
+def heartbeat(request, task_pk):
+    """Record that the worker is still running a task.
+
+    The response tells the worker if it should stop the task.
+    """
+    task = worker_task(request, task_pk)
+    Task.objects.filter(pk=task.pk).update(heartbeat=timezone.now())
+
+    return HttpResponse(json.dumps({
+            'stop': task.status != Task.STATUS_RUNNING,
+        }), content_type="application/json")
+
+
+@worker_api
+def append_log(request, task_pk):
+    """Add lines to the log of a task.
+
+    The request provides the number of the first line, so a worker can
+    safely resend lines if it isn't sure they were received.
+    """
+    task = worker_task(request, task_pk)
+    try:
+        line = int(request.data['line'])
+        lines = [str(content) for content in request.data['lines']]
+    except (KeyError, TypeError, ValueError):
+        return HttpResponseBadRequest('A line number and a list of lines must be provided.')
+
+    if lines:
+        LogChunk.objects.get_or_create(task=task, line=line, defaults={
+            'content': '\n'.join(lines),
+        })
+    return HttpResponse(status=204)
+
+
+@worker_api
+def complete(request, task_pk):
+    """Record that the worker has finished running a task.
+
+    The request provides the exit code of the task, or an error if the
+    task couldn't be run. The outcome is recorded (and reported to
+    GitHub) on the next check of the build.
+    """
+    task = worker_task(request, task_pk)
+    try:
+        exit_code = request.data.get('exit_code')
+        if exit_code is not None:
+            exit_code = int(exit_code)
+    except (AttributeError, TypeError, ValueError):
+        return HttpResponseBadRequest('The exit code must be an integer.')
+
+    if task.completed is None and not task.is_finished:
+        if exit_code is None:
+            error = str(request.data.get('error', 'Worker was unable to run the task.'))
+        else:
+            error = task.error
+        # Use an update, so that a stop request made since the task was
+        # retrieved isn't overwritten.
+        Task.objects.filter(pk=task.pk, completed__isnull=True).update(
+            exit_code=exit_code,
+            error=error,
+            completed=timezone.now(),
+        )
+
+    return HttpResponse(status=204)